@@ -0,0 +1,57 @@
+-- One time migration for a sakila_star database whose dim_film held one row per film and category
+-- (a film in N categories had N dim_film rows, the fact rows of its rentals pointed at one of them)
+-- This script moves the categories into bridge_film_category, keeps one dim_film row per film,
+-- points the fact table at it and replaces the (film_id, film_category_id) unique key by film_id.
+-- Run it after Script-Migrate-Sakila-Star-Lean-Indexes.sql
+
+-- Using sakila_star database
+USE sakila_star;
+
+-- Keep the newest row (highest surrogate key) of every film
+CREATE TEMPORARY TABLE keep_film AS
+SELECT film_id, MAX(film_key) AS film_key
+FROM dim_film
+GROUP BY film_id;
+
+-- Create Bridge Film Category Tables
+-- -----------------------------------------------------
+-- Table `sakila_star`.`bridge_film_category`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `sakila_star`.`bridge_film_category` (
+    `film_key` INT(8) NOT NULL,
+    `category_id` INT(12) NOT NULL,
+    `category_name` CHAR(30) NULL DEFAULT NULL,
+    `last_update` DATETIME NOT NULL,
+    PRIMARY KEY (`film_key`, `category_id`),
+    KEY idx_category_id (category_id));
+
+-- Every category row of a film goes to the bridge under the kept film_key
+INSERT IGNORE INTO bridge_film_category(film_key, category_id, category_name, last_update)
+SELECT KF.film_key, DF.film_category_id, DF.film_category_name, DF.film_last_update
+FROM dim_film AS DF
+INNER JOIN keep_film AS KF ON DF.film_id = KF.film_id;
+
+-- Point fact rows at the kept film row before the other rows of the film are deleted
+UPDATE fact_transaction AS FT
+INNER JOIN dim_film AS DF ON FT.film_key = DF.film_key
+INNER JOIN keep_film AS KF ON DF.film_id = KF.film_id
+SET FT.film_key = KF.film_key
+WHERE FT.film_key <> KF.film_key;
+
+DELETE DF FROM dim_film AS DF
+INNER JOIN keep_film AS KF ON DF.film_id = KF.film_id
+WHERE DF.film_key <> KF.film_key;
+
+-- dim_film is one row per film from here on
+ALTER TABLE `sakila_star`.`dim_film`
+    DROP INDEX `uq_film_category_id`,
+    DROP INDEX `idx_category_id`,
+    DROP COLUMN `film_category_id`,
+    DROP COLUMN `film_category_name`,
+    ADD UNIQUE KEY uq_film_id (film_id);
+
+-- Recreate the staging table of the daily load with the new columns and keys
+DROP TABLE IF EXISTS stg_dim_film;
+CREATE TABLE `sakila_star`.`stg_dim_film` LIKE `sakila_star`.`dim_film`;
+
+DROP TEMPORARY TABLE keep_film;
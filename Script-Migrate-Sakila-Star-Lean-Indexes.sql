@@ -0,0 +1,45 @@
+-- One time migration for a sakila_star database created with the duplicate and prefix-redundant indexes
+-- Written by script-audit-star-schema-indexes.py against the earlier create_table DDL:
+-- every dimension indexed its natural id three times (the UNIQUE key, KEY idx_x_id and INDEX x_id USING BTREE)
+-- and the fact table every dimension key twice (fk_x_idx and idx_x), which every upsert had to maintain.
+-- Run it after Script-Migrate-Sakila-Star-Partition-Fact.sql
+
+-- Using sakila_star database
+USE sakila_star;
+
+-- The natural id is already indexed by the UNIQUE key the upserts rely on
+ALTER TABLE `sakila_star`.`dim_customer`
+    DROP INDEX `customer_id`,
+    DROP INDEX `idx_customer_id`;
+
+ALTER TABLE `sakila_star`.`dim_store`
+    DROP INDEX `store_id`,
+    DROP INDEX `idx_store_id`;
+
+ALTER TABLE `sakila_star`.`dim_staff`
+    DROP INDEX `staff_id`,
+    DROP INDEX `idx_staff_id`;
+
+-- film_id is the leading column of uq_film_category_id (film_id, film_category_id)
+ALTER TABLE `sakila_star`.`dim_film`
+    DROP INDEX `film_id`,
+    DROP INDEX `idx_film_id`;
+
+-- rental_id is the leading column of uq_rental_payment_id, the fk_x_idx indexes duplicate idx_x,
+-- and the covering index of the customer feature query starts with customer_key
+ALTER TABLE `sakila_star`.`fact_transaction`
+    DROP INDEX `idx_rental`,
+    DROP INDEX `fk_film_idx`,
+    DROP INDEX `fk_staff_idx`,
+    DROP INDEX `fk_store_idx`,
+    DROP INDEX `fk_customer_idx`,
+    DROP INDEX `idx_customer`,
+    ADD INDEX `idx_customer_film_amount` (customer_key, film_key, payment_amount);
+
+-- Recreate the staging tables of the daily load with the lean index set
+DROP TABLE IF EXISTS stg_dim_customer, stg_dim_store, stg_dim_staff, stg_dim_film, stg_fact_transaction;
+CREATE TABLE stg_dim_customer LIKE dim_customer;
+CREATE TABLE stg_dim_store LIKE dim_store;
+CREATE TABLE stg_dim_staff LIKE dim_staff;
+CREATE TABLE stg_dim_film LIKE dim_film;
+CREATE TABLE stg_fact_transaction LIKE fact_transaction;
@@ -0,0 +1,104 @@
+-- One time migration for a sakila_star database that was loaded before the natural key UNIQUE constraints existed
+-- Without them ON DUPLICATE KEY UPDATE never fired, so every changed source row was appended as another copy
+-- This script keeps one row per natural key, points the fact table at the kept dimension rows,
+-- and then adds the UNIQUE constraints that the daily airflow load relies on
+
+-- Using sakila_star database
+USE sakila_star;
+
+-- Keep the newest copy (highest surrogate key) of every natural key, it holds the latest loaded data
+-- -----------------------------------------------------
+-- Dimension Customer
+-- -----------------------------------------------------
+CREATE TEMPORARY TABLE keep_customer AS
+SELECT customer_id, MAX(customer_key) AS customer_key
+FROM dim_customer
+GROUP BY customer_id;
+
+-- Point fact rows at the kept customer row before the duplicates are deleted
+-- (fk_customer is ON DELETE CASCADE, deleting first would delete the facts too)
+UPDATE fact_transaction AS FT
+INNER JOIN dim_customer AS DC ON FT.customer_key = DC.customer_key
+INNER JOIN keep_customer AS KC ON DC.customer_id = KC.customer_id
+SET FT.customer_key = KC.customer_key
+WHERE FT.customer_key <> KC.customer_key;
+
+DELETE DC FROM dim_customer AS DC
+INNER JOIN keep_customer AS KC ON DC.customer_id = KC.customer_id
+WHERE DC.customer_key <> KC.customer_key;
+
+-- -----------------------------------------------------
+-- Dimension Store
+-- -----------------------------------------------------
+CREATE TEMPORARY TABLE keep_store AS
+SELECT store_id, MAX(store_key) AS store_key
+FROM dim_store
+GROUP BY store_id;
+
+UPDATE fact_transaction AS FT
+INNER JOIN dim_store AS DS ON FT.store_key = DS.store_key
+INNER JOIN keep_store AS KS ON DS.store_id = KS.store_id
+SET FT.store_key = KS.store_key
+WHERE FT.store_key <> KS.store_key;
+
+DELETE DS FROM dim_store AS DS
+INNER JOIN keep_store AS KS ON DS.store_id = KS.store_id
+WHERE DS.store_key <> KS.store_key;
+
+-- -----------------------------------------------------
+-- Dimension Staff
+-- -----------------------------------------------------
+CREATE TEMPORARY TABLE keep_staff AS
+SELECT staff_id, MAX(staff_key) AS staff_key
+FROM dim_staff
+GROUP BY staff_id;
+
+UPDATE fact_transaction AS FT
+INNER JOIN dim_staff AS DS ON FT.staff_key = DS.staff_key
+INNER JOIN keep_staff AS KS ON DS.staff_id = KS.staff_id
+SET FT.staff_key = KS.staff_key
+WHERE FT.staff_key <> KS.staff_key;
+
+DELETE DS FROM dim_staff AS DS
+INNER JOIN keep_staff AS KS ON DS.staff_id = KS.staff_id
+WHERE DS.staff_key <> KS.staff_key;
+
+-- -----------------------------------------------------
+-- Dimension Film (one row per film and category)
+-- -----------------------------------------------------
+CREATE TEMPORARY TABLE keep_film AS
+SELECT film_id, film_category_id, MAX(film_key) AS film_key
+FROM dim_film
+GROUP BY film_id, film_category_id;
+
+UPDATE fact_transaction AS FT
+INNER JOIN dim_film AS DF ON FT.film_key = DF.film_key
+INNER JOIN keep_film AS KF ON DF.film_id = KF.film_id AND DF.film_category_id = KF.film_category_id
+SET FT.film_key = KF.film_key
+WHERE FT.film_key <> KF.film_key;
+
+DELETE DF FROM dim_film AS DF
+INNER JOIN keep_film AS KF ON DF.film_id = KF.film_id AND DF.film_category_id = KF.film_category_id
+WHERE DF.film_key <> KF.film_key;
+
+-- -----------------------------------------------------
+-- Fact Rental Transaction (one row per rental and payment)
+-- -----------------------------------------------------
+CREATE TEMPORARY TABLE keep_transaction AS
+SELECT rental_id, payment_id, MAX(transaction_key) AS transaction_key
+FROM fact_transaction
+GROUP BY rental_id, payment_id
+HAVING COUNT(*) > 1;
+
+DELETE FT FROM fact_transaction AS FT
+INNER JOIN keep_transaction AS KT ON FT.rental_id = KT.rental_id AND FT.payment_id = KT.payment_id
+WHERE FT.transaction_key <> KT.transaction_key;
+
+-- Add the natural key UNIQUE constraints, from now on ON DUPLICATE KEY UPDATE updates the row in place
+ALTER TABLE dim_customer ADD UNIQUE KEY uq_customer_id (customer_id);
+ALTER TABLE dim_store ADD UNIQUE KEY uq_store_id (store_id);
+ALTER TABLE dim_staff ADD UNIQUE KEY uq_staff_id (staff_id);
+ALTER TABLE dim_film ADD UNIQUE KEY uq_film_category_id (film_id, film_category_id);
+ALTER TABLE fact_transaction ADD UNIQUE KEY uq_rental_payment_id (rental_id, payment_id);
+
+DROP TEMPORARY TABLE keep_customer, keep_store, keep_staff, keep_film, keep_transaction;
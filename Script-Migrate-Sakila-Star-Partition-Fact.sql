@@ -0,0 +1,40 @@
+-- One time migration for a sakila_star database whose fact_transaction table was created before it was partitioned
+-- It turns the table into the monthly RANGE partitioned layout of the daily airflow load,
+-- the airflow task maintain_fact_partitions adds the months after the ones created here
+
+-- Using sakila_star database
+USE sakila_star;
+
+-- MySQL does not support foreign keys on partitioned tables, drop the keys to the dimension tables
+ALTER TABLE fact_transaction
+    DROP FOREIGN KEY fk_customer,
+    DROP FOREIGN KEY fk_staff,
+    DROP FOREIGN KEY fk_store,
+    DROP FOREIGN KEY fk_film;
+
+-- Every unique key of a partitioned table has to contain the partitioning column rental_date
+ALTER TABLE fact_transaction
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (transaction_key, rental_date),
+    DROP KEY uq_rental_payment_id,
+    ADD UNIQUE KEY uq_rental_payment_id (rental_id, payment_id, rental_date);
+
+-- Partition by month of rental_date, rows after the last month go to p_future
+ALTER TABLE fact_transaction
+PARTITION BY RANGE (TO_DAYS(rental_date)) (
+    PARTITION p_history VALUES LESS THAN (TO_DAYS('2005-05-01')),
+    PARTITION p200505 VALUES LESS THAN (TO_DAYS('2005-06-01')),
+    PARTITION p200506 VALUES LESS THAN (TO_DAYS('2005-07-01')),
+    PARTITION p200507 VALUES LESS THAN (TO_DAYS('2005-08-01')),
+    PARTITION p200508 VALUES LESS THAN (TO_DAYS('2005-09-01')),
+    PARTITION p200509 VALUES LESS THAN (TO_DAYS('2005-10-01')),
+    PARTITION p200510 VALUES LESS THAN (TO_DAYS('2005-11-01')),
+    PARTITION p200511 VALUES LESS THAN (TO_DAYS('2005-12-01')),
+    PARTITION p200512 VALUES LESS THAN (TO_DAYS('2006-01-01')),
+    PARTITION p200601 VALUES LESS THAN (TO_DAYS('2006-02-01')),
+    PARTITION p200602 VALUES LESS THAN (TO_DAYS('2006-03-01')),
+    PARTITION p_future VALUES LESS THAN MAXVALUE);
+
+-- Recreate the staging table of the daily load with the new layout
+DROP TABLE IF EXISTS stg_fact_transaction;
+CREATE TABLE stg_fact_transaction LIKE fact_transaction;
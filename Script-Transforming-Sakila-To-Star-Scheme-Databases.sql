@@ -12,6 +12,91 @@ SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='ONLY_FULL_GROUP_BY,STRICT_TRANS_TABLES,NO_ZERO_IN_DATE,NO_ZERO_DATE,ERROR_FOR_DIVISION_BY_ZERO,NO_ENGINE_SUBSTITUTION';
 
+-- Create ETL Watermark and Changed Keys Tables
+-- -----------------------------------------------------
+-- Table `sakila_star`.`etl_watermark`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_watermark` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `source_table` VARCHAR(64) NOT NULL,
+    `last_update` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
+    `last_id` INT(12) NOT NULL DEFAULT 0,
+    `updated_at` DATETIME NULL DEFAULT NULL,
+    PRIMARY KEY (`target_table`, `source_table`));
+
+-- -----------------------------------------------------
+-- Table `sakila_star`.`etl_changed_keys`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_changed_keys` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `natural_id` INT(12) NOT NULL,
+    PRIMARY KEY (`target_table`, `natural_id`));
+
+-- Start the daily airflow load from a snapshot of the sources taken before any row is loaded below
+-- The watermark is the highest (last_update, id) of every source table of every load at this point, so a source row
+-- that changes while the tables below are loaded is newer than the watermark and the first daily run loads it again
+-- (the daily upserts are idempotent), instead of falling in the gap between the full load and the watermark
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_customer', 'customer', last_update, customer_id, NOW()
+FROM sakila.customer ORDER BY last_update DESC, customer_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_customer', 'address', last_update, address_id, NOW()
+FROM sakila.address ORDER BY last_update DESC, address_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_customer', 'city', last_update, city_id, NOW()
+FROM sakila.city ORDER BY last_update DESC, city_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_customer', 'country', last_update, country_id, NOW()
+FROM sakila.country ORDER BY last_update DESC, country_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_store', 'store', last_update, store_id, NOW()
+FROM sakila.store ORDER BY last_update DESC, store_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_store', 'address', last_update, address_id, NOW()
+FROM sakila.address ORDER BY last_update DESC, address_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_store', 'city', last_update, city_id, NOW()
+FROM sakila.city ORDER BY last_update DESC, city_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_store', 'country', last_update, country_id, NOW()
+FROM sakila.country ORDER BY last_update DESC, country_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_store', 'staff', last_update, staff_id, NOW()
+FROM sakila.staff ORDER BY last_update DESC, staff_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_staff', 'staff', last_update, staff_id, NOW()
+FROM sakila.staff ORDER BY last_update DESC, staff_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_staff', 'address', last_update, address_id, NOW()
+FROM sakila.address ORDER BY last_update DESC, address_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_staff', 'city', last_update, city_id, NOW()
+FROM sakila.city ORDER BY last_update DESC, city_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_staff', 'country', last_update, country_id, NOW()
+FROM sakila.country ORDER BY last_update DESC, country_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_film', 'film', last_update, film_id, NOW()
+FROM sakila.film ORDER BY last_update DESC, film_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_film', 'language', last_update, language_id, NOW()
+FROM sakila.language ORDER BY last_update DESC, language_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_film', 'film_category', last_update, film_id, NOW()
+FROM sakila.film_category ORDER BY last_update DESC, film_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'dim_film', 'category', last_update, category_id, NOW()
+FROM sakila.category ORDER BY last_update DESC, category_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'fact_transaction', 'rental', last_update, rental_id, NOW()
+FROM sakila.rental ORDER BY last_update DESC, rental_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'fact_transaction', 'payment', last_update, payment_id, NOW()
+FROM sakila.payment ORDER BY last_update DESC, payment_id DESC LIMIT 1;
+INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+SELECT 'fact_transaction', 'inventory', last_update, inventory_id, NOW()
+FROM sakila.inventory ORDER BY last_update DESC, inventory_id DESC LIMIT 1;
+
 -- Create Dimention Customer Tables
 -- -----------------------------------------------------
 -- Table `sakila_star`.`dim_customer`
@@ -36,11 +121,10 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_customer` (
     `customer_location` GEOMETRY NULL DEFAULT NULL,
     `customer_create_date` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
     PRIMARY KEY (`customer_key`),
-    KEY idx_customer_id (customer_id),
+    UNIQUE KEY uq_customer_id (customer_id),
     KEY idx_address_id (customer_address_id),
     KEY idx_city_id (customer_city_id),
-    KEY idx_country_id (customer_country_id),
-    INDEX `customer_id` USING BTREE (`customer_id`) VISIBLE)
+    KEY idx_country_id (customer_country_id))
 AUTO_INCREMENT = 1;
 
 -- Insert data from sakila database to sakila_star database with new architecture
@@ -78,12 +162,11 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_store` (
     `store_manager_first_name` VARCHAR(45) NULL DEFAULT NULL,
     `store_manager_last_name` VARCHAR(45) NULL DEFAULT NULL,
     PRIMARY KEY (`store_key`),
-    KEY idx_store_id (store_id),
+    UNIQUE KEY uq_store_id (store_id),
     KEY idx_address_id (store_address_id),
     KEY idx_city_id (store_city_id),
     KEY idx_country_id (store_country_id),
-    KEY idx_manager_id (store_manager_staff_id),
-    INDEX `store_id` USING BTREE (`store_id`) VISIBLE);
+    KEY idx_manager_id (store_manager_staff_id));
 
 -- Insert data from sakila database to sakila_star database with new architecture
 INSERT INTO sakila_star.dim_store(store_key, store_last_update, store_id, store_address_id, store_address,
@@ -121,12 +204,11 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_staff` (
     `staff_store_id` INT(8) NULL DEFAULT NULL,
     `staff_active` CHAR(3) NULL DEFAULT NULL,
     PRIMARY KEY (`staff_key`),
-    KEY idx_staff_id (staff_id),
+    UNIQUE KEY uq_staff_id (staff_id),
     KEY idx_address_id (staff_address_id),
     KEY idx_city_id (staff_city_id),
     KEY idx_country_id (staff_country_id),
-    KEY idx_store_id (staff_store_id),
-    INDEX `staff_id` USING BTREE (`staff_id`) VISIBLE);
+    KEY idx_store_id (staff_store_id));
 
 -- Insert data from sakila database to sakila_star database with new architecture
 INSERT INTO sakila_star.dim_staff(staff_key, staff_last_update, staff_id, staff_first_name, staff_last_name,
@@ -142,6 +224,7 @@ INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
 INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id;
 
 -- Create Dimention Film Tables
+-- One row per film, the categories of a film are in bridge_film_category
 -- -----------------------------------------------------
 -- Table `sakila_star`.`dim_film`
 -- -----------------------------------------------------
@@ -160,29 +243,45 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_film` (
     `film_replacement_cost` DECIMAL(5,2) NULL DEFAULT NULL,
     `film_rating_text` VARCHAR(30) NULL DEFAULT NULL,
     `film_special_features` VARCHAR(64) NULL DEFAULT NULL,
-    `film_category_id` INT(12) NOT NULL,
-    `film_category_name` CHAR(30) NULL DEFAULT NULL,
     PRIMARY KEY (`film_key`),
-    KEY idx_film_id (film_id),
-    KEY idx_language_id (film_language_id),
-    KEY idx_category_id (film_category_id),
-    INDEX `film_id` USING BTREE (`film_id`) VISIBLE);
+    UNIQUE KEY uq_film_id (film_id),
+    KEY idx_language_id (film_language_id));
 
 -- Insert data from sakila database to sakila_star database with new architecture
 INSERT INTO sakila_star.dim_film(film_key,film_last_update,film_id,film_title,film_description,
                                  film_release_year,film_language_id,film_language_name,
                                  film_rental_duration,film_rental_rate,film_duration,
-                                 film_replacement_cost,film_rating_text,film_special_features,
-                                 film_category_id,film_category_name)
+                                 film_replacement_cost,film_rating_text,film_special_features)
 SELECT NULL, SFIL.last_update, SFIL.film_id, SFIL.title, SFIL.description, SFIL.release_year, SFIL.language_id, SLAN.name,
-SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features,
-SFCA.category_id, SCAT.name
+SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features
 FROM sakila.film AS SFIL
-INNER JOIN sakila.language AS SLAN ON SFIL.language_id = SLAN.language_id
-INNER JOIN sakila.film_category AS SFCA ON SFIL.film_id = SFCA.film_id
+INNER JOIN sakila.language AS SLAN ON SFIL.language_id = SLAN.language_id;
+
+-- Create Bridge Film Category Tables
+-- One row per film and category, so a film in several categories does not repeat the fact rows of its rentals
+-- -----------------------------------------------------
+-- Table `sakila_star`.`bridge_film_category`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `sakila_star`.`bridge_film_category` (
+    `film_key` INT(8) NOT NULL,
+    `category_id` INT(12) NOT NULL,
+    `category_name` CHAR(30) NULL DEFAULT NULL,
+    `last_update` DATETIME NOT NULL,
+    PRIMARY KEY (`film_key`, `category_id`),
+    KEY idx_category_id (category_id));
+
+-- Insert data from sakila database to sakila_star database with new architecture
+INSERT INTO sakila_star.bridge_film_category(film_key,category_id,category_name,last_update)
+SELECT DFIL.film_key, SFCA.category_id, SCAT.name, GREATEST(SFCA.last_update, SCAT.last_update)
+FROM sakila_star.dim_film AS DFIL
+INNER JOIN sakila.film_category AS SFCA ON DFIL.film_id = SFCA.film_id
 INNER JOIN sakila.category AS SCAT ON SFCA.category_id = SCAT.category_id;
 
 -- Create Fact Tabel - Rental Transaction
+-- Partitioned by month of rental_date, so date bounded queries only read the partitions of their months
+-- and a month that is not needed anymore is removed by dropping its partition instead of a DELETE.
+-- MySQL does not support foreign keys on partitioned tables, so the keys to the dimension tables are not enforced,
+-- and every unique key has to contain rental_date, the partitioning column
 -- -----------------------------------------------------
 -- Table `sakila_star`.`fact_transaction`
 -- -----------------------------------------------------
@@ -200,38 +299,27 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`fact_transaction` (
     `payment_id` INT(12) NULL DEFAULT NULL,
     `payment_date` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
     `payment_amount` DECIMAL(5,2) NULL DEFAULT NULL,
-    INDEX `fk_customer_idx` (`customer_key` ASC) VISIBLE,
-    INDEX `fk_store_idx` (`store_key` ASC) VISIBLE,
-    INDEX `fk_staff_idx` (`staff_key` ASC) VISIBLE,
-    INDEX `fk_film_idx` (`film_key` ASC) VISIBLE,
-    PRIMARY KEY (`transaction_key`),
-    KEY idx_customer (customer_key),
+    PRIMARY KEY (`transaction_key`, `rental_date`),
+    UNIQUE KEY uq_rental_payment_id (rental_id, payment_id, rental_date),
+    KEY idx_customer_film_amount (customer_key, film_key, payment_amount),
     KEY idx_staff (staff_key),
     KEY idx_film (film_key),
     KEY idx_store (store_key),
-    KEY idx_rental (rental_id),
     KEY idx_inventory (inventory_id),
-    KEY idx_payment (payment_id),
-    CONSTRAINT `fk_customer`
-        FOREIGN KEY (`customer_key`)
-        REFERENCES `sakila_star`.`dim_customer` (`customer_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_staff`
-        FOREIGN KEY (`staff_key`)
-        REFERENCES `sakila_star`.`dim_staff` (`staff_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_store`
-        FOREIGN KEY (`store_key`)
-        REFERENCES `sakila_star`.`dim_store` (`store_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_film`
-        FOREIGN KEY (`film_key`)
-        REFERENCES `sakila_star`.`dim_film` (`film_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION);
+    KEY idx_payment (payment_id))
+PARTITION BY RANGE (TO_DAYS(`rental_date`)) (
+    PARTITION p_history VALUES LESS THAN (TO_DAYS('2005-05-01')),
+    PARTITION p200505 VALUES LESS THAN (TO_DAYS('2005-06-01')),
+    PARTITION p200506 VALUES LESS THAN (TO_DAYS('2005-07-01')),
+    PARTITION p200507 VALUES LESS THAN (TO_DAYS('2005-08-01')),
+    PARTITION p200508 VALUES LESS THAN (TO_DAYS('2005-09-01')),
+    PARTITION p200509 VALUES LESS THAN (TO_DAYS('2005-10-01')),
+    PARTITION p200510 VALUES LESS THAN (TO_DAYS('2005-11-01')),
+    PARTITION p200511 VALUES LESS THAN (TO_DAYS('2005-12-01')),
+    PARTITION p200512 VALUES LESS THAN (TO_DAYS('2006-01-01')),
+    PARTITION p200601 VALUES LESS THAN (TO_DAYS('2006-02-01')),
+    PARTITION p200602 VALUES LESS THAN (TO_DAYS('2006-03-01')),
+    PARTITION p_future VALUES LESS THAN MAXVALUE);
 
 -- Insert data from sakila database to sakila_star database with new architecture
 INSERT INTO sakila_star.fact_transaction(transaction_key,rental_id,rental_last_update,customer_key,
@@ -246,4 +334,34 @@ INNER JOIN sakila_star.dim_staff AS DSTA ON SREN.staff_id = DSTA.staff_id
 INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
 INNER JOIN sakila_star.dim_film AS DFIL ON SINV.film_id = DFIL.film_id
 INNER JOIN sakila_star.dim_store AS DSTO ON SINV.store_id = DSTO.store_id
-INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id;
\ No newline at end of file
+INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id;
+
+-- Create Customer Feature Mart Of The ML Classification
+-- Running sums and counts of the ML features per customer, the averages are the sums divided by transaction_count
+-- The daily airflow load keeps it up to date for the customers that changed
+-- -----------------------------------------------------
+-- Table `sakila_star`.`mart_customer_features`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `sakila_star`.`mart_customer_features` (
+    `customer_key` INT(8) NOT NULL,
+    `customer_active` CHAR(3) NULL DEFAULT NULL,
+    `customer_country` VARCHAR(50) NULL DEFAULT NULL,
+    `transaction_count` INT(12) NOT NULL DEFAULT 0,
+    `sum_payment_amount` DECIMAL(12,2) NULL DEFAULT NULL,
+    `sum_film_duration` BIGINT NULL DEFAULT NULL,
+    `sum_film_rental_rate` DECIMAL(12,2) NULL DEFAULT NULL,
+    `sum_film_replacement_cost` DECIMAL(14,2) NULL DEFAULT NULL,
+    `updated_at` DATETIME NULL DEFAULT NULL,
+    PRIMARY KEY (`customer_key`));
+
+-- Insert the features of every customer
+INSERT INTO sakila_star.mart_customer_features(customer_key, customer_active, customer_country, transaction_count,
+                                               sum_payment_amount, sum_film_duration, sum_film_rental_rate,
+                                               sum_film_replacement_cost, updated_at)
+SELECT FT.customer_key, MAX(DC.customer_active), MAX(DC.customer_country), COUNT(*),
+       SUM(FT.payment_amount), SUM(DF.film_duration), SUM(DF.film_rental_rate),
+       SUM(DF.film_replacement_cost), NOW()
+FROM sakila_star.fact_transaction AS FT
+INNER JOIN sakila_star.dim_customer AS DC ON FT.customer_key = DC.customer_key
+INNER JOIN sakila_star.dim_film AS DF ON FT.film_key = DF.film_key
+GROUP BY FT.customer_key;
@@ -2,19 +2,28 @@
 import airflow
 from airflow import DAG
 from airflow.operators.mysql_operator import MySqlOperator
-from airflow.operators.python_operator import PythonOperator
-from airflow.operators.python_operator import BranchPythonOperator
+from airflow.operators.python_operator import BranchPythonOperator, PythonOperator
 from airflow.providers.mysql.hooks.mysql import MySqlHook
-from airflow.operators.dummy import DummyOperator
-from airflow.utils.dates import days_ago
-from datetime import date, timedelta
-import pandas as pd
+from airflow.exceptions import AirflowException, AirflowSkipException
+from datetime import datetime, timedelta, timezone
+import contextlib
+import functools
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Define default arguments for the DAG
 default_args = {
     'owner': 'admin',
     'depends_on_past': False,
-    'start_date': days_ago(0),  # Start the DAG from yesterday
+    'start_date': datetime(2024, 1, 1),  # A fixed date, so parsing the DAG file does not compute one
     'retries': 3, # Retry 3 times if there is something wrong
     'retry_delay': timedelta(minutes=5), # Retry interval is 5 minutes
 }
@@ -25,11 +34,87 @@ dag = DAG(
     default_args=default_args,
     description='Airflow DAGs to transform Sakila database to new Star Schema',
     schedule_interval=timedelta(days=1),  # Run daily
+    # One run at a time, every run continues from the watermarks the previous one committed
+    max_active_runs=1,
+    # The watermarks pick up every change since the last run, the runs before the first one are not needed
+    catchup=False,
+    # Fact load mode, "single" runs the whole fact upsert as one statement,
+    # "chunked" splits the changed rental_id set into chunks of fact_chunk_size keys
+    # that fact_load_workers connections upsert and commit one by one in parallel,
+    # "keycache" resolves the dimension keys in python and upserts fact_batch_size rows at a time
+    # Load mode, "local" loads with INSERT ... SELECT across the sakila and sakila_star databases of one server,
+    # "transfer" streams the changed rows from SOURCE_CONN_ID to TARGET_CONN_ID in transfer_batch_size batches,
+    # through a named pipe ("pipe") or a gzip spool file in transfer_spool_dir ("file"), into LOAD DATA LOCAL INFILE
+    # Fact partitions, fact_partition_months_ahead monthly partitions are created ahead of data_interval_end,
+    # the months before fact_partition_retention_months are archived or dropped (fact_partition_expire),
+    # a retention of 0 keeps every month
+    # mart_rebuild recomputes the customer feature mart for every customer instead of the changed ones
+    # Alerts, check_load_metrics fails when a load got alert_latency_factor times slower or examines
+    # alert_examined_factor times more rows per affected row than over its last alert_history_runs runs
+    # Execution mode, "tasks" runs one load task per table, "consolidated" runs all loads in one task
+    # over one connection, for small daily deltas, "bootstrap" builds every table from scratch in parallel
+    # resumable ranges of bootstrap_chunk_size source ids over bootstrap_workers connections,
+    # bootstrap_restart empties the star tables and the checkpoints of an earlier bootstrap first
+    # Reconciliation, reconcile turns on the checksum check of sakila_star against sakila in reconcile_chunk_size
+    # natural id ranges, narrowed down to reconcile_leaf_size ids, sleeping reconcile_sleep_factor times every query
+    # Parquet export, parquet_export writes every table to parquet_export_dir after the loads, parquet_batch_size rows
+    # at a time, a fact month is compacted into one file once it has parquet_compact_files files
+    # Change window, every window starts watermark_lookback_seconds before the watermark to pick up late commits,
+    # source_timezone is the time zone of the last_update values of sakila, empty takes the offset of the source server
+    params={
+        'load_mode': 'local',
+        'transfer_spool': 'pipe',
+        'transfer_spool_dir': '/tmp',
+        'transfer_batch_size': 10000,
+        'fact_load_mode': 'single',
+        'fact_chunk_size': 5000,
+        'fact_load_workers': 4,
+        'fact_batch_size': 1000,
+        'fact_partition_months_ahead': 3,
+        'fact_partition_retention_months': 0,
+        'fact_partition_expire': 'archive',
+        'mart_rebuild': False,
+        'alert_history_runs': 7,
+        'alert_latency_factor': 3.0,
+        'alert_examined_factor': 3.0,
+        'alert_min_seconds': 30,
+        'execution_mode': 'tasks',
+        'bootstrap_chunk_size': 5000,
+        'bootstrap_workers': 4,
+        'bootstrap_restart': False,
+        'parquet_export': False,
+        'parquet_export_dir': '/tmp/sakila_star_parquet',
+        'parquet_batch_size': 50000,
+        'parquet_compact_files': 8,
+        'reconcile': False,
+        'reconcile_chunk_size': 10000,
+        'reconcile_leaf_size': 64,
+        'reconcile_sleep_factor': 1.0,
+        'watermark_lookback_seconds': 300,
+        'source_timezone': '',
+    },
 )
 
+# Connection of the sakila source database and of the sakila_star target database
+# Both point at the same MySQL instance by default, which the cross-database INSERT ... SELECT loads need;
+# with the load_mode param set to "transfer" they can point at two different servers
+SOURCE_CONN_ID = "my_sql"
+TARGET_CONN_ID = "my_sql"
+
 # Task 1: Create Database and Table if Not Exist
 # Create new database namely sakila_star in case sakila_star not exist
 # Create 5 table that represent new star scheme if that table not exist, with corresponding type of data and key every table
+# (fact_transaction is partitioned by month of rental_date, without foreign keys which partitioned tables do not support,
+# task maintain_fact_partitions adds the months after the initial ones, rental_date is part of its unique key,
+# so the load deletes the old row of a corrected rental_date before the publish, see task_6_stale_query)
+# (dim_film has one row per film, its categories are in the bridge_film_category table, one row per film and category,
+# so joining the fact table to dim_film does not repeat a rental once per category of its film)
+# and the etl_watermark table that remembers up to which source row every load already ran
+# and the etl_changed_keys table that holds the natural keys every load has to refresh in the current run
+# and one stg_ staging table per star table (LIKE copies the columns and keys but no foreign keys)
+# and the etl_run_log table with the row counts, phase timings, rows examined and query plans of every load
+# and the mart_customer_features table with the running sums and counts of the ML features of every customer
+# and the etl_bootstrap_checkpoint and etl_bootstrap_index tables of a resumable bootstrap (see bootstrap_star_schema)
 task_1_query = """
 CREATE DATABASE IF NOT EXISTS sakila_star;
 CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_customer` (
@@ -52,11 +137,10 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_customer` (
     `customer_location` GEOMETRY NULL DEFAULT NULL,
     `customer_create_date` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
     PRIMARY KEY (`customer_key`),
-    KEY idx_customer_id (customer_id),
+    UNIQUE KEY uq_customer_id (customer_id),
     KEY idx_address_id (customer_address_id),
     KEY idx_city_id (customer_city_id),
-    KEY idx_country_id (customer_country_id),
-    INDEX `customer_id` USING BTREE (`customer_id`) VISIBLE)
+    KEY idx_country_id (customer_country_id))
 AUTO_INCREMENT = 1;
 
 CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_store` (
@@ -74,12 +158,11 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_store` (
     `store_manager_first_name` VARCHAR(45) NULL DEFAULT NULL,
     `store_manager_last_name` VARCHAR(45) NULL DEFAULT NULL,
     PRIMARY KEY (`store_key`),
-    KEY idx_store_id (store_id),
+    UNIQUE KEY uq_store_id (store_id),
     KEY idx_address_id (store_address_id),
     KEY idx_city_id (store_city_id),
     KEY idx_country_id (store_country_id),
-    KEY idx_manager_id (store_manager_staff_id),
-    INDEX `store_id` USING BTREE (`store_id`) VISIBLE);
+    KEY idx_manager_id (store_manager_staff_id));
     
 CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_staff` (
     `staff_key` INT(8) NOT NULL AUTO_INCREMENT,
@@ -101,12 +184,11 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_staff` (
     `staff_store_id` INT(8) NULL DEFAULT NULL,
     `staff_active` CHAR(3) NULL DEFAULT NULL,
     PRIMARY KEY (`staff_key`),
-    KEY idx_staff_id (staff_id),
+    UNIQUE KEY uq_staff_id (staff_id),
     KEY idx_address_id (staff_address_id),
     KEY idx_city_id (staff_city_id),
     KEY idx_country_id (staff_country_id),
-    KEY idx_store_id (staff_store_id),
-    INDEX `staff_id` USING BTREE (`staff_id`) VISIBLE);
+    KEY idx_store_id (staff_store_id));
 
 CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_film` (
     `film_key` INT(8) NOT NULL AUTO_INCREMENT,
@@ -123,13 +205,17 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`dim_film` (
     `film_replacement_cost` DECIMAL(5,2) NULL DEFAULT NULL,
     `film_rating_text` VARCHAR(30) NULL DEFAULT NULL,
     `film_special_features` VARCHAR(64) NULL DEFAULT NULL,
-    `film_category_id` INT(12) NOT NULL,
-    `film_category_name` CHAR(30) NULL DEFAULT NULL,
     PRIMARY KEY (`film_key`),
-    KEY idx_film_id (film_id),
-    KEY idx_language_id (film_language_id),
-    KEY idx_category_id (film_category_id),
-    INDEX `film_id` USING BTREE (`film_id`) VISIBLE);
+    UNIQUE KEY uq_film_id (film_id),
+    KEY idx_language_id (film_language_id));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`bridge_film_category` (
+    `film_key` INT(8) NOT NULL,
+    `category_id` INT(12) NOT NULL,
+    `category_name` CHAR(30) NULL DEFAULT NULL,
+    `last_update` DATETIME NOT NULL,
+    PRIMARY KEY (`film_key`, `category_id`),
+    KEY idx_category_id (category_id));
 
 CREATE TABLE IF NOT EXISTS `sakila_star`.`fact_transaction` (
     `transaction_key` INT(8) NOT NULL AUTO_INCREMENT,
@@ -145,79 +231,1106 @@ CREATE TABLE IF NOT EXISTS `sakila_star`.`fact_transaction` (
     `payment_id` INT(12) NULL DEFAULT NULL,
     `payment_date` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
     `payment_amount` DECIMAL(5,2) NULL DEFAULT NULL,
-    INDEX `fk_customer_idx` (`customer_key` ASC) VISIBLE,
-    INDEX `fk_store_idx` (`store_key` ASC) VISIBLE,
-    INDEX `fk_staff_idx` (`staff_key` ASC) VISIBLE,
-    INDEX `fk_film_idx` (`film_key` ASC) VISIBLE,
-    PRIMARY KEY (`transaction_key`),
-    KEY idx_customer (customer_key),
+    PRIMARY KEY (`transaction_key`, `rental_date`),
+    UNIQUE KEY uq_rental_payment_id (rental_id, payment_id, rental_date),
+    KEY idx_customer_film_amount (customer_key, film_key, payment_amount),
     KEY idx_staff (staff_key),
     KEY idx_film (film_key),
     KEY idx_store (store_key),
-    KEY idx_rental (rental_id),
     KEY idx_inventory (inventory_id),
-    KEY idx_payment (payment_id),
-    CONSTRAINT `fk_customer`
-        FOREIGN KEY (`customer_key`)
-        REFERENCES `sakila_star`.`dim_customer` (`customer_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_staff`
-        FOREIGN KEY (`staff_key`)
-        REFERENCES `sakila_star`.`dim_staff` (`staff_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_store`
-        FOREIGN KEY (`store_key`)
-        REFERENCES `sakila_star`.`dim_store` (`store_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION,
-    CONSTRAINT `fk_film`
-        FOREIGN KEY (`film_key`)
-        REFERENCES `sakila_star`.`dim_film` (`film_key`)
-        ON DELETE CASCADE
-        ON UPDATE NO ACTION);
+    KEY idx_payment (payment_id))
+PARTITION BY RANGE (TO_DAYS(`rental_date`)) (
+    PARTITION p_history VALUES LESS THAN (TO_DAYS('2005-05-01')),
+    PARTITION p200505 VALUES LESS THAN (TO_DAYS('2005-06-01')),
+    PARTITION p200506 VALUES LESS THAN (TO_DAYS('2005-07-01')),
+    PARTITION p200507 VALUES LESS THAN (TO_DAYS('2005-08-01')),
+    PARTITION p200508 VALUES LESS THAN (TO_DAYS('2005-09-01')),
+    PARTITION p200509 VALUES LESS THAN (TO_DAYS('2005-10-01')),
+    PARTITION p200510 VALUES LESS THAN (TO_DAYS('2005-11-01')),
+    PARTITION p200511 VALUES LESS THAN (TO_DAYS('2005-12-01')),
+    PARTITION p200512 VALUES LESS THAN (TO_DAYS('2006-01-01')),
+    PARTITION p200601 VALUES LESS THAN (TO_DAYS('2006-02-01')),
+    PARTITION p200602 VALUES LESS THAN (TO_DAYS('2006-03-01')),
+    PARTITION p_future VALUES LESS THAN MAXVALUE);
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_watermark` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `source_table` VARCHAR(64) NOT NULL,
+    `last_update` DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00',
+    `last_id` INT(12) NOT NULL DEFAULT 0,
+    `updated_at` DATETIME NULL DEFAULT NULL,
+    PRIMARY KEY (`target_table`, `source_table`));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_changed_keys` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `natural_id` INT(12) NOT NULL,
+    PRIMARY KEY (`target_table`, `natural_id`));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`stg_dim_customer` LIKE `sakila_star`.`dim_customer`;
+CREATE TABLE IF NOT EXISTS `sakila_star`.`stg_dim_store` LIKE `sakila_star`.`dim_store`;
+CREATE TABLE IF NOT EXISTS `sakila_star`.`stg_dim_staff` LIKE `sakila_star`.`dim_staff`;
+CREATE TABLE IF NOT EXISTS `sakila_star`.`stg_dim_film` LIKE `sakila_star`.`dim_film`;
+CREATE TABLE IF NOT EXISTS `sakila_star`.`stg_fact_transaction` LIKE `sakila_star`.`fact_transaction`;
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_run_log` (
+    `run_id` VARCHAR(250) NOT NULL,
+    `task_id` VARCHAR(250) NOT NULL,
+    `target_table` VARCHAR(64) NOT NULL,
+    `logged_at` DATETIME NOT NULL,
+    `records` INT(12) NOT NULL DEFAULT 0,
+    `affected` INT(12) NOT NULL DEFAULT 0,
+    `inserted` INT(12) NOT NULL DEFAULT 0,
+    `updated` INT(12) NOT NULL DEFAULT 0,
+    `rows_examined` BIGINT NOT NULL DEFAULT 0,
+    `duration_seconds` DECIMAL(12,3) NOT NULL DEFAULT 0,
+    `phases` JSON NULL DEFAULT NULL,
+    `plans` JSON NULL DEFAULT NULL,
+    PRIMARY KEY (`run_id`, `task_id`),
+    KEY idx_task_logged (task_id, logged_at));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`mart_customer_features` (
+    `customer_key` INT(8) NOT NULL,
+    `customer_active` CHAR(3) NULL DEFAULT NULL,
+    `customer_country` VARCHAR(50) NULL DEFAULT NULL,
+    `transaction_count` INT(12) NOT NULL DEFAULT 0,
+    `sum_payment_amount` DECIMAL(12,2) NULL DEFAULT NULL,
+    `sum_film_duration` BIGINT NULL DEFAULT NULL,
+    `sum_film_rental_rate` DECIMAL(12,2) NULL DEFAULT NULL,
+    `sum_film_replacement_cost` DECIMAL(14,2) NULL DEFAULT NULL,
+    `updated_at` DATETIME NULL DEFAULT NULL,
+    PRIMARY KEY (`customer_key`));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_bootstrap_checkpoint` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `chunk_lo` INT(12) NOT NULL,
+    `chunk_hi` INT(12) NOT NULL,
+    `records` INT(12) NOT NULL DEFAULT 0,
+    `finished_at` DATETIME NOT NULL,
+    PRIMARY KEY (`target_table`, `chunk_lo`));
+
+CREATE TABLE IF NOT EXISTS `sakila_star`.`etl_bootstrap_index` (
+    `target_table` VARCHAR(64) NOT NULL,
+    `index_name` VARCHAR(64) NOT NULL,
+    `index_columns` VARCHAR(512) NOT NULL,
+    PRIMARY KEY (`target_table`, `index_name`));
 """
 
 # Using MySqlOperator to run MySql query
 mysql_task_1 = MySqlOperator(
     task_id="create_table",
     sql=task_1_query,
-    mysql_conn_id="my_sql",
+    mysql_conn_id=TARGET_CONN_ID,
+    dag=dag
+)
+
+# Task 1b: Make sure every source table that the daily load filters on last_update has an index on that column
+# MySQL has no CREATE INDEX IF NOT EXISTS, so look at information_schema first and only create the missing ones
+# The tables are the change sources of the load specs, see LOAD_SPECS
+def ensure_last_update_index():
+    mysql_hook = MySqlHook(mysql_conn_id=SOURCE_CONN_ID)
+    for table in sorted(set(source['source'] for spec in LOAD_SPECS for source in spec['sources'])):
+        query = """
+        SELECT COUNT(*)
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = 'sakila' AND TABLE_NAME = %s
+        AND COLUMN_NAME = 'last_update' AND SEQ_IN_INDEX = 1
+        """
+        result = mysql_hook.get_first(query, parameters=(table,))
+        if result[0] == 0:
+            mysql_hook.run("CREATE INDEX idx_last_update ON sakila.{table} (last_update)".format(table=table))
+
+mysql_task_1_ensure_index = PythonOperator(
+    task_id="ensure_last_update_index",
+    python_callable=ensure_last_update_index,
     dag=dag
 )
 
-# Task 2: Insert New Yesterday Data From Sakila Database to Sakila_Star Database Dimension Customer Table
-# Specify Yesterday
-yesterday = date.today() - timedelta(days=1)
-#str_yesterday = str('2006-02-15')
-str_yesterday = str(yesterday)
+# Task 1c: Maintain the monthly partitions of the fact table
+# Every month has a partition pYYYYMM holding the rental_date values before the first day of the next month,
+# p_history takes the rental_date values before the first month and p_future (VALUES LESS THAN MAXVALUE) any later
+# rental_date. The task splits the next fact_partition_months_ahead months out of p_future before their rows arrive,
+# so the split only moves an empty partition. A month before data_interval_end only gets its own partition when
+# p_future has rows of it, the empty months in between are folded into the next partition, so a table whose last
+# month partition is long ago is not split into one empty partition for every month since.
+# With fact_partition_retention_months above 0 the months older than that are removed in O(1), and p_history with
+# them once the first month is removed:
+# "archive" exchanges the partition with the table fact_transaction_<partition> and drops the now empty partition,
+# "drop" drops the partition with its rows. Rows of a removed month that change later land in the next partition
+PARTITION_MONTH_PATTERN = re.compile(r'^p(\d{4})(\d{2})$')
+
+def add_months(year, month, months):
+    index = year * 12 + month - 1 + months
+    return index // 12, index % 12 + 1
+
+def month_partition(year, month):
+    next_year, next_month = add_months(year, month, 1)
+    return "PARTITION p{year:04d}{month:02d} VALUES LESS THAN (TO_DAYS('{next_year:04d}-{next_month:02d}-01'))".format(
+        year=year, month=month, next_year=next_year, next_month=next_month)
+
+# Months that get a partition: the months p_future has rows of and every month from data_interval_end
+# (or from the month after the last partition, when that is later) up to last_month
+def new_partition_months(months, row_months, current_month, last_month):
+    month = max(add_months(*max(months), 1), current_month) if months else current_month
+    new_months = set(row_months)
+    while month <= last_month:
+        new_months.add(month)
+        month = add_months(*month, 1)
+    return sorted(new_months)
+
+# Archive or drop one partition of the fact table
+def expire_partition(mysql_hook, partition, expire):
+    if expire == 'archive':
+        archive = "sakila_star.fact_transaction_{partition}".format(partition=partition)
+        exists = mysql_hook.get_first("""
+        SELECT COUNT(*)
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = 'sakila_star' AND TABLE_NAME = %s
+        """, parameters=('fact_transaction_' + partition,))
+        if exists[0] == 0:
+            mysql_hook.run("CREATE TABLE {archive} LIKE sakila_star.fact_transaction".format(archive=archive))
+            mysql_hook.run("ALTER TABLE {archive} REMOVE PARTITIONING".format(archive=archive))
+        # A filled archive table means an earlier run already exchanged the partition, exchanging again would swap it back
+        if mysql_hook.get_first("SELECT 1 FROM {archive} LIMIT 1".format(archive=archive)) is None:
+            mysql_hook.run("ALTER TABLE sakila_star.fact_transaction EXCHANGE PARTITION {partition} WITH TABLE {archive}"
+                           .format(partition=partition, archive=archive))
+    mysql_hook.run("ALTER TABLE sakila_star.fact_transaction DROP PARTITION {partition}".format(partition=partition))
+    logging.info("fact_transaction: removed partition %s (%s)", partition, expire)
+
+def maintain_fact_partitions(data_interval_end, params, **context):
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    query = """
+    SELECT PARTITION_NAME
+    FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = 'sakila_star' AND TABLE_NAME = 'fact_transaction' AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+    """
+    names = [row[0] for row in mysql_hook.get_records(query)]
+    if 'p_future' not in names:
+        logging.warning("sakila_star.fact_transaction is not partitioned by month, run "
+                        "Script-Migrate-Sakila-Star-Partition-Fact.sql first")
+        return
+    months = [(int(match.group(1)), int(match.group(2)))
+              for match in map(PARTITION_MONTH_PATTERN.match, names) if match]
+
+    # Split the missing months up to fact_partition_months_ahead out of p_future
+    current_month = (data_interval_end.year, data_interval_end.month)
+    last_month = add_months(*current_month, int(params['fact_partition_months_ahead']))
+    rows_query = """
+    SELECT DISTINCT YEAR(rental_date), MONTH(rental_date)
+    FROM sakila_star.fact_transaction PARTITION (p_future)
+    WHERE rental_date < %s
+    """
+    row_months = [(int(year), int(month)) for year, month in mysql_hook.get_records(
+        rows_query, parameters=('{0:04d}-{1:02d}-01'.format(*add_months(*last_month, 1)),))]
+    new_months = new_partition_months(months, row_months, current_month, last_month)
+    if new_months:
+        mysql_hook.run("""
+        ALTER TABLE sakila_star.fact_transaction REORGANIZE PARTITION p_future INTO (
+            {partitions},
+            PARTITION p_future VALUES LESS THAN MAXVALUE)
+        """.format(partitions=",\n            ".join(month_partition(*month) for month in new_months)))
+        logging.info("fact_transaction: added %d partitions up to p%04d%02d", len(new_months), *new_months[-1])
+
+    # Remove the months before the retention period, p_history is older than every month
+    retention = int(params['fact_partition_retention_months'])
+    if retention <= 0:
+        return
+    first_kept = add_months(*current_month, -retention)
+    months = sorted(months + new_months)
+    if 'p_history' in names and months and months[0] < first_kept:
+        expire_partition(mysql_hook, 'p_history', params['fact_partition_expire'])
+    for year, month in months:
+        if (year, month) < first_kept:
+            expire_partition(mysql_hook, "p{year:04d}{month:02d}".format(year=year, month=month),
+                             params['fact_partition_expire'])
+
+mysql_task_1_maintain_partitions = PythonOperator(
+    task_id="maintain_fact_partitions",
+    python_callable=maintain_fact_partitions,
+    dag=dag
+)
+
+# Task 2: Insert New Data Since The Last Load From Sakila Database to Sakila_Star Database Dimension Customer Table
+# Specify change window of the run
+# Every load keeps a high watermark in sakila_star.etl_watermark, the highest (last_update, id) of its source table
+# that is already loaded. The window starts strictly after the watermark and ends at data_interval_end of the run,
+# so a skipped run or a late row is picked up by the next run without a full rebuild, whatever the gap
+DEFAULT_WATERMARK = ('1970-01-01 00:00:00', 0)
+
+# End of the change window in the time zone of the last_update values of sakila
+# data_interval_end is in UTC, sakila's last_update is a TIMESTAMP read in the session time zone of the source server,
+# so the end is moved to the source_timezone param or, when it is empty, by the UTC offset the source server reports.
+# A naive end (the benchmark passes NOW() of the server) is already in the time zone of the server
+def window_end(cursor, data_interval_end, params):
+    if data_interval_end.tzinfo is None:
+        end = data_interval_end
+    elif params['source_timezone']:
+        import pendulum
+        end = data_interval_end.astimezone(pendulum.timezone(params['source_timezone'])).replace(tzinfo=None)
+    else:
+        cursor.execute("SELECT TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW())")
+        offset = cursor.fetchone()[0]
+        end = data_interval_end.astimezone(timezone.utc).replace(tzinfo=None) + timedelta(seconds=int(offset))
+    return end.strftime('%Y-%m-%d %H:%M:%S')
+
+# Change window of one source table, from its watermark to end
+# A transaction that commits after a run has read the window can carry a last_update older than the watermark that
+# run moved to, so the window starts lookback_seconds before the watermark and those rows are read again by the next
+# run (the upserts are idempotent and unchanged rows count as neither inserted nor updated). The overlap takes every
+# row from its start on, the ids are positive so an id of -1 does not exclude any row at that last_update
+def change_window(watermark, end, lookback_seconds):
+    if lookback_seconds <= 0 or watermark == DEFAULT_WATERMARK:
+        return {'wm_update': watermark[0], 'wm_id': watermark[1], 'end': end}
+    start = datetime.strptime(watermark[0], '%Y-%m-%d %H:%M:%S') - timedelta(seconds=lookback_seconds)
+    return {'wm_update': start.strftime('%Y-%m-%d %H:%M:%S'), 'wm_id': -1, 'end': end}
+
+# Next watermark of a source table, the high mark of the window never moves it back,
+# the overlap of the window can end below the watermark when no newer row came in
+def next_watermark(watermark, high_mark):
+    if high_mark is None:
+        return None
+    return max(watermark, high_mark)
 
-# Insert new data from sakila databases to sakila_star based on yesterday last update
-# Using Insert Into from original database that already querying for data that update yesterday to input new data (or updated data) to sakila_star
-# Using WHERE DATE(SCUS.last_update) = '{ysd}' to refer yesterday, and
-# that means this airflow dags can run daily without burden of transforming all data in old database
+# Build the WHERE condition of the change window for one source table alias and its id column
+# (last_update, id) > watermark is written as an OR so MySQL can range scan the last_update index
+def change_predicate(alias, id_column):
+    return """({alias}.last_update > %(wm_update)s
+       OR ({alias}.last_update = %(wm_update)s AND {alias}.{id} > %(wm_id)s))
+   AND {alias}.last_update < %(end)s""".format(alias=alias, id=id_column)
+
+# Read the watermark of one target and source table, locked until the load commits
+# so two runs of the same load can not move it at the same time
+def read_watermark(cursor, table, source):
+    cursor.execute("""
+    SELECT last_update, last_id
+    FROM sakila_star.etl_watermark
+    WHERE target_table = %s AND source_table = %s
+    FOR UPDATE
+    """, (table, source))
+    result = cursor.fetchone()
+    if result is None:
+        return DEFAULT_WATERMARK
+    return (result[0].strftime('%Y-%m-%d %H:%M:%S'), result[1])
+
+# Highest (last_update, id) of the source table inside the change window, it becomes the next watermark
+def read_high_mark(cursor, source, id_column, window):
+    cursor.execute("""
+    SELECT SRC.last_update, SRC.{id}
+    FROM sakila.{source} AS SRC
+    WHERE {predicate}
+    ORDER BY SRC.last_update DESC, SRC.{id} DESC
+    LIMIT 1
+    """.format(id=id_column, source=source, predicate=change_predicate('SRC', id_column)), window)
+    result = cursor.fetchone()
+    if result is None:
+        return None
+    return (result[0].strftime('%Y-%m-%d %H:%M:%S'), result[1])
+
+def write_watermark(cursor, table, source, watermark):
+    cursor.execute("""
+    INSERT INTO sakila_star.etl_watermark(target_table, source_table, last_update, last_id, updated_at)
+    VALUES (%s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE
+        last_update = VALUES(last_update),
+        last_id = VALUES(last_id),
+        updated_at = VALUES(updated_at)
+    """, (table, source, watermark[0], watermark[1]))
+
+# Read one counter out of the connection info string, e.g. "Records: 3  Duplicates: 1  Warnings: 0"
+def parse_info_counter(info, name):
+    match = re.search(name + r': (\d+)', info or '')
+    return int(match.group(1)) if match else 0
+
+# Run one upsert query once and report how many rows it touched
+# For INSERT ... SELECT ... ON DUPLICATE KEY UPDATE MySQL counts 1 affected row for every inserted row,
+# 2 for every updated row and 0 for a row that was already up to date,
+# and the connection info tells how many rows the SELECT produced and how many of them hit an existing key
+def run_upsert(conn, cursor, query, parameters):
+    cursor.execute(query, parameters)
+    return upsert_counts(conn, cursor)
+
+# Counts of the statement result the cursor is at
+def upsert_counts(conn, cursor):
+    affected = cursor.rowcount
+    info = conn.info()
+    records = parse_info_counter(info, 'Records')
+    duplicates = parse_info_counter(info, 'Duplicates')
+    inserted = records - duplicates
+    updated = (affected - inserted) // 2
+    return {
+        'records': records,
+        'affected': affected,
+        'inserted': inserted,
+        'updated': updated,
+        'unchanged': duplicates - updated,
+    }
+
+# Join queries into one multi-statement batch, without the trailing ; of any of them,
+# which would leave an empty statement in the batch that MySQL rejects (ER_EMPTY_QUERY)
+def batch_query(queries):
+    statements = [query.strip().rstrip(';').strip() for query in queries]
+    if not all(statements):
+        raise ValueError('Empty statement in a multi-statement batch')
+    return ";\n".join(statements)
+
+# Run several upsert queries without parameters as one multi-statement round trip
+# and report the counts of every one of them, in order
+def run_upsert_batch(conn, cursor, queries):
+    cursor.execute(batch_query(queries))
+    results = [upsert_counts(conn, cursor)]
+    while cursor.nextset():
+        results.append(upsert_counts(conn, cursor))
+    return results
+
+# A change source is one sakila table whose changed rows make some rows of the target table stale,
+# e.g. a changed sakila.city row makes every dim_customer row of a customer living in that city stale.
+# keys_query maps the changed rows of the source (alias SRC, filtered by {window}) to the natural ids of the target,
+# it is rendered when a load runs (see render_load), not when the DAG file is parsed
+def change_source(source, id_column, keys_query):
+    return {
+        'source': source,
+        'id_column': id_column,
+        'keys_template': keys_query,
+    }
+
+# Collect the natural ids one change source made stale into etl_changed_keys
+def collect_changed_keys(cursor, table, source, window):
+    cursor.execute("""
+    INSERT IGNORE INTO sakila_star.etl_changed_keys(target_table, natural_id)
+    SELECT %(table)s, CHANGED.natural_id
+    FROM ({keys_query}) AS CHANGED
+    """.format(keys_query=source['keys_query']), dict(window, table=table))
+    return cursor.rowcount
+
+# Read the watermark of every change source, collect the natural ids they made stale
+# and return the high mark every source moves to once the load is done
+def collect_changes(cursor, table, sources, data_interval_end, params):
+    cursor.execute("DELETE FROM sakila_star.etl_changed_keys WHERE target_table = %s", (table,))
+    end = window_end(cursor, data_interval_end, params)
+    high_marks = {}
+    changed_keys = {}
+    for source in sources:
+        watermark = read_watermark(cursor, table, source['source'])
+        window = change_window(watermark, end, int(params['watermark_lookback_seconds']))
+        high_marks[source['source']] = next_watermark(
+            watermark, read_high_mark(cursor, source['source'], source['id_column'], window))
+        if high_marks[source['source']] is not None:
+            changed_keys[source['source']] = collect_changed_keys(cursor, table, source, window)
+    return high_marks, changed_keys
+
+def write_watermarks(cursor, table, high_marks):
+    for source, high_mark in high_marks.items():
+        if high_mark is not None:
+            write_watermark(cursor, table, source, high_mark)
+
+# Every load query may be limited to a natural key range, the whole range by default
+FULL_KEY_RANGE = {'chunk_lo': 0, 'chunk_hi': 2147483647}
+NO_RECORDS = {'records': 0, 'affected': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+# Load instrumentation
+# Every load times its phases: probe (finding the changed keys), extract (building the rows in staging),
+# load (publishing them into the live table and moving the watermarks) and commit.
+# Rows examined is the growth of the Handler_read_* session counters over the load, on every connection
+# the load used, so rows examined per affected row shows when a statement stopped using its index.
+# EXPLAIN FORMAT=JSON of the build and publish statements is taken right before they run,
+# against the same change set. Everything goes to XCom (load_metrics) and sakila_star.etl_run_log
+def handler_reads(cursor):
+    cursor.execute("SHOW SESSION STATUS LIKE 'Handler_read%'")
+    return sum(int(value) for _, value in cursor.fetchall())
+
+def start_metrics(cursor):
+    return {'started': time.time(), 'phases': {}, 'plans': {}, 'rows_examined': 0,
+            'reads_start': handler_reads(cursor)}
+
+@contextlib.contextmanager
+def timed_phase(metrics, phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics['phases'][phase] = metrics['phases'].get(phase, 0) + time.time() - start
+
+# A plan that can not be explained is recorded with its error, it never fails the load
+def explain_statement(cursor, metrics, name, query, parameters):
+    try:
+        cursor.execute("EXPLAIN FORMAT=JSON " + query, parameters)
+        metrics['plans'][name] = json.loads(cursor.fetchone()[0])
+    except Exception as error:
+        metrics['plans'][name] = {'error': str(error)}
+
+# Close the metrics of a load, rows examined on other connections (chunks, streams) are passed in as extra_reads
+def end_metrics(cursor, metrics, extra_reads=0):
+    metrics['rows_examined'] = handler_reads(cursor) - metrics.pop('reads_start') + extra_reads
+    metrics['duration_seconds'] = time.time() - metrics.pop('started')
+    return metrics
+
+# Write the counts and metrics of a load into etl_run_log, a retry of the task overwrites its row
+def write_run_log(cursor, run_id, task_id, table, counts, metrics):
+    cursor.execute("""
+    INSERT INTO sakila_star.etl_run_log(run_id, task_id, target_table, logged_at, records, affected, inserted, updated,
+                                        rows_examined, duration_seconds, phases, plans)
+    VALUES (%s, %s, %s, NOW(), %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        logged_at = VALUES(logged_at),
+        records = VALUES(records),
+        affected = VALUES(affected),
+        inserted = VALUES(inserted),
+        updated = VALUES(updated),
+        rows_examined = VALUES(rows_examined),
+        duration_seconds = VALUES(duration_seconds),
+        phases = VALUES(phases),
+        plans = VALUES(plans)
+    """, (run_id, task_id, table, counts['records'], counts['affected'], counts['inserted'], counts['updated'],
+          metrics['rows_examined'], metrics['duration_seconds'], json.dumps(metrics['phases']),
+          json.dumps(metrics['plans'])))
+
+# Close the metrics, time the commit and write the run log in its own short transaction after it
+def commit_load(conn, cursor, metrics, run_id, task_id, table, counts, extra_reads=0):
+    with timed_phase(metrics, 'commit'):
+        conn.commit()
+    end_metrics(cursor, metrics, extra_reads)
+    write_run_log(cursor, run_id, task_id, table, counts, metrics)
+    conn.commit()
+
+# Push the counts and metrics of a load to XCom, a load that inserted or updated no row ends as skipped
+# (the overlap of the change window reads rows that are already loaded, they come out unchanged)
+def finish_load(table, counts, changed_keys, ti, metrics):
+    counts['changed_keys'] = changed_keys
+    ti.xcom_push(key='load_counts', value=counts)
+    ti.xcom_push(key='load_metrics', value={
+        'phases': metrics['phases'],
+        'rows_examined': metrics['rows_examined'],
+        'duration_seconds': metrics['duration_seconds'],
+        'rows_examined_per_affected': metrics['rows_examined'] / max(counts['affected'], 1),
+        'plans': metrics['plans'],
+    })
+    logging.info('%s: %s in %.2fs %s, %d rows examined', table, counts, metrics['duration_seconds'],
+                 metrics['phases'], metrics['rows_examined'])
+    if counts['affected'] == 0:
+        raise AirflowSkipException('No changed records for {table} in the change window'.format(table=table))
+    return counts
+
+# Empty the staging table of a star table before its rows of this run are built in it
+# (TRUNCATE is DDL and commits, so it runs before the load transaction starts)
+def truncate_staging(cursor, table):
+    cursor.execute("TRUNCATE TABLE sakila_star.stg_{table}".format(table=table))
+
+# Define function to load one table for the change window
+# Every change source of the table moves its own watermark, the natural ids they made stale are collected
+# in etl_changed_keys and only those rows are upserted, so a change in a lookup table (address, city, country, ...)
+# refreshes just the dimension rows that copy its columns, without a full reload.
+# The heavy join query builds the rows in the stg_ staging table, then the publish query merges them into the live
+# table in one short statement right before the commit, so readers never see half of a load and only wait for
+# the live rows for the length of that merge. A failed load leaves the live table untouched.
+# The build runs once (no separate COUNT(*) probe doing the same join again) and the watermarks are moved
+# in the same transaction as the publish, so either both the rows and the new watermarks are committed or neither is.
+# The before_publish queries (the stale fact rows) run right before the publish and the after_publish queries
+# (the bridge rows of dim_film) right after it, in its transaction.
+# The keys stay in etl_changed_keys until the next load of the table, for the stages that run after it.
+# The counts go to XCom and a run that inserted or updated no row ends as skipped.
+# With load_mode "transfer" the table is copied from the source server instead, see transfer_table
+# The task only gets the table name, its queries are rendered from its load spec here (see render_load)
+def load_table(table, data_interval_end, params, ti, run_id, **context):
+    load = render_load(table)
+    if params['load_mode'] == 'transfer':
+        return transfer_table(table, load['sources'], load['transfer'], data_interval_end, params, ti, run_id)
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    conn = mysql_hook.get_conn()
+    try:
+        cursor = conn.cursor()
+        # READ COMMITTED, so the loads of the other tables that run in parallel are not blocked by gap locks
+        # on etl_changed_keys and the source tables are read without locking them
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        metrics = start_metrics(cursor)
+        with timed_phase(metrics, 'probe'):
+            truncate_staging(cursor, table)
+            high_marks, changed_keys = collect_changes(cursor, table, load['sources'], data_interval_end, params)
+        counts = dict(NO_RECORDS)
+        if changed_keys:
+            explain_statement(cursor, metrics, 'extract', load['query'], FULL_KEY_RANGE)
+            with timed_phase(metrics, 'extract'):
+                counts['staged'] = run_upsert(conn, cursor, load['query'], FULL_KEY_RANGE)['records']
+            explain_statement(cursor, metrics, 'load', load['publish_query'], None)
+        with timed_phase(metrics, 'load'):
+            if changed_keys:
+                for before_query in load['before_publish']:
+                    cursor.execute(before_query, FULL_KEY_RANGE)
+                counts.update(run_upsert(conn, cursor, load['publish_query'], None))
+                for after_query in load['after_publish']:
+                    cursor.execute(after_query)
+            write_watermarks(cursor, table, high_marks)
+        commit_load(conn, cursor, metrics, run_id, ti.task_id, table, counts)
+        cursor.close()
+    finally:
+        conn.close()
+    return finish_load(table, counts, changed_keys, ti, metrics)
+
+# Split the sorted changed natural ids of a table into (first id, last id) ranges of chunk_size keys
+def changed_key_ranges(cursor, table, chunk_size):
+    cursor.execute("""
+    SELECT natural_id
+    FROM sakila_star.etl_changed_keys
+    WHERE target_table = %s
+    ORDER BY natural_id
+    """, (table,))
+    keys = [row[0] for row in cursor.fetchall()]
+    return [(keys[i], keys[min(i + chunk_size, len(keys)) - 1]) for i in range(0, len(keys), chunk_size)]
+
+# Build one key range in the staging table in its own short transaction, over its own connection
+# The upsert is idempotent, so a chunk that hit a deadlock or a lost connection is simply run again.
+# Every attempt opens a new connection inside the retry, so a connect that fails is retried as well,
+# and the rollback and close of a connection that is already lost do not hide the error of the attempt
+FACT_CHUNK_ATTEMPTS = 3
+
+def load_chunk(query, key_range):
+    for attempt in range(1, FACT_CHUNK_ATTEMPTS + 1):
+        conn = None
+        try:
+            conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+            cursor = conn.cursor()
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            reads = handler_reads(cursor)
+            counts = run_upsert(conn, cursor, query, {'chunk_lo': key_range[0], 'chunk_hi': key_range[1]})
+            counts['rows_examined'] = handler_reads(cursor) - reads
+            conn.commit()
+            cursor.close()
+            return counts
+        except Exception:
+            if conn is not None:
+                with contextlib.suppress(Exception):
+                    conn.rollback()
+            if attempt == FACT_CHUNK_ATTEMPTS:
+                raise
+            logging.warning('chunk %s: attempt %d failed, retrying', key_range, attempt, exc_info=True)
+            time.sleep(attempt * 5)
+        finally:
+            if conn is not None:
+                with contextlib.suppress(Exception):
+                    conn.close()
+
+# Build every changed key range in parallel over a bounded pool of connections
+def load_key_ranges(cursor, query, table, params):
+    key_ranges = changed_key_ranges(cursor, table, int(params['fact_chunk_size']))
+    counts = dict(NO_RECORDS, rows_examined=0)
+    with ThreadPoolExecutor(max_workers=int(params['fact_load_workers'])) as executor:
+        for chunk_counts in executor.map(lambda key_range: load_chunk(query, key_range), key_ranges):
+            for name in counts:
+                counts[name] += chunk_counts[name]
+    counts['chunks'] = len(key_ranges)
+    return counts
+
+KEY_CACHE_DIR = '/tmp/sakila_star_key_cache'
+
+# Load the key map of one dimension as an array indexed by natural id, 0 where the id has no row
+# The map is kept on the worker disk and only read again from MySQL when the dimension load of this run inserted rows
+# or when the fingerprint of the dimension moved since the map was saved. The fingerprint is the row count,
+# the highest surrogate key and the BIT_XOR of the CRC32 of every (natural id, key) pair, so a reload that gives
+# the same ids other keys with the same highest key (a bootstrap_restart truncate, the dedupe or bridge migrations)
+# is caught too, not only rows inserted outside this DAG. It is one scan of the unique natural id index
+def load_key_map(cursor, dimension, id_column, key_column, inserted):
+    import numpy as np
+    cursor.execute("""
+    SELECT COUNT(*), COALESCE(MAX({key}), 0), COALESCE(BIT_XOR(CRC32(CONCAT_WS(',', {id}, {key}))), 0)
+    FROM sakila_star.{dimension}
+    """.format(id=id_column, key=key_column, dimension=dimension))
+    fingerprint = np.array(cursor.fetchone(), dtype=np.int64)
+    path = os.path.join(KEY_CACHE_DIR, dimension + '.npz')
+    if not inserted and os.path.exists(path):
+        cached = np.load(path)
+        if 'fingerprint' in cached and np.array_equal(cached['fingerprint'], fingerprint):
+            return cached['key_map']
+    cursor.execute("""
+    SELECT {id}, {key}
+    FROM sakila_star.{dimension}
+    WHERE {id} IS NOT NULL
+    """.format(id=id_column, key=key_column, dimension=dimension))
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    # A natural id that still has more than one row keeps the newest one, the highest surrogate key:
+    # the rows are sorted by natural id then key and only the last row of every natural id is kept,
+    # so every index of the assignment below is unique
+    rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+    rows = rows[np.append(rows[1:, 0] != rows[:-1, 0], True)] if len(rows) else rows
+    key_map = np.zeros(int(rows[:, 0].max()) + 1 if len(rows) else 1, dtype=np.int64)
+    key_map[rows[:, 0]] = rows[:, 1]
+    os.makedirs(KEY_CACHE_DIR, exist_ok=True)
+    np.savez(path, key_map=key_map, fingerprint=fingerprint)
+    return key_map
+
+# Resolve a batch of natural ids to surrogate keys in one vectorized lookup, 0 for the ids that are not found
+def resolve_keys(key_map, natural_ids):
+    import numpy as np
+    ids = np.asarray(natural_ids, dtype=np.int64)
+    found = (ids >= 0) & (ids < len(key_map))
+    keys = np.zeros(len(ids), dtype=np.int64)
+    keys[found] = key_map[ids[found]]
+    return keys
+
+# Changed rentals with their payment and the natural ids of the four dimensions, no sakila_star dimension join
+fact_extract_query = """
+SELECT SREN.rental_id, SREN.last_update, SREN.customer_id, SREN.staff_id, SINV.film_id, SINV.store_id,
+SREN.inventory_id, SREN.rental_date, SREN.return_date, SPAY.payment_id, SPAY.payment_date, SPAY.amount
+FROM sakila_star.etl_changed_keys AS CHG
+INNER JOIN sakila.rental AS SREN ON SREN.rental_id = CHG.natural_id
+INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
+INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id
+WHERE CHG.target_table = 'fact_transaction'"""
+
+# Multi-row upsert of resolved fact rows into the staging table, {values} is one placeholder group per row
+fact_insert_query = """
+INSERT INTO sakila_star.stg_fact_transaction(rental_id,rental_last_update,customer_key,
+                                 staff_key,film_key,store_key,inventory_id,rental_date,return_date,
+                                 payment_id,payment_date,payment_amount)
+VALUES {values}
+ON DUPLICATE KEY UPDATE
+    rental_last_update = VALUES(rental_last_update),
+    customer_key = VALUES(customer_key),
+    staff_key = VALUES(staff_key),
+    film_key = VALUES(film_key),
+    store_key = VALUES(store_key),
+    inventory_id = VALUES(inventory_id),
+    rental_date = VALUES(rental_date),
+    return_date = VALUES(return_date),
+    payment_date = VALUES(payment_date),
+    payment_amount = VALUES(payment_amount)"""
+FACT_ROW_PLACEHOLDERS = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+# Upsert one batch of resolved fact rows as one multi-row statement and return its counts
+# The statement is built here instead of with executemany: MySQLdb splits an executemany into several statements
+# once it passes max_stmt_length and conn.info() only describes the last of them, which made the counts wrong
+def upsert_fact_rows(conn, cursor, rows):
+    query = fact_insert_query.format(values=', '.join([FACT_ROW_PLACEHOLDERS] * len(rows)))
+    return run_upsert(conn, cursor, query, [value for row in rows for value in row])
+
+# Stream the changed rentals through a server side cursor, resolve their surrogate keys in python
+# batch by batch and write the facts with batched multi-row upserts
+# Rows whose keys can not be resolved are reported in the counts instead of silently dropped by an INNER JOIN
+def load_facts_with_key_cache(conn, cursor, params, ti):
+    import MySQLdb.cursors
+    key_maps = []
+    for dimension, id_column, key_column, task_id in FACT_DIMENSIONS:
+        dimension_counts = ti.xcom_pull(task_ids=task_id, key='load_counts')
+        inserted = dimension_counts is None or dimension_counts['inserted'] > 0
+        key_maps.append(load_key_map(cursor, dimension, id_column, key_column, inserted))
+    counts = dict(NO_RECORDS)
+    unresolved = {dimension: 0 for dimension, _, _, _ in FACT_DIMENSIONS}
+    unresolved_rentals = []
+    batch_size = int(params['fact_batch_size'])
+    stream_conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+    try:
+        reads_cursor = stream_conn.cursor()
+        reads = handler_reads(reads_cursor)
+        stream_cursor = stream_conn.cursor(MySQLdb.cursors.SSCursor)
+        stream_cursor.execute(fact_extract_query)
+        while True:
+            batch = stream_cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            columns = list(zip(*batch))
+            # Natural ids are columns 2 - 5 (customer, staff, film, store), in the order of FACT_DIMENSIONS
+            keys = [resolve_keys(key_map, columns[2 + i]) for i, key_map in enumerate(key_maps)]
+            rows = []
+            for i, row in enumerate(batch):
+                row_keys = [int(dimension_keys[i]) for dimension_keys in keys]
+                if 0 in row_keys:
+                    for dimension_index, key in enumerate(row_keys):
+                        if key == 0:
+                            unresolved[FACT_DIMENSIONS[dimension_index][0]] += 1
+                    if len(unresolved_rentals) < 100:
+                        unresolved_rentals.append(row[0])
+                    continue
+                rows.append((row[0], row[1], row_keys[0], row_keys[1], row_keys[2], row_keys[3]) + tuple(row[6:]))
+            if rows:
+                batch_counts = upsert_fact_rows(conn, cursor, rows)
+                for name in NO_RECORDS:
+                    counts[name] += batch_counts[name]
+        stream_cursor.close()
+        counts['rows_examined'] = handler_reads(reads_cursor) - reads
+        reads_cursor.close()
+    finally:
+        stream_conn.close()
+    counts['unresolved'] = unresolved
+    counts['unresolved_rentals'] = unresolved_rentals
+    if unresolved_rentals:
+        logging.warning('Fact rows without a dimension key, per dimension %s, first rental ids %s',
+                        unresolved, unresolved_rentals)
+    return counts
+
+# Define function to load the fact table
+# "single" runs the fact upsert as one statement like the dimension loads.
+# In "chunked" mode the changed rental_id set is collected and committed first, then split into key ranges
+# that a bounded pool of workers upserts in parallel, each range committing on its own, so no statement holds locks
+# on the dimension tables or fills the undo log and the binlog for the whole change set.
+# In "keycache" mode the surrogate keys are resolved in python from cached dimension key maps,
+# so MySQL only reads the changed rentals and payments instead of joining them with four dimension tables.
+# The heavy build runs in the staging table, where the chunks may commit on their own since no reader looks there.
+# The publish into the live fact table then runs in rental_id ranges of fact_chunk_size changed keys, one bounded
+# statement per range, but all of them and the new watermarks in one transaction, so readers never see a partly
+# published change set and a failed publish leaves the live table untouched (the next run publishes it again)
+def load_fact_table(table, data_interval_end, params, ti, run_id, **context):
+    if params['load_mode'] == 'transfer' or params['fact_load_mode'] == 'single':
+        return load_table(table, data_interval_end, params, ti, run_id, **context)
+    load = render_load(table)
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    conn = mysql_hook.get_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        metrics = start_metrics(cursor)
+        with timed_phase(metrics, 'probe'):
+            truncate_staging(cursor, table)
+            high_marks, changed_keys = collect_changes(cursor, table, load['sources'], data_interval_end, params)
+            conn.commit()
+        with timed_phase(metrics, 'extract'):
+            if params['fact_load_mode'] == 'keycache':
+                counts = load_facts_with_key_cache(conn, cursor, params, ti)
+            else:
+                explain_statement(cursor, metrics, 'extract', load['query'], FULL_KEY_RANGE)
+                counts = load_key_ranges(cursor, load['query'], table, params)
+            conn.commit()
+        # Rows examined by the chunk and stream connections
+        extra_reads = counts.pop('rows_examined')
+        counts['staged'] = counts['records']
+        explain_statement(cursor, metrics, 'load', load['publish_range_query'], FULL_KEY_RANGE)
+        with timed_phase(metrics, 'load'):
+            counts.update(NO_RECORDS)
+            for key_range in changed_key_ranges(cursor, table, int(params['fact_chunk_size'])):
+                range_parameters = {'chunk_lo': key_range[0], 'chunk_hi': key_range[1]}
+                for before_query in load['before_publish']:
+                    cursor.execute(before_query, range_parameters)
+                range_counts = run_upsert(conn, cursor, load['publish_range_query'], range_parameters)
+                for name in NO_RECORDS:
+                    counts[name] += range_counts[name]
+            write_watermarks(cursor, table, high_marks)
+        commit_load(conn, cursor, metrics, run_id, ti.task_id, table, counts, extra_reads)
+        cursor.close()
+    finally:
+        conn.close()
+    return finish_load(table, counts, changed_keys, ti, metrics)
+
+# Transfer mode, for a sakila_star database on another server than sakila
+# Every table has a transfer spec: the extract query run on the source server for a batch of changed natural ids,
+# the staging table the rows are loaded into on the target server, and the merge query that upserts them from there
+# (and the queries that run before and after the merge, in its transaction, the ones before it are templates like
+# the before_publish queries of load_spec). Without a merge query the staging table is merged
+# with staged_merge_query over the columns of the load, rendered when the load runs
+def transfer_spec(extract_query, staging_table, columns, merge_query=None, staging_ddl=None, converted_columns=None,
+                  before_merge=None, after_merge=None):
+    return {
+        'extract_query': extract_query,
+        'staging_table': staging_table,
+        'columns': columns,
+        'merge_query': merge_query,
+        'staging_ddl': staging_ddl,
+        # Columns that travel as hex text and the expression that turns @value back into the column type
+        'converted_columns': converted_columns or {},
+        'before_merge': before_merge or [],
+        'after_merge': after_merge or [],
+    }
+
+# Merge query of a staging table with the columns of the star table into the star table,
+# every column except the natural key is updated, the surrogate key is left alone
+# (where limits the staging rows that are merged, e.g. to a natural key range)
+def staged_merge_query(table, staging_table, columns, natural_key, where=None):
+    return """
+    INSERT INTO sakila_star.{table}({columns})
+    SELECT {columns}
+    FROM sakila_star.{staging_table}{where}
+    ON DUPLICATE KEY UPDATE
+        {updates}""".format(
+        table=table,
+        staging_table=staging_table,
+        where='\n    WHERE ' + where if where else '',
+        columns=', '.join(columns),
+        updates=',\n        '.join('{column} = VALUES({column})'.format(column=column)
+                                    for column in columns if column not in natural_key))
+
+# One row as a line of LOAD DATA text, tab separated, backslash escaped and \N for NULL
+def load_data_line(row):
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, (bytes, bytearray)):
+            fields.append(value.hex())
+        else:
+            if isinstance(value, set):
+                value = ','.join(sorted(value))
+            fields.append(str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+                          .replace('\r', '\\r').replace('\0', '\\0'))
+    return '\t'.join(fields) + '\n'
+
+# Read the changed rows from the source server through an unbuffered server side cursor,
+# batch_size natural ids per extract query and batch_size rows per fetch, so memory stays flat
+def stream_changed_rows(source_conn, extract_query, keys, batch_size):
+    import MySQLdb.cursors
+    cursor = source_conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        for i in range(0, len(keys), batch_size):
+            cursor.execute(extract_query, {'keys': tuple(keys[i:i + batch_size])})
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield load_data_line(row)
+    finally:
+        cursor.close()
+
+# Feed the lines into LOAD DATA LOCAL INFILE through a named pipe, written by a second thread while MySQL reads it
+# With transfer_spool "file" the lines are spooled to a gzip file first (the source connection is released early
+# and the file can be inspected), LOAD DATA can not read gzip so the file is still fed through the pipe.
+# The target connection needs "local_infile": true in its extras
+def load_data_local(cursor, spec, lines, params):
+    workdir = tempfile.mkdtemp(dir=params['transfer_spool_dir'])
+    try:
+        if params['transfer_spool'] == 'file':
+            spool_path = os.path.join(workdir, spec['staging_table'] + '.tsv.gz')
+            with gzip.open(spool_path, 'wt', encoding='utf-8') as spool_file:
+                spool_file.writelines(lines)
+            lines = gzip.open(spool_path, 'rt', encoding='utf-8')
+        fifo_path = os.path.join(workdir, spec['staging_table'] + '.fifo')
+        os.mkfifo(fifo_path)
+        errors = []
+
+        def feed_pipe():
+            try:
+                with open(fifo_path, 'w', encoding='utf-8') as pipe:
+                    pipe.writelines(lines)
+            except Exception as error:
+                errors.append(error)
+
+        writer = threading.Thread(target=feed_pipe)
+        writer.start()
+        column_list = ', '.join('@' + column if column in spec['converted_columns'] else column
+                                for column in spec['columns'])
+        conversions = ', '.join('{column} = {expression}'.format(column=column,
+                                                                 expression=expression.format(value='@' + column))
+                                for column, expression in spec['converted_columns'].items())
+        try:
+            cursor.execute("""
+            LOAD DATA LOCAL INFILE %s
+            INTO TABLE sakila_star.{staging_table}
+            CHARACTER SET utf8mb4
+            ({column_list})
+            {conversions}
+            """.format(staging_table=spec['staging_table'], column_list=column_list,
+                       conversions='SET ' + conversions if conversions else ''), (fifo_path,))
+            loaded = cursor.rowcount
+        finally:
+            # When LOAD DATA failed before opening the pipe, open it here so the writer does not wait forever
+            if writer.is_alive():
+                reader = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+                writer.join(1)
+                os.close(reader)
+            writer.join()
+        if errors:
+            raise errors[0]
+        return loaded
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# Stream the rows of the natural ids keys from the source server into the staging table with LOAD DATA
+# and merge them with one upsert, in the open transaction of the target connection
+# (a repair deletes the star rows of its deleted_keys with delete_query right before the merge)
+def transfer_rows(source_conn, target_conn, target_cursor, table, spec, keys, params, metrics, delete_query=None,
+                  deleted_keys=()):
+    counts = dict(NO_RECORDS)
+    # The extract streams from the source into LOAD DATA on the target, both run in this one phase
+    with timed_phase(metrics, 'extract'):
+        target_cursor.execute("DROP TEMPORARY TABLE IF EXISTS sakila_star.{staging_table}".format(**spec))
+        target_cursor.execute(spec['staging_ddl'] or "CREATE TEMPORARY TABLE sakila_star.{staging_table} LIKE sakila_star.{table}"
+                              .format(staging_table=spec['staging_table'], table=table))
+        lines = stream_changed_rows(source_conn, spec['extract_query'], keys, int(params['transfer_batch_size']))
+        counts['staged'] = load_data_local(target_cursor, spec, lines, params)
+    explain_statement(target_cursor, metrics, 'load', spec['merge_query'], None)
+    with timed_phase(metrics, 'load'):
+        for before_query in spec['before_merge']:
+            target_cursor.execute(before_query)
+        if delete_query:
+            delete_keys(target_cursor, delete_query, deleted_keys, params)
+        counts.update(run_upsert(target_conn, target_cursor, spec['merge_query'], None))
+        for after_query in spec['after_merge']:
+            target_cursor.execute(after_query)
+    return counts
+
+# Define function to copy one table from the source server to the target server
+# The watermarks and etl_changed_keys live on the target server, the change sources are read on the source server.
+# The changed rows are streamed into a staging table with LOAD DATA and merged with one upsert,
+# which commits in the same transaction as the new watermarks
+def transfer_table(table, sources, spec, data_interval_end, params, ti, run_id):
+    source_conn = MySqlHook(mysql_conn_id=SOURCE_CONN_ID).get_conn()
+    target_conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+    try:
+        source_cursor = source_conn.cursor()
+        target_cursor = target_conn.cursor()
+        target_cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        metrics = start_metrics(target_cursor)
+        source_reads = handler_reads(source_cursor)
+        end = window_end(source_cursor, data_interval_end, params)
+        high_marks = {}
+        changed_keys = {}
+        keys = set()
+        with timed_phase(metrics, 'probe'):
+            for source in sources:
+                watermark = read_watermark(target_cursor, table, source['source'])
+                window = change_window(watermark, end, int(params['watermark_lookback_seconds']))
+                high_marks[source['source']] = next_watermark(
+                    watermark, read_high_mark(source_cursor, source['source'], source['id_column'], window))
+                if high_marks[source['source']] is not None:
+                    source_cursor.execute(source['keys_query'], window)
+                    source_keys = {row[0] for row in source_cursor.fetchall()}
+                    changed_keys[source['source']] = len(source_keys)
+                    keys |= source_keys
+            keys = sorted(keys)
+            target_cursor.execute("DELETE FROM sakila_star.etl_changed_keys WHERE target_table = %s", (table,))
+            target_cursor.executemany("""
+            INSERT INTO sakila_star.etl_changed_keys(target_table, natural_id)
+            VALUES (%s, %s)
+            """, [(table, key) for key in keys])
+        counts = dict(NO_RECORDS)
+        if keys:
+            counts = transfer_rows(source_conn, target_conn, target_cursor, table, spec, keys, params, metrics)
+        with timed_phase(metrics, 'load'):
+            write_watermarks(target_cursor, table, high_marks)
+        source_reads = handler_reads(source_cursor) - source_reads
+        source_cursor.close()
+        commit_load(target_conn, target_cursor, metrics, run_id, ti.task_id, table, counts, source_reads)
+        target_cursor.close()
+    finally:
+        source_conn.close()
+        target_conn.close()
+    return finish_load(table, counts, changed_keys, ti, metrics)
+
+# Load specs
+# Every load task is declared once as a spec: its task id, the star table and its natural key, the columns its staging
+# table is merged with, the build query, the change sources, the transfer spec and the reconciliation specs.
+# load_operator builds the task from the spec and passes it only the table name, and everything else that lists
+# the star tables (the key maps of the fact dimensions, the reconciliation, the bootstrap, the Parquet export and
+# the last_update indexes of the sources) is derived from LOAD_SPECS, so a new dimension is one more spec.
+# The SQL of a spec is kept as templates, render_load formats them (the change windows of the sources, the publish
+# and transfer merge queries, the staging table and key range of the before_publish and before_merge queries)
+# the first time the table loads in the process, so parsing the DAG file, which the scheduler does every few
+# seconds, formats no SQL at all
+def load_spec(task_id, table, natural_key, columns, query, sources, transfer, python_callable=load_table,
+              before_publish=(), after_publish=(), surrogate_key=None, side_tables=(), reconcile=(), **operator_args):
+    # A field of a reconciliation spec left unset is the one of this table
+    reconcile_defaults = {'table': table, 'key_column': natural_key[0], 'columns': columns,
+                          'star_keys': ('sakila_star.' + table, natural_key[0]), 'repair_table': table}
+    return {
+        'task_id': task_id,
+        'table': table,
+        'natural_key': natural_key,
+        'columns': columns,
+        'query': query,
+        'sources': sources,
+        'transfer': transfer,
+        'python_callable': python_callable,
+        # Templates of the queries that run before the publish, formatted with {staging_table} and
+        # {key_range}, the range of the fact rows FT of a chunked publish (see render_load)
+        'before_publish': before_publish,
+        'after_publish': after_publish,
+        # The surrogate key column of a dimension, the fact table points at it
+        'surrogate_key': surrogate_key,
+        # Star tables the load writes next to its own table (the film category bridge of dim_film)
+        'side_tables': list(side_tables),
+        'reconcile': [dict(spec, **dict((name, value) for name, value in reconcile_defaults.items() if spec[name] is None))
+                      for spec in reconcile],
+        # trigger_rule and any other PythonOperator argument of the task
+        'operator_args': operator_args,
+    }
+
+# Reconciliation spec of one star table, see Task 6b
+# source_query and star_query return the columns for the natural ids between %(lo)s and %(hi)s,
+# without a star query the columns are read from the star table itself (see star_rows_query).
+# source_keys and star_keys are the (table, natural id column) of both servers, for the first and last natural id,
+# repair_table is the table whose load upserts the differing natural ids again. load_spec fills in the fields
+# left unset with the ones of its table
+def reconcile_spec(source_query, source_keys, table=None, key_column=None, columns=None, star_query=None,
+                   star_keys=None, repair_table=None, repair_delete_query=None):
+    return {
+        'table': table,
+        'key_column': key_column,
+        'columns': columns,
+        'source_query': source_query,
+        'star_query': star_query,
+        'source_keys': source_keys,
+        'star_keys': star_keys,
+        'repair_table': repair_table,
+        'repair_delete_query': repair_delete_query,
+    }
+
+# Rows of a dimension in sakila_star, the columns of its load
+def star_rows_query(table, columns, key_column):
+    return """
+    SELECT {columns}
+    FROM sakila_star.{table}
+    WHERE {key_column} BETWEEN %(lo)s AND %(hi)s""".format(columns=', '.join(columns), table=table, key_column=key_column)
+
+# Queries of the load of one table, rendered from its spec once per process
+@functools.lru_cache(maxsize=None)
+def render_load(table):
+    spec = next(spec for spec in LOAD_SPECS if spec['table'] == table)
+    transfer = dict(spec['transfer'])
+    if transfer['merge_query'] is None:
+        transfer['merge_query'] = staged_merge_query(table, transfer['staging_table'], spec['columns'], spec['natural_key'])
+    # The transfer merges all the changed rows at once, the publish may run per range of the first natural key column
+    transfer['before_merge'] = [query.format(staging_table=transfer['staging_table'], key_range='')
+                                for query in transfer['before_merge']]
+    key_range = '\nAND FT.{key} BETWEEN %(chunk_lo)s AND %(chunk_hi)s'.format(key=spec['natural_key'][0])
+    return {
+        'table': table,
+        'query': spec['query'],
+        'publish_query': staged_merge_query(table, 'stg_' + table, spec['columns'], spec['natural_key']),
+        # The publish of one range of the first natural key column, for the fact loads that publish in chunks
+        'publish_range_query': staged_merge_query(
+            table, 'stg_' + table, spec['columns'], spec['natural_key'],
+            '{key} BETWEEN %(chunk_lo)s AND %(chunk_hi)s'.format(key=spec['natural_key'][0])),
+        'sources': [dict(source, keys_query=source['keys_template'].format(
+            window=change_predicate('SRC', source['id_column']))) for source in spec['sources']],
+        'transfer': transfer,
+        'before_publish': [query.format(staging_table='stg_' + table, key_range=key_range)
+                           for query in spec['before_publish']],
+        'after_publish': spec['after_publish'],
+    }
+
+# Task to build the records of the change window in staging, publish them and move the watermarks,
+# skipped when there are no records
+def load_operator(spec):
+    return PythonOperator(
+        task_id=spec['task_id'],
+        python_callable=spec['python_callable'],
+        op_kwargs={'table': spec['table']},
+        dag=dag,
+        **spec['operator_args']
+    )
+
+# Insert new data from sakila databases to sakila_star based on last update inside the change window
+# Using Insert Into from original database that already querying for data that update in the window to input new data (or updated data) to sakila_star
+# Using the range condition of change_predicate on last_update instead of DATE(SCUS.last_update), so MySQL can
+# range scan the last_update index, and that means this airflow dags can run daily without burden of transforming all data in old database
+# The customer, address, city and country changes are joined in through etl_changed_keys
 # Using ON DUPLICATE KEY UPDATE to update data in new database when there is some changes in old database
+# The duplicate key is the UNIQUE natural key (customer_id, store_id, staff_id, film_id and
+# (rental_id, payment_id)), the surrogate key is left to AUTO_INCREMENT and never updated so it stays stable for the fact table
 task_2_query = """
-INSERT INTO sakila_star.dim_customer(customer_key,customer_last_update,customer_id,
+INSERT INTO sakila_star.stg_dim_customer(customer_last_update,customer_id,
                                      customer_first_name,customer_last_name,customer_email,
                                      customer_active,customer_address_id,customer_address,
                                      customer_district,customer_city_id,
                                      customer_city,customer_country_id,customer_country,
                                      customer_postal_code,customer_phone,
                                      customer_location,customer_create_date)
-SELECT NULL, SCUS.last_update, SCUS.customer_id, SCUS.first_name, SCUS.last_name, SCUS.email, SCUS.active, SCUS.address_id,
+SELECT SCUS.last_update, SCUS.customer_id, SCUS.first_name, SCUS.last_name, SCUS.email, SCUS.active, SCUS.address_id,
 SADD.address, SADD.district, SADD.city_id, SCI.city, SCI.country_id, SCO.country, SADD.postal_code, SADD.phone, SADD.location,
 SCUS.create_date
 FROM sakila.customer AS SCUS
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'dim_customer' AND CHG.natural_id = SCUS.customer_id
 INNER JOIN sakila.address AS SADD ON SCUS.address_id = SADD.address_id
 INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
 INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
-WHERE DATE(SCUS.last_update) = '{ysd}'
 
 ON DUPLICATE KEY UPDATE
     customer_last_update = SCUS.last_update,
-    customer_id = SCUS.customer_id,
     customer_first_name = SCUS.first_name,
     customer_last_name = SCUS.last_name,
     customer_email = SCUS.email,
@@ -232,61 +1345,83 @@ ON DUPLICATE KEY UPDATE
     customer_postal_code = SADD.postal_code,
     customer_phone = SADD.phone,
     customer_location = SADD.location,
-    customer_create_date = SCUS.create_date;""".format(ysd=str_yesterday)
+    customer_create_date = SCUS.create_date"""
 
 
-# Define function to detect is there any data that insert yesterday or not
-def check_records_task_2():
-    # Your SQL query to count records
-    query = """
-    SELECT COUNT(*)
+# Change sources of task 2, the driving table and every lookup table its columns are copied from
+task_2_sources = [
+    change_source('customer', 'customer_id', """
+    SELECT SRC.customer_id AS natural_id
+    FROM sakila.customer AS SRC
+    WHERE {window}"""),
+    change_source('address', 'address_id', """
+    SELECT SCUS.customer_id AS natural_id
+    FROM sakila.address AS SRC
+    INNER JOIN sakila.customer AS SCUS ON SCUS.address_id = SRC.address_id
+    WHERE {window}"""),
+    change_source('city', 'city_id', """
+    SELECT SCUS.customer_id AS natural_id
+    FROM sakila.city AS SRC
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SRC.city_id
+    INNER JOIN sakila.customer AS SCUS ON SCUS.address_id = SADD.address_id
+    WHERE {window}"""),
+    change_source('country', 'country_id', """
+    SELECT SCUS.customer_id AS natural_id
+    FROM sakila.country AS SRC
+    INNER JOIN sakila.city AS SCI ON SCI.country_id = SRC.country_id
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SCI.city_id
+    INNER JOIN sakila.customer AS SCUS ON SCUS.address_id = SADD.address_id
+    WHERE {window}"""),
+]
+
+# Transfer spec of task 2, the same columns read on the source server, location travels as WKB
+task_2_columns = ['customer_last_update', 'customer_id', 'customer_first_name', 'customer_last_name', 'customer_email',
+                  'customer_active', 'customer_address_id', 'customer_address', 'customer_district', 'customer_city_id',
+                  'customer_city', 'customer_country_id', 'customer_country', 'customer_postal_code', 'customer_phone',
+                  'customer_location', 'customer_create_date']
+task_2_transfer = transfer_spec("""
+SELECT SCUS.last_update, SCUS.customer_id, SCUS.first_name, SCUS.last_name, SCUS.email, SCUS.active, SCUS.address_id,
+SADD.address, SADD.district, SADD.city_id, SCI.city, SCI.country_id, SCO.country, SADD.postal_code, SADD.phone,
+ST_AsBinary(SADD.location), SCUS.create_date
+FROM sakila.customer AS SCUS
+INNER JOIN sakila.address AS SADD ON SCUS.address_id = SADD.address_id
+INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
+INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
+WHERE SCUS.customer_id IN %(keys)s""",
+    'transfer_dim_customer', task_2_columns,
+    converted_columns={'customer_location': 'ST_GeomFromWKB(UNHEX({value}))'})
+
+# Rows of task 2 in sakila for the reconciliation, the columns of the load in the same order
+task_2_reconcile_query = """
+    SELECT SCUS.last_update, SCUS.customer_id, SCUS.first_name, SCUS.last_name, SCUS.email, SCUS.active, SCUS.address_id,
+    SADD.address, SADD.district, SADD.city_id, SCI.city, SCI.country_id, SCO.country, SADD.postal_code, SADD.phone,
+    SADD.location, SCUS.create_date
     FROM sakila.customer AS SCUS
     INNER JOIN sakila.address AS SADD ON SCUS.address_id = SADD.address_id
     INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
     INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
-    WHERE DATE(SCUS.last_update) = '{ysd}'
-    """.format(ysd=str_yesterday)
-    # Execute the query and return the branch task ID based on the result
-    mysql_hook = MySqlHook(mysql_conn_id="my_sql")
-    result = mysql_hook.get_first(query)
-    if result[0] > 0:
-        return "mysql_task_2_execute_next"
-    else:
-        return "mysql_task_2_no_records_task"
+    WHERE SCUS.customer_id BETWEEN %(lo)s AND %(hi)s"""
 
-# Task to check records and decide which task to execute next
-mysql_task_2_check_records_task = BranchPythonOperator(
-    task_id="mysql_task_2_check_records_task",
-    python_callable=check_records_task_2,
-    dag=dag
-)
-# Task to execute the next query if there are records
-mysql_task_2_execute_next = MySqlOperator(
-    task_id="mysql_task_2_execute_next",
-    sql=task_2_query,
-    mysql_conn_id="my_sql",
-    dag=dag
-)
-# Task to handle the case when no records are found
-mysql_task_2_no_records_task = DummyOperator(task_id="mysql_task_2_no_records_task", dag=dag)
+task_2_load = load_spec('mysql_task_2_execute_next', 'dim_customer', ['customer_id'], task_2_columns,
+                        task_2_query, task_2_sources, task_2_transfer, surrogate_key='customer_key',
+                        reconcile=[reconcile_spec(task_2_reconcile_query, ('sakila.customer', 'customer_id'))])
 
 # Task 3 - Task 6 (Final Task) is quite repetitive like taks 2
-# Task 3: Insert New Yesterday Data From Sakila Database to Sakila_Star Database Dimension Store Table
+# Task 3: Insert New Data Since The Last Load From Sakila Database to Sakila_Star Database Dimension Store Table
 task_3_query = """
-INSERT INTO sakila_star.dim_store(store_key, store_last_update, store_id, store_address_id, store_address,
+INSERT INTO sakila_star.stg_dim_store(store_last_update, store_id, store_address_id, store_address,
                                     store_district, store_city_id, store_city, store_country_id, store_country,
                                     store_manager_staff_id, store_manager_first_name, store_manager_last_name)
-SELECT NULL, SSTO.last_update, SSTO.store_id, SSTO.address_id, SADD.address, SADD.district, SADD.city_id, SCI.city,
+SELECT SSTO.last_update, SSTO.store_id, SSTO.address_id, SADD.address, SADD.district, SADD.city_id, SCI.city,
 SCI.country_id, SCO.country, SSTO.manager_staff_id, SSTA.first_name, SSTA.last_name
 FROM sakila.store AS SSTO
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'dim_store' AND CHG.natural_id = SSTO.store_id
 INNER JOIN sakila.address AS SADD ON SSTO.address_id = SADD.address_id
 INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
 INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
 INNER JOIN sakila.staff AS SSTA ON SSTO.manager_staff_id = SSTA.staff_id
-WHERE DATE(SSTO.last_update) = '{ysd}'
 ON DUPLICATE KEY UPDATE
     store_last_update = SSTO.last_update,
-    store_id = SSTO.store_id,
     store_address_id = SSTO.address_id,
     store_address = SADD.address,
     store_district = SADD.district,
@@ -296,62 +1431,86 @@ ON DUPLICATE KEY UPDATE
     store_country = SCO.country,
     store_manager_staff_id = SSTO.manager_staff_id,
     store_manager_first_name = SSTA.first_name,
-    store_manager_last_name = SSTA.last_name """.format(ysd=str_yesterday)
+    store_manager_last_name = SSTA.last_name """
 
-def check_records_task_3():
-    # Your SQL query to count records
-    query = """
-    SELECT COUNT(*)
+# Change sources of task 3, the driving table and every lookup table its columns are copied from
+task_3_sources = [
+    change_source('store', 'store_id', """
+    SELECT SRC.store_id AS natural_id
+    FROM sakila.store AS SRC
+    WHERE {window}"""),
+    change_source('address', 'address_id', """
+    SELECT SSTO.store_id AS natural_id
+    FROM sakila.address AS SRC
+    INNER JOIN sakila.store AS SSTO ON SSTO.address_id = SRC.address_id
+    WHERE {window}"""),
+    change_source('city', 'city_id', """
+    SELECT SSTO.store_id AS natural_id
+    FROM sakila.city AS SRC
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SRC.city_id
+    INNER JOIN sakila.store AS SSTO ON SSTO.address_id = SADD.address_id
+    WHERE {window}"""),
+    change_source('country', 'country_id', """
+    SELECT SSTO.store_id AS natural_id
+    FROM sakila.country AS SRC
+    INNER JOIN sakila.city AS SCI ON SCI.country_id = SRC.country_id
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SCI.city_id
+    INNER JOIN sakila.store AS SSTO ON SSTO.address_id = SADD.address_id
+    WHERE {window}"""),
+    change_source('staff', 'staff_id', """
+    SELECT SSTO.store_id AS natural_id
+    FROM sakila.staff AS SRC
+    INNER JOIN sakila.store AS SSTO ON SSTO.manager_staff_id = SRC.staff_id
+    WHERE {window}"""),
+]
+
+# Transfer spec of task 3
+task_3_columns = ['store_last_update', 'store_id', 'store_address_id', 'store_address', 'store_district',
+                  'store_city_id', 'store_city', 'store_country_id', 'store_country', 'store_manager_staff_id',
+                  'store_manager_first_name', 'store_manager_last_name']
+task_3_transfer = transfer_spec("""
+SELECT SSTO.last_update, SSTO.store_id, SSTO.address_id, SADD.address, SADD.district, SADD.city_id, SCI.city,
+SCI.country_id, SCO.country, SSTO.manager_staff_id, SSTA.first_name, SSTA.last_name
+FROM sakila.store AS SSTO
+INNER JOIN sakila.address AS SADD ON SSTO.address_id = SADD.address_id
+INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
+INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
+INNER JOIN sakila.staff AS SSTA ON SSTO.manager_staff_id = SSTA.staff_id
+WHERE SSTO.store_id IN %(keys)s""",
+    'transfer_dim_store', task_3_columns)
+
+# Rows of task 3 in sakila for the reconciliation
+task_3_reconcile_query = """
+    SELECT SSTO.last_update, SSTO.store_id, SSTO.address_id, SADD.address, SADD.district, SADD.city_id, SCI.city,
+    SCI.country_id, SCO.country, SSTO.manager_staff_id, SSTA.first_name, SSTA.last_name
     FROM sakila.store AS SSTO
     INNER JOIN sakila.address AS SADD ON SSTO.address_id = SADD.address_id
     INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
     INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
     INNER JOIN sakila.staff AS SSTA ON SSTO.manager_staff_id = SSTA.staff_id
-    WHERE DATE(SSTO.last_update) = '{ysd}'
-    """.format(ysd=str_yesterday)
-    # Execute the query and return the branch task ID based on the result
-    mysql_hook = MySqlHook(mysql_conn_id="my_sql")
-    result = mysql_hook.get_first(query)
-    if result[0] > 0:
-        return "mysql_task_3_execute_next"
-    else:
-        return "mysql_task_3_no_records_task"
+    WHERE SSTO.store_id BETWEEN %(lo)s AND %(hi)s"""
 
-# Task to check records and decide which task to execute next
-mysql_task_3_check_records_task = BranchPythonOperator(
-    task_id="mysql_task_3_check_records_task",
-    python_callable=check_records_task_3,
-    trigger_rule='one_success',
-    dag=dag
-)
-# Task to execute the next query if there are records
-mysql_task_3_execute_next = MySqlOperator(
-    task_id="mysql_task_3_execute_next",
-    sql=task_3_query,
-    mysql_conn_id="my_sql",
-    dag=dag
-)
-# Task to handle the case when no records are found
-mysql_task_3_no_records_task = DummyOperator(task_id="mysql_task_3_no_records_task", dag=dag)
+task_3_load = load_spec('mysql_task_3_execute_next', 'dim_store', ['store_id'], task_3_columns,
+                        task_3_query, task_3_sources, task_3_transfer, surrogate_key='store_key',
+                        reconcile=[reconcile_spec(task_3_reconcile_query, ('sakila.store', 'store_id'))])
 
 
-# Task 4: Insert New Yesterday Data From Sakila Database to Sakila_Star Database Dimension Staff Table
+# Task 4: Insert New Data Since The Last Load From Sakila Database to Sakila_Star Database Dimension Staff Table
 task_4_query = """
-INSERT INTO sakila_star.dim_staff(staff_key, staff_last_update, staff_id, staff_first_name, staff_last_name,
+INSERT INTO sakila_star.stg_dim_staff(staff_last_update, staff_id, staff_first_name, staff_last_name,
                                  staff_address_id, staff_address, staff_district, staff_city_id, staff_city,
                                  staff_country_id, staff_country, staff_picture, staff_email, staff_username,
                                  staff_password, staff_store_id, staff_active)
-SELECT NULL, SSTA.last_update, SSTA.staff_id, SSTA.first_name, SSTA.last_name, SSTA.address_id, SADD.address, SADD.district,
+SELECT SSTA.last_update, SSTA.staff_id, SSTA.first_name, SSTA.last_name, SSTA.address_id, SADD.address, SADD.district,
 SADD.city_id, SCI.city, SCI.country_id, SCO.country, SSTA.picture, SSTA.email, SSTA.username, SSTA.password,
 SSTA.store_id, SSTA.active
 FROM sakila.staff AS SSTA
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'dim_staff' AND CHG.natural_id = SSTA.staff_id
 INNER JOIN sakila.address AS SADD ON SSTA.address_id = SADD.address_id
 INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
 INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
-WHERE DATE(SSTA.last_update) = '{ysd}'
 ON DUPLICATE KEY UPDATE
     staff_last_update = SSTA.last_update,
-    staff_id = SSTA.staff_id,
     staff_first_name = SSTA.first_name,
     staff_last_name = SSTA.last_name,
     staff_address_id = SSTA.address_id,
@@ -367,62 +1526,79 @@ ON DUPLICATE KEY UPDATE
     staff_password = SSTA.password,
     staff_store_id = SSTA.store_id,
     staff_active = SSTA.active
-""".format(ysd=str_yesterday)
+"""
 
-def check_records_task_4():
-    # Your SQL query to count records
-    query = """
-    SELECT COUNT(*)
+# Change sources of task 4, the driving table and every lookup table its columns are copied from
+task_4_sources = [
+    change_source('staff', 'staff_id', """
+    SELECT SRC.staff_id AS natural_id
+    FROM sakila.staff AS SRC
+    WHERE {window}"""),
+    change_source('address', 'address_id', """
+    SELECT SSTA.staff_id AS natural_id
+    FROM sakila.address AS SRC
+    INNER JOIN sakila.staff AS SSTA ON SSTA.address_id = SRC.address_id
+    WHERE {window}"""),
+    change_source('city', 'city_id', """
+    SELECT SSTA.staff_id AS natural_id
+    FROM sakila.city AS SRC
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SRC.city_id
+    INNER JOIN sakila.staff AS SSTA ON SSTA.address_id = SADD.address_id
+    WHERE {window}"""),
+    change_source('country', 'country_id', """
+    SELECT SSTA.staff_id AS natural_id
+    FROM sakila.country AS SRC
+    INNER JOIN sakila.city AS SCI ON SCI.country_id = SRC.country_id
+    INNER JOIN sakila.address AS SADD ON SADD.city_id = SCI.city_id
+    INNER JOIN sakila.staff AS SSTA ON SSTA.address_id = SADD.address_id
+    WHERE {window}"""),
+]
+
+# Transfer spec of task 4, picture travels as hex
+task_4_columns = ['staff_last_update', 'staff_id', 'staff_first_name', 'staff_last_name', 'staff_address_id',
+                  'staff_address', 'staff_district', 'staff_city_id', 'staff_city', 'staff_country_id', 'staff_country',
+                  'staff_picture', 'staff_email', 'staff_username', 'staff_password', 'staff_store_id', 'staff_active']
+task_4_transfer = transfer_spec("""
+SELECT SSTA.last_update, SSTA.staff_id, SSTA.first_name, SSTA.last_name, SSTA.address_id, SADD.address, SADD.district,
+SADD.city_id, SCI.city, SCI.country_id, SCO.country, SSTA.picture, SSTA.email, SSTA.username, SSTA.password,
+SSTA.store_id, SSTA.active
+FROM sakila.staff AS SSTA
+INNER JOIN sakila.address AS SADD ON SSTA.address_id = SADD.address_id
+INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
+INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
+WHERE SSTA.staff_id IN %(keys)s""",
+    'transfer_dim_staff', task_4_columns,
+    converted_columns={'staff_picture': 'UNHEX({value})'})
+
+# Rows of task 4 in sakila for the reconciliation
+task_4_reconcile_query = """
+    SELECT SSTA.last_update, SSTA.staff_id, SSTA.first_name, SSTA.last_name, SSTA.address_id, SADD.address, SADD.district,
+    SADD.city_id, SCI.city, SCI.country_id, SCO.country, SSTA.picture, SSTA.email, SSTA.username, SSTA.password,
+    SSTA.store_id, SSTA.active
     FROM sakila.staff AS SSTA
     INNER JOIN sakila.address AS SADD ON SSTA.address_id = SADD.address_id
     INNER JOIN sakila.city AS SCI ON SADD.city_id = SCI.city_id
     INNER JOIN sakila.country AS SCO ON SCI.country_id = SCO.country_id
-    WHERE DATE(SSTA.last_update) = '{ysd}'
-    """.format(ysd=str_yesterday)
-    # Execute the query and return the branch task ID based on the result
-    mysql_hook = MySqlHook(mysql_conn_id="my_sql")
-    result = mysql_hook.get_first(query)
-    if result[0] > 0:
-        return "mysql_task_4_execute_next"
-    else:
-        return "mysql_task_4_no_records_task"
+    WHERE SSTA.staff_id BETWEEN %(lo)s AND %(hi)s"""
 
-# Task to check records and decide which task to execute next
-mysql_task_4_check_records_task = BranchPythonOperator(
-    task_id="mysql_task_4_check_records_task",
-    python_callable=check_records_task_4,
-    trigger_rule='one_success',
-    dag=dag
-)
-# Task to execute the next query if there are records
-mysql_task_4_execute_next = MySqlOperator(
-    task_id="mysql_task_4_execute_next",
-    sql=task_4_query,
-    mysql_conn_id="my_sql",
-    dag=dag
-)
-# Task to handle the case when no records are found
-mysql_task_4_no_records_task = DummyOperator(task_id="mysql_task_4_no_records_task", dag=dag)
+task_4_load = load_spec('mysql_task_4_execute_next', 'dim_staff', ['staff_id'], task_4_columns,
+                        task_4_query, task_4_sources, task_4_transfer, surrogate_key='staff_key',
+                        reconcile=[reconcile_spec(task_4_reconcile_query, ('sakila.staff', 'staff_id'))])
 
-# Task 5: Insert New Yesterday Data From Sakila Database to Sakila_Star Database Dimension Film Table
+# Task 5: Insert New Data Since The Last Load From Sakila Database to Sakila_Star Database Dimension Film Table
 task_5_query = """
-INSERT INTO sakila_star.dim_film(film_key,film_last_update,film_id,film_title,film_description,
+INSERT INTO sakila_star.stg_dim_film(film_last_update,film_id,film_title,film_description,
                                  film_release_year,film_language_id,film_language_name,
                                  film_rental_duration,film_rental_rate,film_duration,
-                                 film_replacement_cost,film_rating_text,film_special_features,
-                                 film_category_id,film_category_name)
+                                 film_replacement_cost,film_rating_text,film_special_features)
 
-SELECT NULL, SFIL.last_update, SFIL.film_id, SFIL.title, SFIL.description, SFIL.release_year, SFIL.language_id, SLAN.name,
-SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features,
-SFCA.category_id, SCAT.name
+SELECT SFIL.last_update, SFIL.film_id, SFIL.title, SFIL.description, SFIL.release_year, SFIL.language_id, SLAN.name,
+SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features
 FROM sakila.film AS SFIL
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'dim_film' AND CHG.natural_id = SFIL.film_id
 INNER JOIN sakila.language AS SLAN ON SFIL.language_id = SLAN.language_id
-INNER JOIN sakila.film_category AS SFCA ON SFIL.film_id = SFCA.film_id
-INNER JOIN sakila.category AS SCAT ON SFCA.category_id = SCAT.category_id
-WHERE DATE(SFIL.last_update) = '{ysd}'
 ON DUPLICATE KEY UPDATE
 film_last_update = SFIL.last_update,
-film_id = SFIL.film_id,
 film_title = SFIL.title,
 film_description = SFIL.description,
 film_release_year = SFIL.release_year,
@@ -433,62 +1609,140 @@ film_rental_rate = SFIL.rental_rate,
 film_duration = SFIL.length,
 film_replacement_cost = SFIL.replacement_cost,
 film_rating_text = SFIL.rating,
-film_special_features = SFIL.special_features,
-film_category_id = SFCA.category_id,
-film_category_name = SCAT.name""".format(ysd=str_yesterday)
+film_special_features = SFIL.special_features"""
 
-def check_records_task_5():
-    # Your SQL query to count records
-    query = """
-    SELECT COUNT(*)
+# The categories of the changed films are replaced in bridge_film_category after dim_film is published,
+# in the same transaction, so a film that left a category loses its bridge row and a new film gets its rows
+# with the film_key it was just given. A film without a category simply has no bridge rows
+task_5_bridge_queries = ["""
+DELETE BFC
+FROM sakila_star.bridge_film_category AS BFC
+INNER JOIN sakila_star.dim_film AS DFIL ON DFIL.film_key = BFC.film_key
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'dim_film' AND CHG.natural_id = DFIL.film_id""", """
+INSERT INTO sakila_star.bridge_film_category(film_key, category_id, category_name, last_update)
+SELECT DFIL.film_key, SFCA.category_id, SCAT.name, GREATEST(SFCA.last_update, SCAT.last_update)
+FROM sakila_star.etl_changed_keys AS CHG
+INNER JOIN sakila_star.dim_film AS DFIL ON DFIL.film_id = CHG.natural_id
+INNER JOIN sakila.film_category AS SFCA ON SFCA.film_id = DFIL.film_id
+INNER JOIN sakila.category AS SCAT ON SCAT.category_id = SFCA.category_id
+WHERE CHG.target_table = 'dim_film'"""]
+
+# Change sources of task 5, the driving table and every lookup table its columns are copied from
+# (film_category and category feed the bridge rows of the film)
+task_5_sources = [
+    change_source('film', 'film_id', """
+    SELECT SRC.film_id AS natural_id
+    FROM sakila.film AS SRC
+    WHERE {window}"""),
+    change_source('language', 'language_id', """
+    SELECT SFIL.film_id AS natural_id
+    FROM sakila.language AS SRC
+    INNER JOIN sakila.film AS SFIL ON SFIL.language_id = SRC.language_id
+    WHERE {window}"""),
+    change_source('film_category', 'film_id', """
+    SELECT SRC.film_id AS natural_id
+    FROM sakila.film_category AS SRC
+    WHERE {window}"""),
+    change_source('category', 'category_id', """
+    SELECT SFCA.film_id AS natural_id
+    FROM sakila.category AS SRC
+    INNER JOIN sakila.film_category AS SFCA ON SFCA.category_id = SRC.category_id
+    WHERE {window}"""),
+]
+
+# Transfer spec of task 5
+task_5_columns = ['film_last_update', 'film_id', 'film_title', 'film_description', 'film_release_year',
+                  'film_language_id', 'film_language_name', 'film_rental_duration', 'film_rental_rate', 'film_duration',
+                  'film_replacement_cost', 'film_rating_text', 'film_special_features']
+
+# Transfer spec of task 5, every film row travels with its categories as a JSON array in film_categories,
+# which JSON_TABLE unnests into the bridge rows on the target server
+task_5_transfer = transfer_spec("""
+SELECT SFIL.last_update, SFIL.film_id, SFIL.title, SFIL.description, SFIL.release_year, SFIL.language_id, SLAN.name,
+SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features,
+(SELECT CAST(JSON_ARRAYAGG(JSON_OBJECT('category_id', SFCA.category_id, 'category_name', SCAT.name,
+                                       'last_update', GREATEST(SFCA.last_update, SCAT.last_update))) AS CHAR)
+ FROM sakila.film_category AS SFCA
+ INNER JOIN sakila.category AS SCAT ON SFCA.category_id = SCAT.category_id
+ WHERE SFCA.film_id = SFIL.film_id)
+FROM sakila.film AS SFIL
+INNER JOIN sakila.language AS SLAN ON SFIL.language_id = SLAN.language_id
+WHERE SFIL.film_id IN %(keys)s""",
+    'transfer_dim_film', task_5_columns + ['film_categories'],
+    staging_ddl="""
+CREATE TEMPORARY TABLE sakila_star.transfer_dim_film (
+    `film_last_update` DATETIME NOT NULL,
+    `film_id` INT(12) NOT NULL,
+    `film_title` VARCHAR(64) NOT NULL,
+    `film_description` TEXT NOT NULL,
+    `film_release_year` SMALLINT(5) NOT NULL,
+    `film_language_id` INT(12) NOT NULL,
+    `film_language_name` VARCHAR(20) NOT NULL,
+    `film_rental_duration` TINYINT(3) NULL DEFAULT NULL,
+    `film_rental_rate` DECIMAL(4,2) NULL DEFAULT NULL,
+    `film_duration` INT(8) NULL DEFAULT NULL,
+    `film_replacement_cost` DECIMAL(5,2) NULL DEFAULT NULL,
+    `film_rating_text` VARCHAR(30) NULL DEFAULT NULL,
+    `film_special_features` VARCHAR(64) NULL DEFAULT NULL,
+    `film_categories` JSON NULL DEFAULT NULL)""",
+    after_merge=[task_5_bridge_queries[0], """
+INSERT INTO sakila_star.bridge_film_category(film_key, category_id, category_name, last_update)
+SELECT DFIL.film_key, CAT.category_id, CAT.category_name, CAT.last_update
+FROM sakila_star.transfer_dim_film AS STG
+INNER JOIN sakila_star.dim_film AS DFIL ON DFIL.film_id = STG.film_id
+CROSS JOIN JSON_TABLE(STG.film_categories, '$[*]' COLUMNS (
+    category_id INT PATH '$.category_id',
+    category_name CHAR(30) PATH '$.category_name',
+    last_update DATETIME PATH '$.last_update')) AS CAT"""])
+
+# Rows of task 5 in sakila for the reconciliation, and its bridge rows in both databases, which are
+# reconciled apart and repaired through the load of dim_film
+task_5_reconcile_query = """
+    SELECT SFIL.last_update, SFIL.film_id, SFIL.title, SFIL.description, SFIL.release_year, SFIL.language_id, SLAN.name,
+    SFIL.rental_duration, SFIL.rental_rate, SFIL.length, SFIL.replacement_cost, SFIL.rating, SFIL.special_features
     FROM sakila.film AS SFIL
     INNER JOIN sakila.language AS SLAN ON SFIL.language_id = SLAN.language_id
-    INNER JOIN sakila.film_category AS SFCA ON SFIL.film_id = SFCA.film_id
+    WHERE SFIL.film_id BETWEEN %(lo)s AND %(hi)s"""
+
+task_5_bridge_reconcile_query = """
+    SELECT SFCA.film_id, SFCA.category_id, SCAT.name, GREATEST(SFCA.last_update, SCAT.last_update)
+    FROM sakila.film_category AS SFCA
     INNER JOIN sakila.category AS SCAT ON SFCA.category_id = SCAT.category_id
-    WHERE DATE(SFIL.last_update) = '{ysd}'
-    """.format(ysd=str_yesterday)
-    # Execute the query and return the branch task ID based on the result
-    mysql_hook = MySqlHook(mysql_conn_id="my_sql")
-    result = mysql_hook.get_first(query)
-    if result[0] > 0:
-        return "mysql_task_5_execute_next"
-    else:
-        return "mysql_task_5_no_records_task"
+    WHERE SFCA.film_id BETWEEN %(lo)s AND %(hi)s"""
 
-# Task to check records and decide which task to execute next
-mysql_task_5_check_records_task = BranchPythonOperator(
-    task_id="mysql_task_5_check_records_task",
-    python_callable=check_records_task_5,
-    trigger_rule='one_success',
-    dag=dag
-)
-# Task to execute the next query if there are records
-mysql_task_5_execute_next = MySqlOperator(
-    task_id="mysql_task_5_execute_next",
-    sql=task_5_query,
-    mysql_conn_id="my_sql",
-    dag=dag
-)
-# Task to handle the case when no records are found
-mysql_task_5_no_records_task = DummyOperator(task_id="mysql_task_5_no_records_task", dag=dag)
+task_5_bridge_star_query = """
+    SELECT DFIL.film_id, BFC.category_id, BFC.category_name, BFC.last_update
+    FROM sakila_star.bridge_film_category AS BFC
+    INNER JOIN sakila_star.dim_film AS DFIL ON DFIL.film_key = BFC.film_key
+    WHERE DFIL.film_id BETWEEN %(lo)s AND %(hi)s"""
+
+task_5_load = load_spec('mysql_task_5_execute_next', 'dim_film', ['film_id'], task_5_columns,
+                        task_5_query, task_5_sources, task_5_transfer, after_publish=task_5_bridge_queries,
+                        surrogate_key='film_key', side_tables=['bridge_film_category'],
+                        reconcile=[reconcile_spec(task_5_reconcile_query, ('sakila.film', 'film_id')),
+                                   reconcile_spec(task_5_bridge_reconcile_query, ('sakila.film_category', 'film_id'),
+                                                  table='bridge_film_category',
+                                                  columns=['film_id', 'category_id', 'category_name', 'last_update'],
+                                                  star_query=task_5_bridge_star_query,
+                                                  star_keys=('sakila_star.dim_film', 'film_id'))])
 
-# Task 6 - Final Task: Insert New Yesterday Data From Sakila Database to Sakila_Star Database Fact Rental Transaction Table
+# Task 6 - Final Task: Insert New Data Since The Last Load From Sakila Database to Sakila_Star Database Fact Rental Transaction Table
 task_6_query = """
-INSERT INTO sakila_star.fact_transaction(transaction_key,rental_id,rental_last_update,customer_key,
+INSERT INTO sakila_star.stg_fact_transaction(rental_id,rental_last_update,customer_key,
                                  staff_key,film_key,store_key,inventory_id,rental_date,return_date,
                                  payment_id,payment_date,payment_amount)
-SELECT NULL, SREN.rental_id, SREN.last_update, DCUS.customer_key, DSTA.staff_key, DFIL.film_key, DSTO.store_key,
+SELECT SREN.rental_id, SREN.last_update, DCUS.customer_key, DSTA.staff_key, DFIL.film_key, DSTO.store_key,
 SREN.inventory_id, SREN.rental_date, SREN.return_date, SPAY.payment_id, SPAY.payment_date, SPAY.amount
 FROM sakila.rental AS SREN
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'fact_transaction' AND CHG.natural_id = SREN.rental_id
 INNER JOIN sakila_star.dim_customer AS DCUS ON SREN.customer_id = DCUS.customer_id
 INNER JOIN sakila_star.dim_staff AS DSTA ON SREN.staff_id = DSTA.staff_id
 INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
 INNER JOIN sakila_star.dim_film AS DFIL ON SINV.film_id = DFIL.film_id
 INNER JOIN sakila_star.dim_store AS DSTO ON SINV.store_id = DSTO.store_id
 INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id
-WHERE DATE(SREN.last_update) = '{ysd}'
+WHERE CHG.natural_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s
 ON DUPLICATE KEY UPDATE
-    rental_id = SREN.rental_id,
     rental_last_update = SREN.last_update,
     customer_key = DCUS.customer_key,
     staff_key = DSTA.staff_key,
@@ -497,57 +1751,1009 @@ ON DUPLICATE KEY UPDATE
     inventory_id = SREN.inventory_id,
     rental_date = SREN.rental_date,
     return_date = SREN.return_date,
-    payment_id = SPAY.payment_id,
     payment_date = SPAY.payment_date,
-    payment_amount = SPAY.amount;""".format(ysd=str_yesterday)
+    payment_amount = SPAY.amount"""
 
-def check_records_task_6():
-    # Your SQL query to count records
-    query = """
-    SELECT COUNT(*)
+# Stale fact rows of the changed rentals, deleted before the publish
+# rental_date is part of the unique key (the partitioning column has to be), so a corrected rental_date would
+# insert a second row for the same rental and payment next to the old one instead of updating it.
+# The fact rows of a changed rental that the staging table no longer has with the same payment and rental_date
+# (a moved rental_date, a deleted payment) are deleted first, the other rows keep their transaction_key
+task_6_stale_query = """
+DELETE FT
+FROM sakila_star.fact_transaction AS FT
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.target_table = 'fact_transaction' AND CHG.natural_id = FT.rental_id
+LEFT JOIN sakila_star.{staging_table} AS STG
+    ON STG.rental_id = FT.rental_id AND STG.payment_id <=> FT.payment_id AND STG.rental_date = FT.rental_date
+WHERE STG.rental_id IS NULL{key_range}"""
+
+# Customers of the live fact rows of the changed rentals, collected for the mart before the publish
+# A rental moved to another customer, or deleted with the stale rows, leaves the mart row of its previous customer
+# stale too, and after the publish the fact table only knows the new customer, see refresh_customer_features
+task_6_previous_customers_query = """
+INSERT IGNORE INTO sakila_star.etl_changed_keys(target_table, natural_id)
+SELECT DISTINCT 'mart_customer_features', FT.customer_key
+FROM sakila_star.fact_transaction AS FT
+INNER JOIN sakila_star.etl_changed_keys AS CHG ON CHG.natural_id = FT.rental_id
+WHERE CHG.target_table = 'fact_transaction'{key_range}"""
+
+# Change sources of task 6, the driving table and every lookup table its columns are copied from
+# A new or corrected payment and an inventory item moved to another store change the fact rows of their rentals
+# without touching the rental row, so the changed rental_ids are the union of the rental, payment and inventory
+# change windows (etl_changed_keys keeps every rental_id once) and only those facts are upserted
+task_6_sources = [
+    change_source('rental', 'rental_id', """
+    SELECT SRC.rental_id AS natural_id
+    FROM sakila.rental AS SRC
+    WHERE {window}"""),
+    change_source('payment', 'payment_id', """
+    SELECT SRC.rental_id AS natural_id
+    FROM sakila.payment AS SRC
+    WHERE {window}
+    AND SRC.rental_id IS NOT NULL"""),
+    change_source('inventory', 'inventory_id', """
+    SELECT SREN.rental_id AS natural_id
+    FROM sakila.inventory AS SRC
+    INNER JOIN sakila.rental AS SREN ON SREN.inventory_id = SRC.inventory_id
+    WHERE {window}"""),
+]
+
+# Transfer spec of task 6, the rows travel with the natural ids of the dimensions
+# and get their surrogate keys on the target server, where the dimensions are
+task_6_transfer = transfer_spec("""
+SELECT SREN.rental_id, SREN.last_update, SREN.customer_id, SREN.staff_id, SINV.film_id, SINV.store_id,
+SREN.inventory_id, SREN.rental_date, SREN.return_date, SPAY.payment_id, SPAY.payment_date, SPAY.amount
+FROM sakila.rental AS SREN
+INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
+INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id
+WHERE SREN.rental_id IN %(keys)s""",
+    'transfer_fact_transaction',
+    ['rental_id', 'rental_last_update', 'customer_id', 'staff_id', 'film_id', 'store_id', 'inventory_id',
+     'rental_date', 'return_date', 'payment_id', 'payment_date', 'payment_amount'],
+    """
+INSERT INTO sakila_star.fact_transaction(rental_id,rental_last_update,customer_key,
+                                 staff_key,film_key,store_key,inventory_id,rental_date,return_date,
+                                 payment_id,payment_date,payment_amount)
+SELECT STG.rental_id, STG.rental_last_update, DCUS.customer_key, DSTA.staff_key, DFIL.film_key, DSTO.store_key,
+STG.inventory_id, STG.rental_date, STG.return_date, STG.payment_id, STG.payment_date, STG.payment_amount
+FROM sakila_star.transfer_fact_transaction AS STG
+INNER JOIN sakila_star.dim_customer AS DCUS ON STG.customer_id = DCUS.customer_id
+INNER JOIN sakila_star.dim_staff AS DSTA ON STG.staff_id = DSTA.staff_id
+INNER JOIN sakila_star.dim_film AS DFIL ON STG.film_id = DFIL.film_id
+INNER JOIN sakila_star.dim_store AS DSTO ON STG.store_id = DSTO.store_id
+ON DUPLICATE KEY UPDATE
+    rental_last_update = VALUES(rental_last_update),
+    customer_key = VALUES(customer_key),
+    staff_key = VALUES(staff_key),
+    film_key = VALUES(film_key),
+    store_key = VALUES(store_key),
+    inventory_id = VALUES(inventory_id),
+    rental_date = VALUES(rental_date),
+    return_date = VALUES(return_date),
+    payment_date = VALUES(payment_date),
+    payment_amount = VALUES(payment_amount)""",
+    staging_ddl="""
+CREATE TEMPORARY TABLE sakila_star.transfer_fact_transaction (
+    `rental_id` INT(12) NOT NULL,
+    `rental_last_update` DATETIME NOT NULL,
+    `customer_id` INT(8) NOT NULL,
+    `staff_id` INT(8) NOT NULL,
+    `film_id` INT(8) NOT NULL,
+    `store_id` INT(8) NOT NULL,
+    `inventory_id` INT(8) NOT NULL,
+    `rental_date` DATETIME NOT NULL,
+    `return_date` DATETIME NULL DEFAULT NULL,
+    `payment_id` INT(12) NULL DEFAULT NULL,
+    `payment_date` DATETIME NOT NULL,
+    `payment_amount` DECIMAL(5,2) NULL DEFAULT NULL)""",
+    before_merge=[task_6_previous_customers_query, task_6_stale_query])
+
+task_6_columns = ['rental_id', 'rental_last_update', 'customer_key', 'staff_key', 'film_key', 'store_key',
+                  'inventory_id', 'rental_date', 'return_date', 'payment_id', 'payment_date', 'payment_amount']
+# Rows of task 6 in both databases for the reconciliation, with the natural ids of the dimensions
+# like the transfer, a differing rental is deleted before it is loaded again
+task_6_reconcile_query = """
+    SELECT SREN.rental_id, SREN.last_update, SREN.customer_id, SREN.staff_id, SINV.film_id, SINV.store_id,
+    SREN.inventory_id, SREN.rental_date, SREN.return_date, SPAY.payment_id, SPAY.payment_date, SPAY.amount
     FROM sakila.rental AS SREN
-    INNER JOIN sakila_star.dim_customer AS DCUS ON SREN.customer_id = DCUS.customer_id
-    INNER JOIN sakila_star.dim_staff AS DSTA ON SREN.staff_id = DSTA.staff_id
     INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
-    INNER JOIN sakila_star.dim_film AS DFIL ON SINV.film_id = DFIL.film_id
-    INNER JOIN sakila_star.dim_store AS DSTO ON SINV.store_id = DSTO.store_id
     INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id
-    WHERE DATE(SREN.last_update) = '{ysd}'
-    """.format(ysd=str_yesterday)
-    # Execute the query and return the branch task ID based on the result
-    mysql_hook = MySqlHook(mysql_conn_id="my_sql")
-    result = mysql_hook.get_first(query)
-    if result[0] > 0:
-        return "mysql_task_6_execute_next"
+    WHERE SREN.rental_id BETWEEN %(lo)s AND %(hi)s"""
+
+task_6_reconcile_star_query = """
+    SELECT FT.rental_id, FT.rental_last_update, DCUS.customer_id, DSTA.staff_id, DFIL.film_id, DSTO.store_id,
+    FT.inventory_id, FT.rental_date, FT.return_date, FT.payment_id, FT.payment_date, FT.payment_amount
+    FROM sakila_star.fact_transaction AS FT
+    INNER JOIN sakila_star.dim_customer AS DCUS ON FT.customer_key = DCUS.customer_key
+    INNER JOIN sakila_star.dim_staff AS DSTA ON FT.staff_key = DSTA.staff_key
+    INNER JOIN sakila_star.dim_film AS DFIL ON FT.film_key = DFIL.film_key
+    INNER JOIN sakila_star.dim_store AS DSTO ON FT.store_key = DSTO.store_key
+    WHERE FT.rental_id BETWEEN %(lo)s AND %(hi)s"""
+
+task_6_load = load_spec('mysql_task_6_execute_next', 'fact_transaction', ['rental_id', 'payment_id'], task_6_columns,
+                        task_6_query, task_6_sources, task_6_transfer, python_callable=load_fact_table,
+                        before_publish=[task_6_previous_customers_query, task_6_stale_query],
+                        reconcile=[reconcile_spec(task_6_reconcile_query, ('sakila.rental', 'rental_id'),
+                                                  columns=task_6_transfer['columns'],
+                                                  star_query=task_6_reconcile_star_query,
+                                                  repair_delete_query=
+                                                  "DELETE FROM sakila_star.fact_transaction WHERE rental_id IN %(keys)s")],
+                        # Wait for all four dimension loads, a dimension without records ends as skipped which is fine
+                        # but any failure is not
+                        trigger_rule='none_failed')
+
+# The load tasks, built from their specs, the four dimensions load in parallel and the fact table after them
+DIMENSION_LOAD_SPECS = [task_2_load, task_3_load, task_4_load, task_5_load]
+LOAD_SPECS = DIMENSION_LOAD_SPECS + [task_6_load]
+# Every star table the loads write, each load table followed by its side tables
+STAR_TABLES = [table for spec in LOAD_SPECS for table in [spec['table']] + spec['side_tables']]
+# Natural id -> surrogate key maps of the dimensions the fact table points at, in the order of the fact columns
+# (fact_extract_query returns their natural ids in the same order)
+# (dimension table, natural id column, surrogate key column, task that loads the dimension)
+FACT_DIMENSIONS = sorted([(spec['table'], spec['natural_key'][0], spec['surrogate_key'], spec['task_id'])
+                          for spec in DIMENSION_LOAD_SPECS], key=lambda dimension: task_6_columns.index(dimension[2]))
+dimension_load_tasks = [load_operator(spec) for spec in DIMENSION_LOAD_SPECS]
+fact_load_task = load_operator(task_6_load)
+
+# Consolidated execution mode
+# For small daily deltas the task startups and connection handshakes take longer than the SQL itself.
+# With execution_mode "consolidated" the branch below skips the five load tasks and one task runs the same loads
+# over one connection instead, in one transaction per stage: the four dimensions, then the fact table.
+# The build statements of the changed dimensions go to the server as one multi-statement batch, their publish
+# statements as a second one, so a stage costs a handful of round trips whatever the number of tables.
+# The fact stage always runs as one statement ("single"), chunked and keycache loads need their own connections.
+# Consolidated mode needs load_mode "local", with "transfer" the branch keeps the load tasks
+CONSOLIDATED_STAGES = [
+    ('load_consolidated.dimensions', DIMENSION_LOAD_SPECS),
+    ('load_consolidated.fact', [task_6_load]),
+]
+
+def choose_execution_mode(params, **context):
+    if params['execution_mode'] in ('consolidated', 'bootstrap'):
+        if params['load_mode'] == 'local':
+            return 'load_consolidated' if params['execution_mode'] == 'consolidated' else 'bootstrap_star_schema'
+        logging.warning('execution_mode %s needs load_mode local, running the load tasks', params['execution_mode'])
+    return [spec['task_id'] for spec in LOAD_SPECS]
+
+# Load the tables of one stage in one transaction, logged in etl_run_log under the stage id
+def load_stage(conn, cursor, stage_id, specs, data_interval_end, params, run_id):
+    loads = [render_load(spec['table']) for spec in specs]
+    metrics = start_metrics(cursor)
+    with timed_phase(metrics, 'probe'):
+        for load in loads:
+            truncate_staging(cursor, load['table'])
+        changes = [collect_changes(cursor, load['table'], load['sources'], data_interval_end, params) for load in loads]
+    counts = dict((load['table'], dict(NO_RECORDS)) for load in loads)
+    changed = [load for load, (_, changed_keys) in zip(loads, changes) if changed_keys]
+    built = published = []
+    if len(changed) == 1:
+        # A single build statement may take the key range parameters of the fact query
+        with timed_phase(metrics, 'extract'):
+            built = [run_upsert(conn, cursor, changed[0]['query'], FULL_KEY_RANGE)]
+        with timed_phase(metrics, 'load'):
+            for before_query in changed[0]['before_publish']:
+                cursor.execute(before_query, FULL_KEY_RANGE)
+            published = [run_upsert(conn, cursor, changed[0]['publish_query'], None)]
+    elif changed:
+        with timed_phase(metrics, 'extract'):
+            built = run_upsert_batch(conn, cursor, [load['query'] for load in changed])
+        with timed_phase(metrics, 'load'):
+            for load in changed:
+                for before_query in load['before_publish']:
+                    cursor.execute(before_query, FULL_KEY_RANGE)
+            published = run_upsert_batch(conn, cursor, [load['publish_query'] for load in changed])
+    for load, build, publish in zip(changed, built, published):
+        counts[load['table']]['staged'] = build['records']
+        counts[load['table']].update(publish)
+    with timed_phase(metrics, 'load'):
+        for load in changed:
+            for after_query in load['after_publish']:
+                cursor.execute(after_query)
+        for load, (high_marks, _) in zip(loads, changes):
+            write_watermarks(cursor, load['table'], high_marks)
+    stage_counts = dict((name, sum(table_counts[name] for table_counts in counts.values())) for name in NO_RECORDS)
+    commit_load(conn, cursor, metrics, run_id, stage_id, ",".join(load['table'] for load in loads), stage_counts)
+    for load, (_, changed_keys) in zip(loads, changes):
+        counts[load['table']]['changed_keys'] = changed_keys
+    return counts, stage_counts, metrics
+
+def load_consolidated(data_interval_end, params, ti, run_id, **context):
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    conn = mysql_hook.get_conn()
+    table_counts = {}
+    stage_counts = {}
+    stage_metrics = {}
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        for stage_id, specs in CONSOLIDATED_STAGES:
+            counts, stage_counts[stage_id], metrics = load_stage(conn, cursor, stage_id, specs, data_interval_end,
+                                                                 params, run_id)
+            table_counts.update(counts)
+            stage_metrics[stage_id] = {
+                'phases': metrics['phases'],
+                'rows_examined': metrics['rows_examined'],
+                'duration_seconds': metrics['duration_seconds'],
+                'rows_examined_per_affected': metrics['rows_examined'] / max(stage_counts[stage_id]['affected'], 1),
+            }
+        cursor.close()
+    finally:
+        conn.close()
+    ti.xcom_push(key='table_counts', value=table_counts)
+    ti.xcom_push(key='stage_counts', value=stage_counts)
+    ti.xcom_push(key='stage_metrics', value=stage_metrics)
+    logging.info('consolidated load: %s, %s', table_counts, stage_metrics)
+    if not any(counts['affected'] for counts in table_counts.values()):
+        raise AirflowSkipException('No changed records in the change window')
+    return stage_counts
+
+mysql_task_1_choose_mode = BranchPythonOperator(
+    task_id="choose_execution_mode",
+    python_callable=choose_execution_mode,
+    dag=dag
+)
+
+mysql_task_consolidated = PythonOperator(
+    task_id="load_consolidated",
+    python_callable=load_consolidated,
+    dag=dag
+)
+
+# Task 6b: Reconcile Sakila_Star Against Sakila With Chunked Checksums
+# Instead of running Script-Transforming-Sakila-To-Star-Scheme-Databases.sql again to be sure sakila_star still matches
+# sakila, every dimension, the film category bridge and the fact table are split into ranges of reconcile_chunk_size
+# natural ids. Both servers hash every range themselves, COUNT(*) and BIT_XOR of the CRC32 of every row (independent
+# of the row order), and only the two numbers travel. A range whose hashes differ is split in halves until it is at
+# most reconcile_leaf_size ids wide, then the hashes per natural id name the rows that differ. So the clean ranges
+# cost one hash query per side, and the narrowing and the repair only follow the drift.
+# The differing natural ids are upserted again through the load of their table (the bridge through dim_film),
+# the fact rows of a differing rental are deleted before the publish, so a payment that is gone or a rental_date that moved to
+# another partition does not leave a row behind. Dimension rows that only exist in sakila_star stay, the facts point
+# at them, they are only counted. The repaired ids are added to etl_changed_keys, so the mart refreshes their customers.
+# After every hash query the task sleeps reconcile_sleep_factor times the time the query took, so the check can run
+# next to the business traffic, and it only runs when the reconcile param is set
+# The reconciliation specs are declared with the loads (see reconcile_spec), the dimensions come first
+RECONCILE_SPECS = [reconcile for spec in LOAD_SPECS for reconcile in spec['reconcile']]
+
+# Hash query of a range, COUNT(*) and BIT_XOR of the row CRC32s, per natural id when by_key is set
+# (NULL is hashed as a marker, CONCAT_WS would skip it and shift the other columns)
+def reconcile_hash_query(spec, row_query, by_key):
+    row_hash = "CRC32(CONCAT_WS('|', {values}))".format(
+        values=', '.join("COALESCE(R.{column}, '<null>')".format(column=column) for column in spec['columns']))
+    if by_key:
+        return "SELECT R.{key}, COUNT(*), BIT_XOR({row_hash}) FROM ({rows}) AS R ({columns}) GROUP BY R.{key}".format(
+            key=spec['key_column'], row_hash=row_hash, rows=row_query, columns=', '.join(spec['columns']))
+    return "SELECT COUNT(*), BIT_XOR({row_hash}) FROM ({rows}) AS R ({columns})".format(
+        row_hash=row_hash, rows=row_query, columns=', '.join(spec['columns']))
+
+# Run one reconciliation query and sleep sleep_factor times the time it took
+def throttled_fetch(cursor, query, parameters, sleep_factor):
+    start = time.time()
+    cursor.execute(query, parameters)
+    rows = cursor.fetchall()
+    time.sleep((time.time() - start) * sleep_factor)
+    return rows
+
+# Compare one table over all its ranges, returns the natural ids that differ
+# and the ones that only exist in sakila_star, with the number of ranges checked and mismatched
+def reconcile_table(source_cursor, target_cursor, spec, params):
+    sleep_factor = float(params['reconcile_sleep_factor'])
+    bounds = []
+    for cursor, (table, column) in ((source_cursor, spec['source_keys']), (target_cursor, spec['star_keys'])):
+        cursor.execute("SELECT MIN({column}), MAX({column}) FROM {table}".format(column=column, table=table))
+        bounds.append(cursor.fetchone())
+    lows = [low for low, _ in bounds if low is not None]
+    highs = [high for _, high in bounds if high is not None]
+    stats = {'ranges_checked': 0, 'ranges_mismatched': 0}
+    if not lows:
+        return [], [], stats
+    chunk_size = int(params['reconcile_chunk_size'])
+    pending = [(low, min(low + chunk_size - 1, max(highs))) for low in range(min(lows), max(highs) + 1, chunk_size)]
+    star_query = spec['star_query'] or star_rows_query(spec['table'], spec['columns'], spec['key_column'])
+    queries = [(source_cursor, spec['source_query']), (target_cursor, star_query)]
+    differing = []
+    star_only = []
+    while pending:
+        low, high = pending.pop()
+        key_range = {'lo': low, 'hi': high}
+        stats['ranges_checked'] += 1
+        source_hash, star_hash = [throttled_fetch(cursor, reconcile_hash_query(spec, query, False), key_range, sleep_factor)
+                                  for cursor, query in queries]
+        if source_hash == star_hash:
+            continue
+        stats['ranges_mismatched'] += 1
+        if high - low >= int(params['reconcile_leaf_size']):
+            middle = (low + high) // 2
+            pending += [(low, middle), (middle + 1, high)]
+            continue
+        source_keys, star_keys = [dict((row[0], row[1:]) for row in throttled_fetch(
+            cursor, reconcile_hash_query(spec, query, True), key_range, sleep_factor)) for cursor, query in queries]
+        differing += [key for key in source_keys if source_keys[key] != star_keys.get(key)]
+        star_only += [key for key in star_keys if key not in source_keys]
+    return sorted(differing), sorted(star_only), stats
+
+# Delete the star rows of the natural ids keys with delete_query, transfer_batch_size ids per statement
+def delete_keys(cursor, delete_query, keys, params):
+    batch_size = int(params['transfer_batch_size'])
+    for i in range(0, len(keys), batch_size):
+        cursor.execute(delete_query, {'keys': tuple(keys[i:i + batch_size])})
+
+# Upsert the natural ids keys of one table again through its load, in one transaction logged under task_id
+# The keys join the ids this run already loaded in etl_changed_keys and the build takes all of them, so the
+# before_publish queries (the previous customers of the facts for the mart) run before delete_query removes the rows
+def repair_table(source_conn, target_conn, load, keys, delete_query, params, run_id, task_id):
+    table = load['table']
+    target_cursor = target_conn.cursor()
+    if params['load_mode'] != 'transfer':
+        truncate_staging(target_cursor, table)
+    metrics = start_metrics(target_cursor)
+    with timed_phase(metrics, 'probe'):
+        target_cursor.executemany("""
+        INSERT IGNORE INTO sakila_star.etl_changed_keys(target_table, natural_id)
+        VALUES (%s, %s)
+        """, [(table, key) for key in keys])
+        target_cursor.execute("""
+        SELECT natural_id FROM sakila_star.etl_changed_keys WHERE target_table = %s ORDER BY natural_id
+        """, (table,))
+        changed = [row[0] for row in target_cursor.fetchall()]
+    if params['load_mode'] == 'transfer':
+        # The transfer also takes the ids this run already loaded, they come out unchanged
+        counts = transfer_rows(source_conn, target_conn, target_cursor, table, load['transfer'], changed, params, metrics,
+                               delete_query, keys)
+    else:
+        counts = dict(NO_RECORDS)
+        # The build also takes the ids this run already loaded, they come out unchanged
+        with timed_phase(metrics, 'extract'):
+            counts['staged'] = run_upsert(target_conn, target_cursor, load['query'], FULL_KEY_RANGE)['records']
+        with timed_phase(metrics, 'load'):
+            for before_query in load['before_publish']:
+                target_cursor.execute(before_query, FULL_KEY_RANGE)
+            if delete_query:
+                delete_keys(target_cursor, delete_query, keys, params)
+            counts.update(run_upsert(target_conn, target_cursor, load['publish_query'], None))
+            for after_query in load['after_publish']:
+                target_cursor.execute(after_query)
+    commit_load(target_conn, target_cursor, metrics, run_id, task_id, table, counts)
+    target_cursor.close()
+    return counts
+
+def reconcile_star_schema(params, ti, run_id, **context):
+    if not params['reconcile']:
+        raise AirflowSkipException('Reconciliation is off, set the reconcile param to run it')
+    source_conn = MySqlHook(mysql_conn_id=SOURCE_CONN_ID).get_conn()
+    target_conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+    table_counts = {}
+    repairs = {}
+    try:
+        source_cursor = source_conn.cursor()
+        target_cursor = target_conn.cursor()
+        # Every hash query reads its own fresh snapshot, so the reconciliation does not hold one REPEATABLE READ
+        # snapshot on the OLTP database (and keep its undo history from being purged) from its first range to its last
+        for cursor in (source_cursor, target_cursor):
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        for spec in RECONCILE_SPECS:
+            differing, star_only, stats = reconcile_table(source_cursor, target_cursor, spec, params)
+            table_counts[spec['table']] = dict(stats, differing=len(differing), star_only=len(star_only))
+            if star_only and not spec['repair_delete_query']:
+                logging.warning('%s: natural ids only in sakila_star, kept: %s', spec['table'], star_only[:100])
+                star_only = []
+            if differing or star_only:
+                repair = repairs.setdefault(spec['repair_table'], {
+                    'load': render_load(spec['repair_table']), 'delete_query': spec['repair_delete_query'],
+                    'keys': set()})
+                repair['keys'] |= set(differing) | set(star_only)
+        source_cursor.close()
+        target_cursor.close()
+        # RECONCILE_SPECS lists the dimensions first, so the repaired facts find the repaired dimension rows
+        for repair in repairs.values():
+            table = repair['load']['table']
+            counts = repair_table(source_conn, target_conn, repair['load'], sorted(repair['keys']), repair['delete_query'],
+                                  params, run_id, 'reconcile_star_schema.' + table)
+            table_counts[table]['repaired'] = counts
+    finally:
+        source_conn.close()
+        target_conn.close()
+    ti.xcom_push(key='reconcile_counts', value=table_counts)
+    logging.info('reconciliation: %s', table_counts)
+    return table_counts
+
+mysql_task_6_reconcile = PythonOperator(
+    task_id="reconcile_star_schema",
+    python_callable=reconcile_star_schema,
+    # Runs after the loads whether they loaded records or ended as skipped
+    trigger_rule='none_failed',
+    dag=dag
+)
+
+# Task 6c: Bootstrap Sakila_Star From Scratch In Parallel Resumable Chunks
+# With execution_mode "bootstrap" the branch skips the daily loads and this task builds the star schema the way
+# Script-Transforming-Sakila-To-Star-Scheme-Databases.sql does, for new environments and disaster recovery:
+# - the watermarks of every daily load are set to the source rows before data_interval_end, once, before any row
+#   is loaded, so whatever changes during the bootstrap is picked up again by the next daily run
+# - the non-unique secondary indexes of the star tables are dropped (their definitions are kept in
+#   etl_bootstrap_index first), the unique natural keys stay since the upserts rely on them
+#   (the star tables have no foreign keys, the partitioned fact table can not have any)
+# - the four dimensions, then the film category bridge and the fact table are loaded in ranges of
+#   bootstrap_chunk_size source ids by bootstrap_workers connections in parallel, every range upserts and
+#   records itself in etl_bootstrap_checkpoint in one transaction
+# - the dropped indexes are added again, one ALTER TABLE per table, and the checkpoints are cleared
+# A failed bootstrap is simply run again, it skips the checkpointed ranges and the indexes it already dropped.
+# bootstrap_restart empties the star tables and the checkpoints first. Bootstrap needs load_mode "local"
+
+# Upsert of one range of source ids from the rows a reconciliation spec reads from sakila
+def bootstrap_insert_query(table, columns, rows_query, natural_key):
+    return """
+    INSERT INTO sakila_star.{table}({columns})
+    {rows_query}
+    ON DUPLICATE KEY UPDATE
+        {updates}""".format(
+        table=table,
+        columns=', '.join(columns),
+        rows_query=rows_query.strip(),
+        updates=',\n        '.join('{column} = VALUES({column})'.format(column=column)
+                                    for column in columns if column not in natural_key))
+
+bootstrap_bridge_query = """
+INSERT INTO sakila_star.bridge_film_category(film_key, category_id, category_name, last_update)
+SELECT DFIL.film_key, SFCA.category_id, SCAT.name, GREATEST(SFCA.last_update, SCAT.last_update)
+FROM sakila.film_category AS SFCA
+INNER JOIN sakila_star.dim_film AS DFIL ON DFIL.film_id = SFCA.film_id
+INNER JOIN sakila.category AS SCAT ON SFCA.category_id = SCAT.category_id
+WHERE SFCA.film_id BETWEEN %(lo)s AND %(hi)s
+ON DUPLICATE KEY UPDATE
+    category_name = VALUES(category_name),
+    last_update = VALUES(last_update)"""
+
+bootstrap_fact_query = """
+INSERT INTO sakila_star.fact_transaction(rental_id,rental_last_update,customer_key,
+                                 staff_key,film_key,store_key,inventory_id,rental_date,return_date,
+                                 payment_id,payment_date,payment_amount)
+SELECT SREN.rental_id, SREN.last_update, DCUS.customer_key, DSTA.staff_key, DFIL.film_key, DSTO.store_key,
+SREN.inventory_id, SREN.rental_date, SREN.return_date, SPAY.payment_id, SPAY.payment_date, SPAY.amount
+FROM sakila.rental AS SREN
+INNER JOIN sakila_star.dim_customer AS DCUS ON SREN.customer_id = DCUS.customer_id
+INNER JOIN sakila_star.dim_staff AS DSTA ON SREN.staff_id = DSTA.staff_id
+INNER JOIN sakila.inventory AS SINV ON SREN.inventory_id = SINV.inventory_id
+INNER JOIN sakila_star.dim_film AS DFIL ON SINV.film_id = DFIL.film_id
+INNER JOIN sakila_star.dim_store AS DSTO ON SINV.store_id = DSTO.store_id
+INNER JOIN sakila.payment AS SPAY ON SREN.rental_id = SPAY.rental_id
+WHERE SREN.rental_id BETWEEN %(lo)s AND %(hi)s
+ON DUPLICATE KEY UPDATE
+    rental_last_update = VALUES(rental_last_update),
+    customer_key = VALUES(customer_key),
+    staff_key = VALUES(staff_key),
+    film_key = VALUES(film_key),
+    store_key = VALUES(store_key),
+    inventory_id = VALUES(inventory_id),
+    rental_date = VALUES(rental_date),
+    return_date = VALUES(return_date),
+    payment_date = VALUES(payment_date),
+    payment_amount = VALUES(payment_amount)"""
+
+# Stages of the bootstrap, the tables of a stage load in parallel, a stage starts when the one before it is done
+# (table, upsert of a range of source ids, (source table, source id column) the ranges split),
+# rendered when the bootstrap runs
+def bootstrap_stages():
+    return [
+        [(reconcile['table'], bootstrap_insert_query(reconcile['table'], reconcile['columns'], reconcile['source_query'],
+                                                     [reconcile['key_column']]), reconcile['source_keys'])
+         for spec in DIMENSION_LOAD_SPECS for reconcile in spec['reconcile'] if reconcile['table'] == spec['table']],
+        [('bridge_film_category', bootstrap_bridge_query, ('sakila.film_category', 'film_id')),
+         ('fact_transaction', bootstrap_fact_query, ('sakila.rental', 'rental_id'))],
+    ]
+
+# Set the watermarks of every daily load to its source rows before data_interval_end, once per bootstrap
+# (a checkpoint with target_table 'etl_watermark' records that it is done)
+def bootstrap_watermarks(conn, cursor, data_interval_end, params):
+    cursor.execute("SELECT COUNT(*) FROM sakila_star.etl_bootstrap_checkpoint WHERE target_table = 'etl_watermark'")
+    if cursor.fetchone()[0]:
+        return
+    window = change_window(DEFAULT_WATERMARK, window_end(cursor, data_interval_end, params), 0)
+    for spec in LOAD_SPECS:
+        for source in render_load(spec['table'])['sources']:
+            high_mark = read_high_mark(cursor, source['source'], source['id_column'], window)
+            if high_mark is not None:
+                write_watermark(cursor, spec['table'], source['source'], high_mark)
+    cursor.execute("""
+    INSERT INTO sakila_star.etl_bootstrap_checkpoint(target_table, chunk_lo, chunk_hi, records, finished_at)
+    VALUES ('etl_watermark', 0, 0, 0, NOW())
+    """)
+    conn.commit()
+
+# Keep the definitions of the non-unique secondary indexes of the star tables and drop them
+def drop_secondary_indexes(cursor):
+    cursor.execute("""
+    INSERT IGNORE INTO sakila_star.etl_bootstrap_index(target_table, index_name, index_columns)
+    SELECT TABLE_NAME, INDEX_NAME, GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX SEPARATOR ', ')
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = 'sakila_star' AND TABLE_NAME IN %(tables)s AND NON_UNIQUE = 1
+    GROUP BY TABLE_NAME, INDEX_NAME
+    """, {'tables': tuple(STAR_TABLES)})
+    for table in STAR_TABLES:
+        cursor.execute("""
+        SELECT BI.index_name
+        FROM sakila_star.etl_bootstrap_index AS BI
+        INNER JOIN information_schema.STATISTICS AS ST
+            ON ST.TABLE_SCHEMA = 'sakila_star' AND ST.TABLE_NAME = BI.target_table AND ST.INDEX_NAME = BI.index_name
+            AND ST.SEQ_IN_INDEX = 1
+        WHERE BI.target_table = %s
+        """, (table,))
+        indexes = [row[0] for row in cursor.fetchall()]
+        if indexes:
+            cursor.execute("ALTER TABLE sakila_star.{table} {drops}".format(
+                table=table, drops=', '.join('DROP INDEX `{name}`'.format(name=name) for name in indexes)))
+
+# Add the kept secondary indexes back, one ALTER TABLE per table so every table is read once
+def rebuild_secondary_indexes(cursor):
+    for table in STAR_TABLES:
+        cursor.execute("""
+        SELECT BI.index_name, BI.index_columns
+        FROM sakila_star.etl_bootstrap_index AS BI
+        LEFT JOIN information_schema.STATISTICS AS ST
+            ON ST.TABLE_SCHEMA = 'sakila_star' AND ST.TABLE_NAME = BI.target_table AND ST.INDEX_NAME = BI.index_name
+            AND ST.SEQ_IN_INDEX = 1
+        WHERE BI.target_table = %s AND ST.INDEX_NAME IS NULL
+        """, (table,))
+        indexes = cursor.fetchall()
+        if indexes:
+            cursor.execute("ALTER TABLE sakila_star.{table} {adds}".format(
+                table=table, adds=', '.join('ADD INDEX `{name}` ({columns})'.format(name=name, columns=columns)
+                                            for name, columns in indexes)))
+        cursor.execute("DELETE FROM sakila_star.etl_bootstrap_index WHERE target_table = %s", (table,))
+
+# Ranges of chunk_size source ids of one table that have no checkpoint yet
+def pending_bootstrap_ranges(cursor, table, source_keys, chunk_size):
+    cursor.execute("SELECT MIN({column}), MAX({column}) FROM {source}".format(column=source_keys[1], source=source_keys[0]))
+    low, high = cursor.fetchone()
+    if low is None:
+        return []
+    cursor.execute("SELECT chunk_lo FROM sakila_star.etl_bootstrap_checkpoint WHERE target_table = %s", (table,))
+    done = {row[0] for row in cursor.fetchall()}
+    return [(start, min(start + chunk_size - 1, high)) for start in range(low, high + 1, chunk_size) if start not in done]
+
+# Upsert one range and record its checkpoint in the same transaction, over its own connection,
+# a range that hit a deadlock or a lost connection (also while connecting) is simply run again, like load_chunk
+def bootstrap_chunk(table, query, key_range):
+    for attempt in range(1, FACT_CHUNK_ATTEMPTS + 1):
+        conn = None
+        try:
+            conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+            cursor = conn.cursor()
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+            counts = run_upsert(conn, cursor, query, {'lo': key_range[0], 'hi': key_range[1]})
+            cursor.execute("""
+            INSERT INTO sakila_star.etl_bootstrap_checkpoint(target_table, chunk_lo, chunk_hi, records, finished_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            """, (table, key_range[0], key_range[1], counts['records']))
+            conn.commit()
+            cursor.close()
+            return counts
+        except Exception:
+            if conn is not None:
+                with contextlib.suppress(Exception):
+                    conn.rollback()
+            if attempt == FACT_CHUNK_ATTEMPTS:
+                raise
+            logging.warning('%s range %s: attempt %d failed, retrying', table, key_range, attempt, exc_info=True)
+            time.sleep(attempt * 5)
+        finally:
+            if conn is not None:
+                with contextlib.suppress(Exception):
+                    conn.close()
+
+def bootstrap_star_schema(data_interval_end, params, ti, run_id, **context):
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    conn = mysql_hook.get_conn()
+    table_counts = dict((table, dict(NO_RECORDS, chunks=0)) for table in STAR_TABLES)
+    try:
+        cursor = conn.cursor()
+        # READ COMMITTED, so the checkpoints and dimension rows the chunk connections commit are seen right away
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        if params['bootstrap_restart']:
+            cursor.execute("DELETE FROM sakila_star.etl_bootstrap_checkpoint")
+            conn.commit()
+            for table in STAR_TABLES + ['mart_customer_features']:
+                cursor.execute("TRUNCATE TABLE sakila_star.{table}".format(table=table))
+        metrics = start_metrics(cursor)
+        with timed_phase(metrics, 'probe'):
+            bootstrap_watermarks(conn, cursor, data_interval_end, params)
+            drop_secondary_indexes(cursor)
+        chunk_size = int(params['bootstrap_chunk_size'])
+        with timed_phase(metrics, 'load'):
+            for stage in bootstrap_stages():
+                chunks = [(table, query, key_range) for table, query, source_keys in stage
+                          for key_range in pending_bootstrap_ranges(cursor, table, source_keys, chunk_size)]
+                with ThreadPoolExecutor(max_workers=int(params['bootstrap_workers'])) as executor:
+                    for (table, _, _), counts in zip(chunks, executor.map(lambda chunk: bootstrap_chunk(*chunk), chunks)):
+                        for name in NO_RECORDS:
+                            table_counts[table][name] += counts[name]
+                        table_counts[table]['chunks'] += 1
+        with timed_phase(metrics, 'index'):
+            rebuild_secondary_indexes(cursor)
+        # Every customer of the bootstrapped star schema gets its mart row recomputed by refresh_customer_features
+        cursor.execute(mart_rebuild_keys_query)
+        cursor.execute("DELETE FROM sakila_star.etl_bootstrap_checkpoint")
+        counts = dict((name, sum(table[name] for table in table_counts.values())) for name in NO_RECORDS)
+        commit_load(conn, cursor, metrics, run_id, ti.task_id, ",".join(STAR_TABLES), counts)
+        cursor.close()
+    finally:
+        conn.close()
+    ti.xcom_push(key='table_counts', value=table_counts)
+    logging.info('bootstrap: %s', table_counts)
+    return table_counts
+
+mysql_task_bootstrap = PythonOperator(
+    task_id="bootstrap_star_schema",
+    python_callable=bootstrap_star_schema,
+    dag=dag
+)
+
+# Task 7: Refresh The Customer Feature Mart Of The ML Classification
+# mart_customer_features keeps per customer_key the transaction count and the sums of payment_amount, film_duration,
+# film_rental_rate and film_replacement_cost over the joined fact and film rows, with customer_active and country,
+# the averages of the notebook are the sums divided by transaction_count.
+# Only the customers the loads of this run touched are recomputed: customers whose dim_customer row changed,
+# customers of the changed rentals and customers who rented a changed film, all read from the natural keys
+# the loads left in etl_changed_keys. They are collected under target_table 'mart_customer_features' and their
+# mart rows are replaced in one transaction, so the cost follows the changed customers instead of all transactions.
+# The previous customers of the changed rentals are already there, the fact load collected them before its publish
+# (see task_6_previous_customers_query), so a rental that moved to another customer refreshes both mart rows.
+# The affected customers are committed before the mart rows are replaced and their keys are only removed in the
+# transaction of the refresh, so a failed refresh leaves them for the next run even after the next loads replaced
+# the keys of their own tables. A bootstrap marks every customer.
+# An empty mart, or the mart_rebuild param, recomputes every customer
+mart_affected_query = """
+INSERT IGNORE INTO sakila_star.etl_changed_keys(target_table, natural_id)
+SELECT 'mart_customer_features', AFFECTED.customer_key
+FROM (
+    SELECT DC.customer_key
+    FROM sakila_star.etl_changed_keys AS CHG
+    INNER JOIN sakila_star.dim_customer AS DC ON DC.customer_id = CHG.natural_id
+    WHERE CHG.target_table = 'dim_customer'
+    UNION
+    SELECT FT.customer_key
+    FROM sakila_star.etl_changed_keys AS CHG
+    INNER JOIN sakila_star.fact_transaction AS FT ON FT.rental_id = CHG.natural_id
+    WHERE CHG.target_table = 'fact_transaction'
+    UNION
+    SELECT FT.customer_key
+    FROM sakila_star.etl_changed_keys AS CHG
+    INNER JOIN sakila_star.dim_film AS DF ON DF.film_id = CHG.natural_id
+    INNER JOIN sakila_star.fact_transaction AS FT ON FT.film_key = DF.film_key
+    WHERE CHG.target_table = 'dim_film') AS AFFECTED
+"""
+
+mart_rebuild_keys_query = """
+INSERT IGNORE INTO sakila_star.etl_changed_keys(target_table, natural_id)
+SELECT 'mart_customer_features', DC.customer_key
+FROM sakila_star.dim_customer AS DC
+"""
+
+mart_delete_query = """
+DELETE MART FROM sakila_star.mart_customer_features AS MART
+INNER JOIN sakila_star.etl_changed_keys AS CHG
+    ON CHG.target_table = 'mart_customer_features' AND CHG.natural_id = MART.customer_key
+"""
+
+mart_insert_query = """
+INSERT INTO sakila_star.mart_customer_features(customer_key, customer_active, customer_country, transaction_count,
+                                               sum_payment_amount, sum_film_duration, sum_film_rental_rate,
+                                               sum_film_replacement_cost, updated_at)
+SELECT FT.customer_key, MAX(DC.customer_active), MAX(DC.customer_country), COUNT(*),
+       SUM(FT.payment_amount), SUM(DF.film_duration), SUM(DF.film_rental_rate),
+       SUM(DF.film_replacement_cost), NOW()
+FROM sakila_star.etl_changed_keys AS CHG
+INNER JOIN sakila_star.fact_transaction AS FT ON FT.customer_key = CHG.natural_id
+INNER JOIN sakila_star.dim_customer AS DC ON FT.customer_key = DC.customer_key
+INNER JOIN sakila_star.dim_film AS DF ON FT.film_key = DF.film_key
+WHERE CHG.target_table = 'mart_customer_features'
+GROUP BY FT.customer_key
+"""
+
+def refresh_customer_features(params, ti, **context):
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    conn = mysql_hook.get_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        cursor.execute("SELECT COUNT(*) FROM sakila_star.mart_customer_features")
+        rebuild = params['mart_rebuild'] or cursor.fetchone()[0] == 0
+        cursor.execute(mart_rebuild_keys_query if rebuild else mart_affected_query)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM sakila_star.etl_changed_keys WHERE target_table = 'mart_customer_features'")
+        customers = cursor.fetchone()[0]
+        if customers:
+            cursor.execute(mart_delete_query)
+            cursor.execute(mart_insert_query)
+            cursor.execute("DELETE FROM sakila_star.etl_changed_keys WHERE target_table = 'mart_customer_features'")
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+    ti.xcom_push(key='mart_counts', value={'customers': customers, 'rebuild': rebuild})
+    if customers == 0:
+        raise AirflowSkipException('No customers changed in this run')
+    return customers
+
+mysql_task_7_refresh_features = PythonOperator(
+    task_id="refresh_customer_features",
+    python_callable=refresh_customer_features,
+    # Runs after the fact load whether it loaded records or ended as skipped, dimension changes still count
+    trigger_rule='none_failed',
+    dag=dag
+)
+
+# Task 7b: Export The Star Schema To Parquet
+# With the parquet_export param every sakila_star table is exported to parquet_export_dir, so the notebooks read
+# memory mapped Parquet files (see sakila_star_parquet.py) instead of pulling rows over the MySQL protocol.
+# - the dimensions, the bridge and the mart are small, each is rewritten as one file when it changed since
+#   the last export (a load of it logged in etl_run_log, or for the mart a newer updated_at)
+# - the fact table is partitioned by rental month (fact_transaction/rental_month=YYYY-MM/), a run of the daily
+#   fact load only appends the fact rows of its etl_changed_keys, one file per month, with the export_run they
+#   were exported in, so a changed row is in the export twice, in its month until the month is compacted or in two
+#   months when its rental_date moved (the reader keeps the newest export_run of every key over all months).
+#   A month with parquet_compact_files files is compacted from the Parquet files themselves into one file,
+#   without reading MySQL again
+# - any other write to the fact table since the last export (the bootstrap, a reconciliation repair, or a run the
+#   export did not see) rewrites the whole fact export from MySQL
+# Every file is written in the _staging directory first and moved in place, the manifest _manifest.json is written last
+PARQUET_TABLES = STAR_TABLES + ['mart_customer_features']
+# Table whose loads in etl_run_log change the exported table
+PARQUET_LOGGED_TABLES = dict((table, spec['table']) for spec in LOAD_SPECS for table in spec['side_tables'])
+# Tasks whose fact writes are exactly the fact rows of etl_changed_keys
+PARQUET_FACT_DELTA_TASKS = [task_6_load['task_id'], 'load_consolidated.fact']
+
+parquet_writes_query = """
+SELECT target_table, task_id, run_id
+FROM sakila_star.etl_run_log
+WHERE logged_at > %s AND records > 0
+"""
+
+parquet_fact_delta_query = """
+SELECT {columns}
+FROM sakila_star.etl_changed_keys AS CHG
+INNER JOIN sakila_star.fact_transaction AS ST ON ST.rental_id = CHG.natural_id
+WHERE CHG.target_table = 'fact_transaction'
+"""
+
+# Arrow type of a MySQL column
+def arrow_type(pa, data_type, precision, scale):
+    if data_type in ('tinyint', 'smallint', 'mediumint', 'int', 'bigint', 'year'):
+        return pa.int64()
+    if data_type == 'decimal':
+        return pa.decimal128(int(precision), int(scale))
+    if data_type in ('float', 'double'):
+        return pa.float64()
+    if data_type in ('datetime', 'timestamp'):
+        return pa.timestamp('s')
+    if data_type == 'date':
+        return pa.date32()
+    if data_type in ('tinyblob', 'blob', 'mediumblob', 'longblob', 'binary', 'varbinary', 'geometry', 'point'):
+        return pa.binary()
+    return pa.string()
+
+# Select expressions and Arrow schema of one star table, geometry columns travel as WKB
+def arrow_columns(pa, cursor, table, alias):
+    cursor.execute("""
+    SELECT COLUMN_NAME, DATA_TYPE, NUMERIC_PRECISION, NUMERIC_SCALE
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = 'sakila_star' AND TABLE_NAME = %s
+    ORDER BY ORDINAL_POSITION
+    """, (table,))
+    columns = cursor.fetchall()
+    expressions = [("ST_AsBinary({alias}.{name})" if data_type in ('geometry', 'point') else "{alias}.{name}").format(
+        alias=alias, name=name) for name, data_type, _, _ in columns]
+    schema = pa.schema([(name, arrow_type(pa, data_type, precision, scale))
+                        for name, data_type, precision, scale in columns])
+    return ', '.join(expressions), schema
+
+# Read a query through an unbuffered server side cursor as Arrow record batches of batch_size rows
+def arrow_batches(pa, conn, query, parameters, schema, batch_size):
+    import MySQLdb.cursors
+    cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(query, parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield pa.RecordBatch.from_arrays([pa.array(values, type=field.type)
+                                              for values, field in zip(zip(*rows), schema)], schema=schema)
+    finally:
+        cursor.close()
+
+# Add the rental_month partition column and the export_run column to fact batches
+def fact_batches(pa, pc, batches, export_run):
+    for batch in batches:
+        yield pa.RecordBatch.from_arrays(
+            batch.columns + [pc.strftime(batch.column('rental_date'), format='%Y-%m'),
+                             pa.array([export_run] * batch.num_rows, type=pa.int64())],
+            names=batch.schema.names + ['rental_month', 'export_run'])
+
+# Move a file or directory written in the staging directory in place of path
+def replace_path(staged, path):
+    if os.path.isdir(path):
+        shutil.rmtree(path + '.old', ignore_errors=True)
+        os.rename(path, path + '.old')
+        os.rename(staged, path)
+        shutil.rmtree(path + '.old')
     else:
-        return "mysql_task_6_no_records_task"
+        os.replace(staged, path)
+
+def export_star_parquet(params, ti, run_id, **context):
+    if not params['parquet_export']:
+        raise AirflowSkipException('Parquet export is off, set the parquet_export param to run it')
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    root = params['parquet_export_dir']
+    staging = os.path.join(root, '_staging')
+    os.makedirs(staging, exist_ok=True)
+    manifest_path = os.path.join(root, '_manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    export_run = manifest['export_run'] + 1 if manifest else 1
+    batch_size = int(params['parquet_batch_size'])
+    partitioning = ds.partitioning(pa.schema([('rental_month', pa.string())]), flavor='hive')
+    basename = 'run-{export_run}-{{i}}.parquet'.format(export_run=export_run)
+    counts = {}
+
+    conn = MySqlHook(mysql_conn_id=TARGET_CONN_ID).get_conn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT NOW()")
+        exported_at = cursor.fetchone()[0].strftime('%Y-%m-%d %H:%M:%S')
+        writes = []
+        if manifest:
+            cursor.execute(parquet_writes_query, (manifest['exported_at'],))
+            writes = [(target_table.split(','), task_id, log_run_id) for target_table, task_id, log_run_id in cursor.fetchall()]
+
+        for table in PARQUET_TABLES:
+            path = os.path.join(root, table)
+            logged = PARQUET_LOGGED_TABLES.get(table, table)
+            table_writes = [(task_id, log_run_id) for tables, task_id, log_run_id in writes if logged in tables]
+            full = manifest is None or not os.path.exists(path)
+            if table == 'mart_customer_features' and not full:
+                cursor.execute("SELECT COUNT(*) FROM sakila_star.mart_customer_features WHERE updated_at > %s",
+                               (manifest['exported_at'],))
+                full = cursor.fetchone()[0] > 0
+            elif table == 'fact_transaction' and not full:
+                full = any(log_run_id != run_id or task_id not in PARQUET_FACT_DELTA_TASKS
+                           for task_id, log_run_id in table_writes)
+            elif not full:
+                full = len(table_writes) > 0
+            if table != 'fact_transaction' and not full:
+                continue
+            expressions, schema = arrow_columns(pa, cursor, table, 'ST')
 
-# Task to check records and decide which task to execute next
-mysql_task_6_check_records_task = BranchPythonOperator(
-    task_id="mysql_task_6_check_records_task",
-    python_callable=check_records_task_6,
-    trigger_rule='one_success',
+            if table != 'fact_transaction':
+                staged = os.path.join(staging, table + '.parquet')
+                with pq.ParquetWriter(staged, schema) as writer:
+                    for batch in arrow_batches(pa, conn, "SELECT {columns} FROM sakila_star.{table} AS ST".format(
+                            columns=expressions, table=table), None, schema, batch_size):
+                        writer.write_batch(batch)
+                        counts[table] = counts.get(table, 0) + batch.num_rows
+                os.makedirs(path, exist_ok=True)
+                replace_path(staged, os.path.join(path, table + '.parquet'))
+                continue
+
+            fact_schema = schema.append(pa.field('rental_month', pa.string())).append(pa.field('export_run', pa.int64()))
+            if full:
+                staged = os.path.join(staging, table)
+                shutil.rmtree(staged, ignore_errors=True)
+                batches = arrow_batches(pa, conn, "SELECT {columns} FROM sakila_star.fact_transaction AS ST".format(
+                    columns=expressions), None, schema, batch_size)
+                ds.write_dataset(fact_batches(pa, pc, batches, export_run), staged, schema=fact_schema, format='parquet',
+                                 partitioning=partitioning, basename_template=basename)
+                replace_path(staged, path)
+                counts[table] = ds.dataset(path, format='parquet').count_rows()
+                continue
+            if table_writes:
+                batches = list(fact_batches(pa, pc, arrow_batches(
+                    pa, conn, parquet_fact_delta_query.format(columns=expressions), None, schema, batch_size), export_run))
+                if batches:
+                    ds.write_dataset(pa.Table.from_batches(batches, schema=fact_schema), path, format='parquet',
+                                     partitioning=partitioning, basename_template=basename,
+                                     existing_data_behavior='overwrite_or_ignore')
+                counts[table] = sum(batch.num_rows for batch in batches)
+            # Compact the months that reached parquet_compact_files files, keeping the newest export_run of every key
+            for month in sorted(os.listdir(path)):
+                month_path = os.path.join(path, month)
+                if len(os.listdir(month_path)) < int(params['parquet_compact_files']):
+                    continue
+                rows = ds.dataset(month_path, format='parquet').to_table()
+                newest = rows.group_by(['rental_id', 'payment_id']).aggregate([('export_run', 'max')])
+                newest = newest.select(['rental_id', 'payment_id', 'export_run_max']).rename_columns(
+                    ['rental_id', 'payment_id', 'export_run'])
+                rows = rows.join(newest, keys=['rental_id', 'payment_id', 'export_run'], join_type='inner')
+                staged = os.path.join(staging, month)
+                os.makedirs(staged, exist_ok=True)
+                pq.write_table(rows.select(fact_schema.names[:-2] + ['export_run']),
+                               os.path.join(staged, 'compacted-{export_run}.parquet'.format(export_run=export_run)))
+                replace_path(staged, month_path)
+                counts.setdefault('compacted_months', []).append(month)
+        cursor.close()
+    finally:
+        conn.close()
+
+    with open(os.path.join(staging, '_manifest.json'), 'w') as manifest_file:
+        json.dump({'export_run': export_run, 'exported_at': exported_at, 'run_id': run_id}, manifest_file)
+    replace_path(os.path.join(staging, '_manifest.json'), manifest_path)
+    ti.xcom_push(key='export_counts', value=counts)
+    logging.info('parquet export %d: %s', export_run, counts)
+    return counts
+
+mysql_task_7_export_parquet = PythonOperator(
+    task_id="export_star_parquet",
+    python_callable=export_star_parquet,
+    trigger_rule='none_failed',
     dag=dag
 )
-# Task to execute the next query if there are records
-mysql_task_6_execute_next = MySqlOperator(
-    task_id="mysql_task_6_execute_next",
-    sql=task_6_query,
-    mysql_conn_id="my_sql",
+
+# Task 8: Check The Load Metrics Against The Previous Runs
+# A load whose duration or rows examined per affected row grew past alert_latency_factor or alert_examined_factor
+# times its average over the last alert_history_runs runs in etl_run_log fails this task, so the failure alerting
+# of Airflow reports it. Loads below alert_min_seconds and runs without records are not checked, they are noise
+LOAD_TASKS = [spec['task_id'] for spec in LOAD_SPECS]
+
+load_history_query = """
+SELECT AVG(HISTORY.duration_seconds), AVG(HISTORY.rows_examined / GREATEST(HISTORY.affected, 1)), COUNT(*)
+FROM (
+    SELECT duration_seconds, rows_examined, affected
+    FROM sakila_star.etl_run_log
+    WHERE task_id = %s AND run_id <> %s AND records > 0
+    ORDER BY logged_at DESC
+    LIMIT %s) AS HISTORY
+"""
+
+def check_load_metrics(params, ti, run_id, **context):
+    mysql_hook = MySqlHook(mysql_conn_id=TARGET_CONN_ID)
+    alerts = []
+    # The load tasks, or the stages of the consolidated load when that ran instead
+    loads = [(task_id, ti.xcom_pull(task_ids=task_id, key='load_metrics'),
+              ti.xcom_pull(task_ids=task_id, key='load_counts')) for task_id in LOAD_TASKS]
+    stage_metrics = ti.xcom_pull(task_ids=mysql_task_consolidated.task_id, key='stage_metrics') or {}
+    stage_counts = ti.xcom_pull(task_ids=mysql_task_consolidated.task_id, key='stage_counts') or {}
+    loads += [(stage_id, stage_metrics[stage_id], stage_counts[stage_id]) for stage_id in stage_metrics]
+    for task_id, metrics, counts in loads:
+        if metrics is None or counts['records'] == 0 or metrics['duration_seconds'] < params['alert_min_seconds']:
+            continue
+        duration, examined, history_runs = mysql_hook.get_first(
+            load_history_query, parameters=(task_id, run_id, int(params['alert_history_runs'])))
+        if history_runs == 0:
+            continue
+        if metrics['duration_seconds'] > float(duration) * params['alert_latency_factor']:
+            alerts.append("{task}: {current:.1f}s against an average of {average:.1f}s".format(
+                task=task_id, current=metrics['duration_seconds'], average=float(duration)))
+        if metrics['rows_examined_per_affected'] > float(examined) * params['alert_examined_factor']:
+            alerts.append("{task}: {current:.1f} rows examined per affected row against an average of {average:.1f}".format(
+                task=task_id, current=metrics['rows_examined_per_affected'], average=float(examined)))
+    if alerts:
+        raise AirflowException("Load metrics out of bounds, " + "; ".join(alerts))
+
+mysql_task_8_check_metrics = PythonOperator(
+    task_id="check_load_metrics",
+    python_callable=check_load_metrics,
+    trigger_rule='none_failed',
+    # A retry would compare the same metrics again
+    retries=0,
     dag=dag
 )
-# Task to handle the case when no records are found
-mysql_task_6_no_records_task = DummyOperator(task_id="mysql_task_6_no_records_task", dag=dag)
 
 # Set up task dependencies
 # For defining flow of architechture
-mysql_task_1 >> mysql_task_2_check_records_task
-mysql_task_2_check_records_task >> [mysql_task_2_execute_next, mysql_task_2_no_records_task]
-[mysql_task_2_execute_next, mysql_task_2_no_records_task] >> mysql_task_3_check_records_task
-mysql_task_3_check_records_task >> [mysql_task_3_execute_next, mysql_task_3_no_records_task]
-[mysql_task_3_execute_next, mysql_task_3_no_records_task] >> mysql_task_4_check_records_task
-mysql_task_4_check_records_task >> [mysql_task_4_execute_next, mysql_task_4_no_records_task]
-[mysql_task_4_execute_next, mysql_task_4_no_records_task] >> mysql_task_5_check_records_task
-mysql_task_5_check_records_task >> [mysql_task_5_execute_next, mysql_task_5_no_records_task]
-[mysql_task_5_execute_next, mysql_task_5_no_records_task] >> mysql_task_6_check_records_task
-mysql_task_6_check_records_task >> [mysql_task_6_execute_next, mysql_task_6_no_records_task]
+# Dimension customer, store, staff and film do not depend on each other, so their loads run in parallel
+# right after the setup tasks (create_table, ensure_last_update_index, maintain_fact_partitions),
+# and only the fact table waits for all four of them. choose_execution_mode runs either these five load tasks
+# or load_consolidated or bootstrap_star_schema, reconcile_star_schema checks and repairs the star schema after them (when the reconcile param
+# is set), the customer feature mart is refreshed after that, then the Parquet export (when the parquet_export param
+# is set) runs next to the check of the load metrics
+mysql_task_1 >> [mysql_task_1_ensure_index, mysql_task_1_maintain_partitions] >> mysql_task_1_choose_mode
+mysql_task_1_choose_mode >> dimension_load_tasks + [fact_load_task, mysql_task_consolidated, mysql_task_bootstrap]
+dimension_load_tasks >> fact_load_task
+[fact_load_task, mysql_task_consolidated, mysql_task_bootstrap] >> mysql_task_6_reconcile
+mysql_task_6_reconcile >> mysql_task_7_refresh_features >> [mysql_task_7_export_parquet, mysql_task_8_check_metrics]
@@ -0,0 +1,50 @@
+# Import required library
+import argparse
+import json
+import sys
+
+# Compare two benchmark results of the same scale factor task by task, a task whose wall time grew by more than
+# the threshold (and by more than the noise floor in seconds) is a regression and the script exits with status 1,
+# so it can gate a change in CI.
+#
+# Usage: python -m benchmark.compare_results baseline.json candidate.json [--threshold 0.2] [--min-seconds 0.5]
+
+# Define function to index the task results of a benchmark result by (phase, task_id)
+# (tasks a branch did not follow have no timings and are left out)
+def task_results(result):
+    return dict(((run['phase'], task['task_id']), task) for run in result['runs'] for task in run['tasks']
+                if 'wall_seconds' in task)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two sakila_to_star_schema benchmark results')
+    parser.add_argument('baseline', help='JSON result of the baseline')
+    parser.add_argument('candidate', help='JSON result of the change')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed relative growth of the wall time')
+    parser.add_argument('--min-seconds', type=float, default=0.5, help='Wall time growth below this is noise')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline = json.load(baseline_file)
+        candidate = json.load(candidate_file)
+    if baseline['scale_factor'] != candidate['scale_factor']:
+        sys.exit("scale factor {baseline} and {candidate} are not comparable".format(
+            baseline=baseline['scale_factor'], candidate=candidate['scale_factor']))
+
+    baseline_tasks = task_results(baseline)
+    regressions = 0
+    for key, task in sorted(task_results(candidate).items()):
+        before = baseline_tasks.get(key)
+        if before is None:
+            print("{phase:10} {task:32} new task, {wall:.2f}s".format(phase=key[0], task=key[1], wall=task['wall_seconds']))
+            continue
+        growth = task['wall_seconds'] - before['wall_seconds']
+        ratio = growth / before['wall_seconds'] if before['wall_seconds'] else 0
+        regression = ratio > args.threshold and growth > args.min_seconds
+        regressions += regression
+        print("{phase:10} {task:32} {before:8.2f}s -> {after:8.2f}s {ratio:+7.1%} {flag}".format(
+            phase=key[0], task=key[1], before=before['wall_seconds'], after=task['wall_seconds'], ratio=ratio,
+            flag='REGRESSION' if regression else ''))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Import required library
+from airflow.providers.mysql.hooks.mysql import MySqlHook
+import argparse
+import logging
+import numpy as np
+
+# Sakila shaped source data at a scale factor, for benchmarking sakila_to_star_schema above the toy size
+# The standard sakila database (about 16k rentals) is the base. A scale factor of N adds N - 1 copies of its
+# addresses, customers, films, film categories, inventory, rentals and payments, every copy with its ids shifted
+# past the base rows, so the clones keep the shape of the original data (rentals per customer, payments per rental,
+# films per category). Countries, cities, languages, categories, stores and staff are shared by all copies.
+# The highest base id of every cloned table is kept in sakila_benchmark.base_max_id, so a later run with another
+# scale factor first removes the clones and starts again from the base rows.
+#
+# Runs against a MySQL instance kept for benchmarking only, it writes into its sakila database.
+#
+# Usage: python -m benchmark.generate_sakila --conn-id <benchmark connection> --scale-factor 10
+
+# Cloned tables in insert order, with their id column and the id columns of the other cloned tables they reference
+CLONED_TABLES = [
+    ('address', 'address_id', {}),
+    ('customer', 'customer_id', {'address_id': 'address'}),
+    ('film', 'film_id', {}),
+    ('film_category', 'film_id', {'film_id': 'film'}),
+    ('inventory', 'inventory_id', {'film_id': 'film'}),
+    ('rental', 'rental_id', {'inventory_id': 'inventory', 'customer_id': 'customer'}),
+    ('payment', 'payment_id', {'rental_id': 'rental', 'customer_id': 'customer'}),
+]
+
+# Columns of the cloned rows that are unique in sakila and get the copy number appended
+UNIQUE_TEXT_COLUMNS = {
+    'customer': ['email'],
+}
+
+# Sakila sets these columns to NOW() in BEFORE INSERT triggers, they are copied from the base rows again afterwards
+TRIGGER_DATE_COLUMNS = {
+    'customer': ['create_date'],
+    'rental': ['rental_date'],
+    'payment': ['payment_date'],
+}
+
+BASE_QUERY = """
+CREATE DATABASE IF NOT EXISTS sakila_benchmark;
+CREATE TABLE IF NOT EXISTS sakila_benchmark.base_max_id (
+    `table_name` VARCHAR(64) NOT NULL,
+    `max_id` INT(12) NOT NULL,
+    PRIMARY KEY (`table_name`));
+"""
+
+# Define function to read the highest base id of every cloned table, stored the first time the generator runs
+def read_base_max_ids(mysql_hook):
+    mysql_hook.run(BASE_QUERY)
+    base = dict(mysql_hook.get_records("SELECT table_name, max_id FROM sakila_benchmark.base_max_id"))
+    for table, id_column, _ in CLONED_TABLES:
+        if table not in base:
+            max_id = mysql_hook.get_first("SELECT COALESCE(MAX({id}), 0) FROM sakila.{table}".format(
+                id=id_column, table=table))[0]
+            mysql_hook.run("INSERT INTO sakila_benchmark.base_max_id(table_name, max_id) VALUES (%s, %s)",
+                           parameters=(table, max_id))
+            base[table] = max_id
+    return base
+
+# Define function to read the column names of one sakila table
+def read_columns(mysql_hook, table):
+    query = """
+    SELECT COLUMN_NAME
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = 'sakila' AND TABLE_NAME = %s
+    ORDER BY ORDINAL_POSITION
+    """
+    return [row[0] for row in mysql_hook.get_records(query, parameters=(table,))]
+
+# Define function to remove every cloned row, children before parents
+# film_category has no own id, its clones are the rows of the cloned films
+def remove_clones(mysql_hook, base):
+    for table, id_column, _ in reversed(CLONED_TABLES):
+        key_table = 'film' if table == 'film_category' else table
+        mysql_hook.run("DELETE FROM sakila.{table} WHERE {id} > %s".format(table=table, id=id_column),
+                       parameters=(base[key_table],))
+    mysql_hook.run("DELETE FROM sakila.film_text WHERE film_id > %s", parameters=(base['film'],))
+
+# Define function to add copy number copy of every cloned table, as one INSERT ... SELECT per table
+def add_copy(mysql_hook, base, columns, copy):
+    for table, id_column, references in CLONED_TABLES:
+        key_table = 'film' if table == 'film_category' else table
+        shifted = dict(references)
+        shifted[id_column] = key_table
+        expressions = []
+        for column in columns[table]:
+            if column in shifted:
+                expressions.append("{column} + {offset}".format(column=column, offset=base[shifted[column]] * copy))
+            elif column in UNIQUE_TEXT_COLUMNS.get(table, []):
+                expressions.append("CONCAT({column}, '.{copy}')".format(column=column, copy=copy))
+            else:
+                expressions.append(column)
+        mysql_hook.run("""
+        INSERT INTO sakila.{table}({columns})
+        SELECT {expressions}
+        FROM sakila.{table}
+        WHERE {id} <= {base_max}
+        """.format(table=table, columns=", ".join(columns[table]), expressions=", ".join(expressions),
+                   id=id_column, base_max=base[key_table]))
+        for column in TRIGGER_DATE_COLUMNS.get(table, []):
+            mysql_hook.run("""
+            UPDATE sakila.{table} AS CLONE
+            INNER JOIN sakila.{table} AS BASE ON CLONE.{id} = BASE.{id} + {offset}
+            SET CLONE.{column} = BASE.{column}
+            WHERE BASE.{id} <= {base_max}
+            """.format(table=table, id=id_column, offset=base[key_table] * copy, column=column,
+                       base_max=base[key_table]))
+
+# Define function to build sakila at scale factor scale_factor from the base rows
+def generate(mysql_hook, scale_factor):
+    base = read_base_max_ids(mysql_hook)
+    columns = dict((table, read_columns(mysql_hook, table)) for table, _, _ in CLONED_TABLES)
+    remove_clones(mysql_hook, base)
+    for copy in range(1, scale_factor):
+        add_copy(mysql_hook, base, columns, copy)
+        logging.info("sakila: added copy %d of %d", copy, scale_factor - 1)
+    return mysql_hook.get_first("SELECT COUNT(*) FROM sakila.rental")[0]
+
+# Define function to draw count ranks from 0 (the newest row) to span - 1 with a weight of about 1 / (r + 1) ** skew,
+# by inverting the distribution function of the continuous power law, so no weight per row is built
+def skewed_ranks(random, span, skew, count):
+    uniform = random.random(count)
+    if skew == 1:
+        ranks = np.power(span + 1.0, uniform)
+    else:
+        ranks = np.power(1 + uniform * (np.power(span + 1.0, 1 - skew) - 1), 1 / (1 - skew))
+    return np.minimum(np.floor(ranks).astype(np.int64) - 1, span - 1)
+
+# Define function to apply one day of source changes
+# change_rate is the share of the rentals changed that day, half of them updated (returned again, which moves
+# their last_update) and half of them new rentals with a payment, cloned from existing ones with new ids.
+# Customers, films, payments and inventory items are touched (last_update moved) at a tenth of that rate.
+# skew concentrates the changes on the newest rows, row r from the newest on is picked with a weight
+# of 1 / (r + 1) ** skew, 0 picks uniformly
+def apply_daily_changes(mysql_hook, change_rate, skew, seed):
+    random = np.random.default_rng(seed)
+
+    # Only MIN and MAX of the ids are read, the ids are drawn from that range (the cloned tables have dense ids,
+    # an id in a gap changes nothing) without loading every id of a table into memory
+    def pick(table, id_column, count):
+        low, high = mysql_hook.get_first("SELECT MIN({id}), MAX({id}) FROM sakila.{table}".format(
+            id=id_column, table=table))
+        if low is None:
+            return []
+        span = high - low + 1
+        count = min(count, span)
+        picked = set()
+        # Draws repeat ids, the missing ones are drawn again, a few rounds are enough below a share of the table
+        for _ in range(100):
+            if len(picked) >= count:
+                break
+            picked.update(high - int(rank) for rank in skewed_ranks(random, span, skew, count - len(picked)))
+        return sorted(picked)[:count]
+
+    rentals = mysql_hook.get_first("SELECT COUNT(*) FROM sakila.rental")[0]
+    changed = int(rentals * change_rate)
+    changes = {}
+
+    updated = pick('rental', 'rental_id', changed // 2)
+    if updated:
+        mysql_hook.run("UPDATE sakila.rental SET return_date = NOW() WHERE rental_id IN %(ids)s",
+                       parameters={'ids': tuple(updated)})
+    changes['rental_updated'] = len(updated)
+
+    templates = pick('rental', 'rental_id', changed - changed // 2)
+    inserted = 0
+    if templates:
+        next_rental, next_payment = mysql_hook.get_first(
+            "SELECT (SELECT MAX(rental_id) FROM sakila.rental), (SELECT MAX(payment_id) FROM sakila.payment)")
+        conn = mysql_hook.get_conn()
+        try:
+            cursor = conn.cursor()
+            for number, rental_id in enumerate(templates, start=1):
+                # rental_date and payment_date are set to NOW() by the sakila triggers, so two templates with the same
+                # inventory_id and customer_id collide on the unique (rental_date, inventory_id, customer_id) key
+                # within a second, the second one is ignored and its payment is not inserted either
+                cursor.execute("""
+                INSERT IGNORE INTO sakila.rental(rental_id, inventory_id, customer_id, return_date, staff_id)
+                SELECT %s, inventory_id, customer_id, NULL, staff_id
+                FROM sakila.rental WHERE rental_id = %s
+                """, (next_rental + number, rental_id))
+                inserted += cursor.rowcount
+                cursor.execute("""
+                INSERT INTO sakila.payment(payment_id, customer_id, staff_id, rental_id, amount)
+                SELECT %s, customer_id, staff_id, %s, 4.99
+                FROM sakila.rental WHERE rental_id = %s
+                """, (next_payment + number, next_rental + number, next_rental + number))
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+    changes['rental_inserted'] = inserted
+
+    for table, id_column in (('customer', 'customer_id'), ('film', 'film_id'), ('payment', 'payment_id'),
+                             ('inventory', 'inventory_id')):
+        ids = pick(table, id_column, max(1, changed // 10))
+        if ids:
+            mysql_hook.run("UPDATE sakila.{table} SET last_update = NOW() WHERE {id} IN %(ids)s".format(
+                table=table, id=id_column), parameters={'ids': tuple(ids)})
+        changes[table + '_updated'] = len(ids)
+    return changes
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate sakila at a scale factor on a benchmark MySQL instance')
+    parser.add_argument('--conn-id', required=True, help='Airflow connection of the benchmark MySQL instance')
+    parser.add_argument('--scale-factor', type=int, default=1, help='Copies of the base sakila rows, 1 keeps the base')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    rentals = generate(MySqlHook(mysql_conn_id=args.conn_id), args.scale_factor)
+    logging.info("sakila: %d rentals at scale factor %d", rentals, args.scale_factor)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Import required library
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+
+# Parse time benchmark of the DAG file
+# The scheduler imports the DAG file again every min_file_process_interval, so everything the file does at module
+# level is paid on every parse, not once per run. Every parse runs in a fresh python process that imports airflow
+# and the operators first (their cost is the same for every DAG file), then times the import of the DAG file alone:
+# wall time, the peak python memory it allocated (tracemalloc), the growth of the max RSS of the process
+# and the modules it imported on top of airflow. The median over the runs goes to stdout and the output file.
+# Needs no database, nothing of the DAG runs but its module level code.
+#
+# Usage: python -m benchmark.parse_dag [--dag-file airflow-script-transform-daily.py] [--runs 20] [--output parse.json]
+#        (to compare with an older version: git show <commit>:airflow-script-transform-daily.py > /tmp/old_dag.py
+#         and run it again with --dag-file /tmp/old_dag.py)
+
+DAG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'airflow-script-transform-daily.py')
+
+# Code of one parse, run by a child process with the DAG file as its argument, prints the measurements as JSON
+PARSE_CHILD = """
+import importlib.util, json, resource, sys, time, tracemalloc
+import airflow
+from airflow import DAG
+from airflow.operators.mysql_operator import MySqlOperator
+from airflow.operators.python_operator import BranchPythonOperator, PythonOperator
+from airflow.providers.mysql.hooks.mysql import MySqlHook
+modules = set(sys.modules)
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+tracemalloc.start()
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('sakila_to_star_schema', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+wall = time.perf_counter() - start
+_, peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+print(json.dumps({
+    'parse_seconds': wall,
+    'peak_python_memory_bytes': peak,
+    # ru_maxrss is in kilobytes on linux
+    'max_rss_growth_bytes': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024,
+    'imported_modules': sorted(name for name in set(sys.modules) - modules if '.' not in name),
+    'tasks': len(module.dag.tasks),
+}))
+"""
+
+# Define function to parse the DAG file once in a fresh process
+def parse_once(dag_file):
+    output = subprocess.run([sys.executable, '-c', PARSE_CHILD, dag_file], check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+# Define function to summarize the parses, the median of every measurement and the spread of the wall time
+def summarize(dag_file, parses):
+    summary = {'dag_file': dag_file, 'runs': len(parses), 'tasks': parses[0]['tasks'],
+               'imported_modules': parses[0]['imported_modules']}
+    for name in ('parse_seconds', 'peak_python_memory_bytes', 'max_rss_growth_bytes'):
+        summary[name] = statistics.median(parse[name] for parse in parses)
+    summary['parse_seconds_min'] = min(parse['parse_seconds'] for parse in parses)
+    summary['parse_seconds_max'] = max(parse['parse_seconds'] for parse in parses)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parse time of the sakila_to_star_schema DAG file')
+    parser.add_argument('--dag-file', default=DAG_FILE, help='DAG file to parse')
+    parser.add_argument('--runs', type=int, default=20, help='Parses, each in a fresh process')
+    parser.add_argument('--output', help='JSON file of the summary and every parse')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    parses = [parse_once(args.dag_file) for _ in range(args.runs)]
+    summary = summarize(args.dag_file, parses)
+    logging.info("%s: %d tasks, median parse %.1f ms (%.1f - %.1f), peak python memory %.1f MiB, RSS growth %.1f MiB",
+                 args.dag_file, summary['tasks'], summary['parse_seconds'] * 1000, summary['parse_seconds_min'] * 1000,
+                 summary['parse_seconds_max'] * 1000, summary['peak_python_memory_bytes'] / 2 ** 20,
+                 summary['max_rss_growth_bytes'] / 2 ** 20)
+    logging.info("modules imported by the DAG file: %s", ", ".join(summary['imported_modules']) or "none")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(summary, parses=parses), output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+# Import required library
+from airflow.exceptions import AirflowSkipException
+from airflow.operators.python_operator import BranchPythonOperator, PythonOperator
+from airflow.providers.mysql.hooks.mysql import MySqlHook
+from benchmark.generate_sakila import apply_daily_changes, generate
+import argparse
+import datetime
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import resource
+import shutil
+import time
+import tracemalloc
+
+# End to end benchmark of sakila_to_star_schema outside the scheduler
+# For every scale factor the source is generated (see generate_sakila), sakila_star is dropped and every task
+# of the DAG runs in dependency order, once for the initial load and then once per simulated day of changes.
+# Every task records its status, wall time, rows and rows per second, the peak python memory (tracemalloc)
+# and the max RSS of the process after it, plus EXPLAIN FORMAT=JSON of its queries against the change set it loaded.
+# One JSON file per scale factor goes to the output directory, compare_results compares two of them.
+#
+# Runs against a MySQL instance kept for benchmarking only, it rebuilds its sakila and drops its sakila_star database.
+#
+# Usage: python -m benchmark.run_benchmark --conn-id <benchmark connection> --scale-factors 1 10 100
+#            [--days 1] [--change-rate 0.01] [--skew 1.0] [--param fact_load_mode=chunked]
+
+DAG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'airflow-script-transform-daily.py')
+
+# Define function to import the DAG file as a module, its name is not a valid module name
+def load_dag_module():
+    spec = importlib.util.spec_from_file_location('sakila_to_star_schema', DAG_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Task instance stand-in with the XCom calls the task callables use
+class BenchmarkTaskInstance:
+    def __init__(self, task_id, xcom):
+        self.task_id = task_id
+        self.xcom = xcom
+
+    def xcom_push(self, key, value):
+        self.xcom[(self.task_id, key)] = value
+
+    def xcom_pull(self, task_ids, key):
+        return self.xcom.get((task_ids, key))
+
+# Define function to read the current time of the database server, the change window ends there
+def database_now(mysql_hook):
+    return mysql_hook.get_first("SELECT NOW()")[0]
+
+# Define function to explain every query of a task, with the whole natural key range
+# (a load task only gets its table name, its queries are rendered from its load spec)
+def explain_task(mysql_hook, module, task):
+    plans = {}
+    if not isinstance(task, PythonOperator) or 'table' not in task.op_kwargs:
+        return plans
+    load = module.render_load(task.op_kwargs['table'])
+    conn = mysql_hook.get_conn()
+    try:
+        cursor = conn.cursor()
+        for name in ('query', 'publish_query'):
+            query = load[name]
+            try:
+                cursor.execute("EXPLAIN FORMAT=JSON " + query, module.FULL_KEY_RANGE)
+                plans[name] = json.loads(cursor.fetchone()[0])
+            except Exception as error:
+                plans[name] = {'error': str(error)}
+        cursor.close()
+    finally:
+        conn.close()
+    return plans
+
+# Define function to read the rows a task loaded from its XCom counts
+def task_rows(xcom, task_id):
+    counts = xcom.get((task_id, 'load_counts'))
+    if counts:
+        return counts.get('staged', counts['records']), counts
+    counts = xcom.get((task_id, 'stage_counts'))
+    if counts:
+        return sum(stage.get('records', 0) for stage in counts.values()), counts
+    counts = xcom.get((task_id, 'mart_counts'))
+    if counts:
+        return counts['customers'], counts
+    return 0, None
+
+# Define function to pick the context arguments a task callable takes, like the PythonOperator does,
+# a callable with **context gets all of them
+def callable_kwargs(python_callable, context):
+    parameters = inspect.signature(python_callable).parameters
+    if any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return dict(context)
+    return dict((name, value) for name, value in context.items() if name in parameters)
+
+# Define function to run every task of the DAG once in dependency order, for the change window ending at end
+# A task that a branch did not follow is skipped, like the scheduler does
+def run_dag(mysql_hook, module, params, end, run_id):
+    xcom = {}
+    results = []
+    not_followed = set()
+    for task in module.dag.topological_sort():
+        if task.task_id in not_followed:
+            results.append({'task_id': task.task_id, 'status': 'skipped by branch'})
+            continue
+        context = {'data_interval_end': end, 'params': params, 'run_id': run_id,
+                   'ti': BenchmarkTaskInstance(task.task_id, xcom)}
+        tracemalloc.start()
+        start = time.perf_counter()
+        status = 'success'
+        try:
+            if isinstance(task, PythonOperator):
+                kwargs = dict(context)
+                kwargs.update(task.op_kwargs)
+                followed = task.python_callable(**callable_kwargs(task.python_callable, kwargs))
+                if isinstance(task, BranchPythonOperator):
+                    followed = [followed] if isinstance(followed, str) else followed
+                    not_followed |= set(task.downstream_task_ids) - set(followed)
+            else:
+                mysql_hook.run(task.sql)
+        except AirflowSkipException:
+            status = 'skipped'
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rows, counts = task_rows(xcom, task.task_id)
+        results.append({
+            'task_id': task.task_id,
+            'status': status,
+            'wall_seconds': wall,
+            'rows': rows,
+            'rows_per_second': rows / wall if wall else 0,
+            'peak_python_memory_bytes': peak,
+            # ru_maxrss is in kilobytes on linux
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'counts': counts,
+            'explain': explain_task(mysql_hook, module, task),
+        })
+        logging.info("%s: %s in %.2fs, %d rows", task.task_id, status, wall, rows)
+    return results
+
+# Define function to benchmark one scale factor, the initial load and then days of changes
+def benchmark_scale_factor(mysql_hook, module, scale_factor, params, args):
+    generate_start = time.perf_counter()
+    rentals = generate(mysql_hook, scale_factor)
+    generate_seconds = time.perf_counter() - generate_start
+    mysql_hook.run("DROP DATABASE IF EXISTS sakila_star")
+    shutil.rmtree(module.KEY_CACHE_DIR, ignore_errors=True)
+
+    runs = []
+    for day in range(args.days + 1):
+        changes = None
+        if day > 0:
+            changes = apply_daily_changes(mysql_hook, args.change_rate, args.skew, args.seed + day)
+        # Rows changed in the same second as the end of the window belong to the next window
+        time.sleep(1)
+        end = database_now(mysql_hook)
+        phase = 'initial' if day == 0 else 'day {day}'.format(day=day)
+        run_id = 'benchmark sf{scale_factor} {phase} {end}'.format(scale_factor=scale_factor, phase=phase, end=end.isoformat())
+        runs.append({
+            'phase': phase,
+            'data_interval_end': end.isoformat(),
+            'source_changes': changes,
+            'tasks': run_dag(mysql_hook, module, params, end, run_id),
+        })
+    return {
+        'scale_factor': scale_factor,
+        'source_rentals': rentals,
+        'generate_seconds': generate_seconds,
+        'change_rate': args.change_rate,
+        'skew': args.skew,
+        'params': params,
+        'runs': runs,
+    }
+
+# Parse a DAG param override, key=value with the type of the default value
+def parse_param(text, defaults):
+    key, value = text.split('=', 1)
+    default = defaults[key]
+    if isinstance(default, bool):
+        return key, value.lower() in ('1', 'true', 'yes')
+    return key, type(default)(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sakila_to_star_schema at scale factors')
+    parser.add_argument('--conn-id', required=True, help='Airflow connection of the benchmark MySQL instance')
+    parser.add_argument('--scale-factors', type=int, nargs='+', default=[1, 10], help='Scale factors to benchmark')
+    parser.add_argument('--days', type=int, default=1, help='Days of changes after the initial load')
+    parser.add_argument('--change-rate', type=float, default=0.01, help='Share of the rentals changed per day')
+    parser.add_argument('--skew', type=float, default=1.0, help='Skew of the changes to the newest rows, 0 is uniform')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the change generator')
+    parser.add_argument('--param', action='append', default=[], help='DAG param override, key=value')
+    parser.add_argument('--output-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'),
+                        help='Directory of the JSON results')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    module = load_dag_module()
+    # Every task of the DAG reads its connection ids when it runs, point them at the benchmark instance
+    module.SOURCE_CONN_ID = args.conn_id
+    module.TARGET_CONN_ID = args.conn_id
+    defaults = dict((key, module.dag.params[key]) for key in module.dag.params)
+    params = dict(defaults)
+    params.update(parse_param(text, defaults) for text in args.param)
+
+    mysql_hook = MySqlHook(mysql_conn_id=args.conn_id)
+    os.makedirs(args.output_dir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    for scale_factor in args.scale_factors:
+        result = benchmark_scale_factor(mysql_hook, module, scale_factor, params, args)
+        path = os.path.join(args.output_dir, 'sf{scale_factor}-{stamp}.json'.format(scale_factor=scale_factor, stamp=stamp))
+        with open(path, 'w') as output:
+            json.dump(result, output, indent=2, default=str)
+        logging.info("scale factor %d: results in %s", scale_factor, path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Import required library
+import os
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+# Read the Parquet export of the sakila_star database (task export_star_parquet of the daily DAG) without MySQL
+# Every table is opened lazily as a pyarrow dataset over memory mapped files: only the columns asked for are read
+# (projection), and a filter skips the fact months (rental_month=YYYY-MM partitions) and the row groups that can not
+# match (predicate pushdown), so a notebook pulls a few columns of a few months instead of the whole table.
+#
+# Usage in a notebook:
+#     import pyarrow.dataset as ds
+#     import sakila_star_parquet
+#     mart = sakila_star_parquet.read_pandas('mart_customer_features', columns=['customer_key', 'sum_payment_amount'])
+#     may = sakila_star_parquet.read_table('fact_transaction', columns=['customer_key', 'payment_amount'],
+#                                          filter=ds.field('rental_month') == '2005-05')
+
+# Root directory of the export, the parquet_export_dir param of the DAG
+DEFAULT_ROOT = os.environ.get('SAKILA_STAR_PARQUET', '/tmp/sakila_star_parquet')
+
+# Natural key of the fact rows, a row changed by a later run is appended again with a higher export_run
+# until the export compacts its month
+FACT_KEY = ['rental_id', 'payment_id']
+
+# Define function to open one exported table lazily, nothing is read before to_table or a scanner runs
+def open_table(table, root=DEFAULT_ROOT):
+    return ds.dataset(os.path.join(root, table), format='parquet', partitioning='hive',
+                      filesystem=fs.LocalFileSystem(use_mmap=True))
+
+# Define function to read the columns of one table, only the rows that match filter (a pyarrow.dataset expression)
+# The fact export can hold older versions of a row, only the newest version is kept: the newest export_run of every
+# key is read first over the whole table (three integer columns), and the rows the filter matched are joined to it,
+# so an older version that matches the filter is not returned in place of the current one. The versions of a row
+# are not always in one month, a corrected rental_date appends the new version to another month, so every fact read
+# is deduplicated, whatever the number of files per month
+def read_table(table, columns=None, filter=None, root=DEFAULT_ROOT):
+    dataset = open_table(table, root)
+    if table != 'fact_transaction':
+        return dataset.to_table(columns=columns, filter=filter)
+    version = FACT_KEY + ['export_run']
+    newest = dataset.to_table(columns=version).group_by(FACT_KEY).aggregate([('export_run', 'max')])
+    newest = newest.select(FACT_KEY + ['export_run_max']).rename_columns(version)
+    wanted = list(columns) if columns is not None else dataset.schema.names
+    rows = dataset.to_table(columns=wanted + [column for column in version if column not in wanted], filter=filter)
+    return rows.join(newest, keys=version, join_type='inner').select(wanted)
+
+# Define function to read the columns of one table into a pandas DataFrame
+def read_pandas(table, columns=None, filter=None, root=DEFAULT_ROOT):
+    return read_table(table, columns, filter, root).to_pandas()
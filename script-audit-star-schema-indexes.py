@@ -0,0 +1,245 @@
+# Import required library
+from airflow.providers.mysql.hooks.mysql import MySqlHook
+from collections import OrderedDict
+import argparse
+import sys
+import time
+
+# Index audit of the sakila_star database
+# Reads the indexes of every star table from information_schema.STATISTICS, flags the duplicate and
+# prefix-redundant ones (an index whose columns are the leading columns of another index of the table),
+# measures the insert and upsert cost of every table with its current and with the lean index set
+# on a synthetic load, and writes the migration that turns the current indexes into the lean set.
+#
+# Usage: python script-audit-star-schema-indexes.py [--conn-id my_sql] [--rows 20000] [--output migration.sql]
+
+STAR_SCHEMA = 'sakila_star'
+STAR_TABLES = ['dim_customer', 'dim_store', 'dim_staff', 'dim_film', 'bridge_film_category', 'fact_transaction']
+
+# Covering indexes of the joins that actually run against the star schema
+# The ML notebook groups the fact table by customer_key and joins dim_film on film_key for the payment sum,
+# with (customer_key, film_key, payment_amount) the fact side of that query is read from the index alone
+# and in customer_key order, without touching the clustered rows
+WORKLOAD_INDEXES = {
+    'fact_transaction': [
+        ('idx_customer_film_amount', ['customer_key', 'film_key', 'payment_amount']),
+    ],
+}
+
+# Define function to read the indexes of one table, in an ordered dict of index name to its columns and uniqueness
+def read_indexes(mysql_hook, table):
+    query = """
+    SELECT INDEX_NAME, COLUMN_NAME, NON_UNIQUE, INDEX_TYPE
+    FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+    ORDER BY INDEX_NAME, SEQ_IN_INDEX
+    """
+    indexes = OrderedDict()
+    for name, column, non_unique, index_type in mysql_hook.get_records(query, parameters=(STAR_SCHEMA, table)):
+        index = indexes.setdefault(name, {'name': name, 'columns': [], 'unique': non_unique == 0, 'type': index_type})
+        index['columns'].append(column)
+    return indexes
+
+# Define function to split the indexes of one table into the kept ones and the redundant ones
+# The indexes are visited widest first (primary key, then unique, then more columns, then the shorter name),
+# an index is redundant when a kept BTREE index starts with the same columns, unless it is a unique index
+# that a wider index can not replace because the wider index does not enforce uniqueness on exactly these columns.
+# Returns the kept indexes and a list of (redundant index, kept index that covers it, reason)
+def find_redundant(indexes):
+    def keep_order(index):
+        return (index['name'] != 'PRIMARY', not index['unique'], -len(index['columns']), len(index['name']), index['name'])
+    kept = []
+    redundant = []
+    for index in sorted(indexes.values(), key=keep_order):
+        cover = None
+        if index['name'] != 'PRIMARY' and index['type'] == 'BTREE':
+            for other in kept:
+                if other['type'] != 'BTREE' or other['columns'][:len(index['columns'])] != index['columns']:
+                    continue
+                if index['unique'] and not (other['unique'] and other['columns'] == index['columns']):
+                    continue
+                cover = other
+                break
+        if cover is None:
+            kept.append(index)
+        else:
+            reason = 'duplicate' if cover['columns'] == index['columns'] else 'prefix'
+            redundant.append((index, cover, reason))
+    return kept, redundant
+
+# Define function to pick the workload covering indexes a table is still missing, a covering index is
+# only missing when no kept index already starts with its columns, and a new covering index makes
+# every kept non-unique index that is a prefix of it redundant
+def plan_covering(table, kept):
+    added = []
+    dropped = []
+    for name, columns in WORKLOAD_INDEXES.get(table, []):
+        if any(index['columns'][:len(columns)] == columns for index in kept):
+            continue
+        added.append((name, columns))
+        for index in kept:
+            if (not index['unique'] and index['name'] != 'PRIMARY'
+                    and columns[:len(index['columns'])] == index['columns']):
+                dropped.append((index, {'name': name, 'columns': columns}, 'prefix'))
+    return added, dropped
+
+# Define function to build the ALTER TABLE statement of one table, None when nothing changes
+def migration_statement(table, dropped, added):
+    clauses = ["DROP INDEX `{name}`".format(name=index['name']) for index, _, _ in dropped]
+    clauses += ["ADD INDEX `{name}` ({columns})".format(name=name, columns=', '.join(columns))
+                for name, columns in added]
+    if not clauses:
+        return None
+    return "ALTER TABLE `{schema}`.`{table}`\n    {clauses};".format(
+        schema=STAR_SCHEMA, table=table, clauses=",\n    ".join(clauses))
+
+# Define function to read the columns of one table with their type and whether they are auto increment
+# A column type is (data type, COLUMN_TYPE, character length, numeric precision, numeric scale),
+# so every synthetic value can be fitted to its column
+def read_columns(mysql_hook, table):
+    query = """
+    SELECT COLUMN_NAME, DATA_TYPE, COLUMN_TYPE, CHARACTER_MAXIMUM_LENGTH, NUMERIC_PRECISION, NUMERIC_SCALE, EXTRA
+    FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+    ORDER BY ORDINAL_POSITION
+    """
+    return [(name, (data_type, column_type, length, precision, scale), 'auto_increment' in extra)
+            for name, data_type, column_type, length, precision, scale, extra
+            in mysql_hook.get_records(query, parameters=(STAR_SCHEMA, table))]
+
+# Highest signed value of every integer type, the unsigned types go twice as high plus one
+INTEGER_MAX = {'tinyint': 127, 'smallint': 32767, 'mediumint': 8388607, 'int': 2147483647, 'bigint': 9223372036854775807}
+
+# Synthetic value of one column for row number i, fitted to the column so strict mode accepts it
+# Every integer column gets i itself, modulo the range of its type (the id columns of the unique keys are INT,
+# so every unique key of the table stays unique across the synthetic rows), decimals stay below
+# 10 ** (precision - scale), strings are cut to the length of the column keeping the digits of i,
+# the datetime columns move one minute per row from the first sakila rental month on
+def synthetic_value(column_type, i):
+    data_type, full_type, length, precision, scale = column_type
+    if data_type in INTEGER_MAX:
+        top = INTEGER_MAX[data_type] * 2 + 1 if 'unsigned' in full_type else INTEGER_MAX[data_type]
+        return "{value}".format(value=i % (top + 1))
+    if data_type in ('decimal', 'float', 'double'):
+        value = i % 1000 / 100.0
+        if data_type == 'decimal' and precision is not None:
+            value %= 10 ** (int(precision) - int(scale or 0))
+        return "{value}".format(value=value)
+    if data_type in ('datetime', 'timestamp', 'date'):
+        return "'2005-05-01 00:00:00' + INTERVAL {i} MINUTE".format(i=i)
+    if data_type in ('geometry', 'json'):
+        return "NULL"
+    text = "synthetic {i}".format(i=i)
+    if length is not None and len(text) > int(length):
+        text = str(i)[-int(length):]
+    return "'{text}'".format(text=text)
+
+# Define function to time the insert of the synthetic rows into one table, and the upsert of the same rows again
+# (every row a duplicate, every column that is not part of a unique key changed to the value of another row,
+# so every index on those columns is maintained), in batches of batch_size rows
+def time_load(conn, table, columns, unique_columns, rows, batch_size):
+    cursor = conn.cursor()
+    loaded = [(name, column_type) for name, column_type, auto_increment in columns if not auto_increment]
+    updates = ", ".join("{name} = VALUES({name})".format(name=name) for name, _ in loaded if name not in unique_columns)
+    timings = {}
+    for phase in ('insert', 'upsert'):
+        start = time.time()
+        for first in range(1, rows + 1, batch_size):
+            shift = rows if phase == 'upsert' else 0
+            values = ",\n".join(
+                "(" + ", ".join(synthetic_value(column_type, i if name in unique_columns else i + shift)
+                                for name, column_type in loaded) + ")"
+                for i in range(first, min(first + batch_size, rows + 1)))
+            query = "INSERT INTO `{schema}`.`{table}` ({columns}) VALUES {values}".format(
+                schema=STAR_SCHEMA, table=table, columns=", ".join(name for name, _ in loaded), values=values)
+            if phase == 'upsert' and updates:
+                query += " ON DUPLICATE KEY UPDATE " + updates
+            cursor.execute(query)
+            conn.commit()
+        timings[phase] = time.time() - start
+    cursor.close()
+    return timings
+
+# Define function to benchmark one table with its current indexes and with the lean index set,
+# on two empty copies of the table (audit_<table>_current and audit_<table>_lean) that are dropped afterwards
+def benchmark_table(mysql_hook, table, dropped, added, unique_columns, rows, batch_size):
+    columns = read_columns(mysql_hook, table)
+    results = {}
+    conn = mysql_hook.get_conn()
+    try:
+        for variant in ('current', 'lean'):
+            copy = "audit_{table}_{variant}".format(table=table, variant=variant)
+            cursor = conn.cursor()
+            cursor.execute("DROP TABLE IF EXISTS `{schema}`.`{copy}`".format(schema=STAR_SCHEMA, copy=copy))
+            cursor.execute("CREATE TABLE `{schema}`.`{copy}` LIKE `{schema}`.`{table}`".format(
+                schema=STAR_SCHEMA, copy=copy, table=table))
+            if variant == 'lean':
+                statement = migration_statement(copy, dropped, added)
+                if statement:
+                    cursor.execute(statement)
+            cursor.close()
+            try:
+                results[variant] = time_load(conn, copy, columns, unique_columns, rows, batch_size)
+            finally:
+                cursor = conn.cursor()
+                cursor.execute("DROP TABLE IF EXISTS `{schema}`.`{copy}`".format(schema=STAR_SCHEMA, copy=copy))
+                cursor.close()
+    finally:
+        conn.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Audit the indexes of the sakila_star database')
+    parser.add_argument('--conn-id', default='my_sql', help='Airflow connection of the sakila_star database')
+    parser.add_argument('--rows', type=int, default=20000, help='Synthetic rows loaded per table and index set')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per synthetic INSERT statement')
+    parser.add_argument('--skip-benchmark', action='store_true', help='Only report and write the migration')
+    parser.add_argument('--output', help='File the migration is written to, standard output when not given')
+    args = parser.parse_args()
+
+    mysql_hook = MySqlHook(mysql_conn_id=args.conn_id)
+    statements = []
+    for table in STAR_TABLES:
+        indexes = read_indexes(mysql_hook, table)
+        if not indexes:
+            print("{table}: table not found, skipped".format(table=table), file=sys.stderr)
+            continue
+        kept, dropped = find_redundant(indexes)
+        added, covered = plan_covering(table, kept)
+        dropped += covered
+
+        print("{table}: {count} indexes".format(table=table, count=len(indexes)), file=sys.stderr)
+        for index, cover, reason in dropped:
+            print("  drop {name} ({columns}), {reason} of {cover} ({cover_columns})".format(
+                name=index['name'], columns=', '.join(index['columns']), reason=reason,
+                cover=cover['name'], cover_columns=', '.join(cover['columns'])), file=sys.stderr)
+        for name, columns in added:
+            print("  add {name} ({columns}), covering index of the workload".format(
+                name=name, columns=', '.join(columns)), file=sys.stderr)
+
+        if (dropped or added) and not args.skip_benchmark:
+            unique_columns = set(column for index in indexes.values() if index['unique'] for column in index['columns'])
+            results = benchmark_table(mysql_hook, table, dropped, added, unique_columns, args.rows, args.batch_size)
+            for phase in ('insert', 'upsert'):
+                current = results['current'][phase]
+                lean = results['lean'][phase]
+                print("  {phase} {rows} rows: current {current:.2f}s ({current_rate:.0f} rows/s), "
+                      "lean {lean:.2f}s ({lean_rate:.0f} rows/s)".format(
+                          phase=phase, rows=args.rows, current=current, lean=lean,
+                          current_rate=args.rows / current if current else 0,
+                          lean_rate=args.rows / lean if lean else 0), file=sys.stderr)
+
+        statement = migration_statement(table, dropped, added)
+        if statement:
+            statements.append(statement)
+
+    migration = "-- Lean index set of the sakila_star database, written by script-audit-star-schema-indexes.py\n"
+    migration += "USE sakila_star;\n\n" + "\n\n".join(statements) + "\n"
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(migration)
+    else:
+        sys.stdout.write(migration)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# Import required library
+import importlib.util
+import os
+import sys
+import types
+import pytest
+
+# Unit tests of the helpers of the DAG file and the scripts, they need no database
+# The DAG file builds its tasks when it is imported. Where airflow is not installed a stub of the few airflow names
+# the files import is installed first (install_airflow_stub), so the tests run in any python with numpy and pendulum.
+# The database is replaced by the fakes below, the MySqlHook of a module by the fake_hook fixture.
+#
+# Usage: python -m pytest tests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAG_FILE = os.path.join(ROOT, 'airflow-script-transform-daily.py')
+AUDIT_FILE = os.path.join(ROOT, 'script-audit-star-schema-indexes.py')
+
+# Operator stand-in, keeps its arguments as attributes and its downstream task ids
+class StubOperator:
+    def __init__(self, task_id, dag=None, python_callable=None, op_kwargs=None, **kwargs):
+        self.task_id = task_id
+        self.python_callable = python_callable
+        self.op_kwargs = op_kwargs or {}
+        self.downstream_task_ids = set()
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        if dag is not None:
+            dag.tasks.append(self)
+
+    def __rshift__(self, other):
+        for task in other if isinstance(other, list) else [other]:
+            self.downstream_task_ids.add(task.task_id)
+        return other
+
+    def __rrshift__(self, other):
+        for task in other:
+            task >> self
+        return self
+
+class StubDAG:
+    def __init__(self, dag_id, params=None, **kwargs):
+        self.dag_id = dag_id
+        self.params = params or {}
+        self.tasks = []
+
+class StubMySqlHook:
+    def __init__(self, mysql_conn_id):
+        raise RuntimeError('No database in the unit tests, use the fake_hook fixture')
+
+# Install the modules and names of airflow the files of the repository import, unless airflow is installed
+def install_airflow_stub():
+    try:
+        import airflow.providers.mysql.hooks.mysql
+        return
+    except ImportError:
+        pass
+    names = {
+        'airflow': {'DAG': StubDAG},
+        'airflow.exceptions': {'AirflowException': type('AirflowException', (Exception,), {}),
+                               'AirflowSkipException': type('AirflowSkipException', (Exception,), {})},
+        'airflow.operators': {},
+        'airflow.operators.mysql_operator': {'MySqlOperator': type('MySqlOperator', (StubOperator,), {})},
+        'airflow.operators.python_operator': {},
+        'airflow.providers': {},
+        'airflow.providers.mysql': {},
+        'airflow.providers.mysql.hooks': {},
+        'airflow.providers.mysql.hooks.mysql': {'MySqlHook': StubMySqlHook},
+        'airflow.utils': {},
+        'airflow.utils.dates': {'days_ago': lambda n: None},
+    }
+    python_operator = type('PythonOperator', (StubOperator,), {})
+    names['airflow.operators.python_operator'] = {
+        'PythonOperator': python_operator,
+        'BranchPythonOperator': type('BranchPythonOperator', (python_operator,), {}),
+    }
+    for name, attributes in names.items():
+        module = types.ModuleType(name)
+        module.__path__ = []
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+
+# Import a script of the repository as a module, their names are not valid module names
+def load_script(name, path):
+    install_airflow_stub()
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# The DAG file imported once for all tests
+@pytest.fixture(scope='session')
+def dag_module():
+    return load_script('sakila_to_star_schema', DAG_FILE)
+
+# The index audit script imported once for all tests
+@pytest.fixture(scope='session')
+def audit_module():
+    return load_script('audit_star_schema_indexes', AUDIT_FILE)
+
+# Cursor stand-in that records the statements and returns the queued results
+# A queued tuple is one row for fetchone, a queued list is the whole result of one fetchall,
+# a fetchall without a queued list returns every queued row
+class FakeCursor:
+    def __init__(self, rows=(), rowcount=0):
+        self.rows = list(rows)
+        self.rowcount = rowcount
+        self.statements = []
+
+    def execute(self, query, parameters=None):
+        self.statements.append((query, parameters))
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        if self.rows and isinstance(self.rows[0], list):
+            return self.rows.pop(0)
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+# Connection stand-in with one cursor, its info string, and how many statements ran before every commit
+class FakeConnection:
+    def __init__(self, cursor=None, info=None):
+        self.fake_cursor = cursor if cursor is not None else FakeCursor()
+        self.info_text = info
+        self.commits = []
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self, *cursor_class):
+        return self.fake_cursor
+
+    def info(self):
+        return self.info_text
+
+    def commit(self):
+        self.commits.append(len(self.fake_cursor.statements))
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+# Task instance stand-in with the XCom calls of the task callables
+class FakeTaskInstance:
+    def __init__(self, task_id='test_task'):
+        self.task_id = task_id
+        self.xcom = {}
+
+    def xcom_push(self, key, value):
+        self.xcom[key] = value
+
+    def xcom_pull(self, task_ids, key):
+        return None
+
+@pytest.fixture
+def fake_cursor():
+    return FakeCursor
+
+@pytest.fixture
+def fake_connection():
+    return FakeConnection
+
+@pytest.fixture
+def fake_task_instance():
+    return FakeTaskInstance
+
+# Point the MySqlHook of the DAG module at queued connections, one per get_conn, a queued exception is raised
+# instead (a failed connect), and skip the retry sleeps. Returns the list of the get_conn calls so far
+@pytest.fixture
+def fake_hook(dag_module, monkeypatch):
+    def install(*connections):
+        queue = list(connections)
+        opened = []
+
+        class Hook:
+            def __init__(self, mysql_conn_id):
+                pass
+
+            def get_conn(self):
+                conn = queue.pop(0)
+                opened.append(conn)
+                if isinstance(conn, Exception):
+                    raise conn
+                return conn
+
+        monkeypatch.setattr(dag_module, 'MySqlHook', Hook)
+        monkeypatch.setattr(dag_module.time, 'sleep', lambda seconds: None)
+        return opened
+    return install
@@ -0,0 +1,46 @@
+# Import required library
+from datetime import datetime, timezone
+import pendulum
+
+# Tests of the change window: the predicate, the lookback overlap, the watermark that never moves back
+# and the end of the window in the time zone of the source
+
+def test_change_predicate_ranges_on_last_update_then_id(dag_module):
+    predicate = dag_module.change_predicate('SRC', 'customer_id')
+    assert "SRC.last_update > %(wm_update)s" in predicate
+    assert "SRC.last_update = %(wm_update)s AND SRC.customer_id > %(wm_id)s" in predicate
+    assert predicate.rstrip().endswith("SRC.last_update < %(end)s")
+
+def test_change_window_without_lookback_starts_after_the_watermark(dag_module):
+    window = dag_module.change_window(('2024-05-01 10:00:00', 42), '2024-05-02 00:00:00', 0)
+    assert window == {'wm_update': '2024-05-01 10:00:00', 'wm_id': 42, 'end': '2024-05-02 00:00:00'}
+
+def test_change_window_lookback_reads_every_row_of_the_overlap(dag_module):
+    window = dag_module.change_window(('2024-05-01 10:00:00', 42), '2024-05-02 00:00:00', 300)
+    assert window == {'wm_update': '2024-05-01 09:55:00', 'wm_id': -1, 'end': '2024-05-02 00:00:00'}
+
+def test_change_window_first_run_starts_at_the_default_watermark(dag_module):
+    window = dag_module.change_window(dag_module.DEFAULT_WATERMARK, '2024-05-02 00:00:00', 300)
+    assert (window['wm_update'], window['wm_id']) == dag_module.DEFAULT_WATERMARK
+
+def test_next_watermark_never_moves_back(dag_module):
+    watermark = ('2024-05-01 10:00:00', 42)
+    assert dag_module.next_watermark(watermark, None) is None
+    assert dag_module.next_watermark(watermark, ('2024-05-01 09:58:00', 7)) == watermark
+    assert dag_module.next_watermark(watermark, ('2024-05-01 10:00:00', 43)) == ('2024-05-01 10:00:00', 43)
+    assert dag_module.next_watermark(watermark, ('2024-05-01 11:00:00', 1)) == ('2024-05-01 11:00:00', 1)
+
+def test_window_end_moves_utc_by_the_offset_of_the_server(dag_module, fake_cursor):
+    cursor = fake_cursor([(7200,)])
+    end = datetime(2024, 5, 1, 22, 30, tzinfo=timezone.utc)
+    assert dag_module.window_end(cursor, end, {'source_timezone': ''}) == '2024-05-02 00:30:00'
+
+def test_window_end_uses_the_source_timezone_param(dag_module, fake_cursor):
+    cursor = fake_cursor()
+    end = pendulum.datetime(2024, 1, 15, 12, 0, tz='UTC')
+    assert dag_module.window_end(cursor, end, {'source_timezone': 'Asia/Jakarta'}) == '2024-01-15 19:00:00'
+    assert cursor.statements == []
+
+def test_window_end_keeps_a_naive_end(dag_module, fake_cursor):
+    cursor = fake_cursor()
+    assert dag_module.window_end(cursor, datetime(2024, 5, 1, 8, 0), {'source_timezone': 'UTC'}) == '2024-05-01 08:00:00'
@@ -0,0 +1,21 @@
+# Import required library
+import pytest
+
+# Tests of the multi-statement batches of the consolidated execution mode
+
+def test_every_statement_of_a_consolidated_batch_is_non_empty(dag_module):
+    for _, specs in dag_module.CONSOLIDATED_STAGES:
+        loads = [dag_module.render_load(spec['table']) for spec in specs]
+        for name in ('query', 'publish_query'):
+            batch = dag_module.batch_query([load[name] for load in loads])
+            statements = batch.split(";\n")
+            assert len(statements) == len(loads)
+            assert all(statement.strip() for statement in statements)
+            assert ";;" not in batch and not batch.rstrip().endswith(";")
+
+def test_batch_query_drops_the_trailing_semicolons(dag_module):
+    assert dag_module.batch_query(["SELECT 1;", "\nSELECT 2 ;\n"]) == "SELECT 1;\nSELECT 2"
+
+def test_batch_query_rejects_an_empty_statement(dag_module):
+    with pytest.raises(ValueError):
+        dag_module.batch_query(["SELECT 1", " ; "])
@@ -0,0 +1,28 @@
+# Tests of the refresh of the customer feature mart: the previous customers of the changed facts
+# are collected before the publish and the collected keys only go away with the refreshed mart rows
+
+def test_previous_customers_are_collected_before_the_fact_rows_change(dag_module):
+    load = dag_module.render_load('fact_transaction')
+    for before_queries in (load['before_publish'], load['transfer']['before_merge']):
+        previous_query, stale_query = before_queries
+        assert "SELECT DISTINCT 'mart_customer_features', FT.customer_key" in previous_query
+        assert stale_query.lstrip().startswith("DELETE FT")
+    assert load['before_publish'][0].rstrip().endswith("AND FT.rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s")
+    assert "%(" not in load['transfer']['before_merge'][0]
+
+def test_refresh_counts_the_collected_customers_and_removes_their_keys_last(dag_module, fake_cursor, fake_connection,
+                                                                           fake_task_instance, fake_hook):
+    # 599 mart rows, then 3 customers collected by the fact load and the affected query
+    cursor = fake_cursor([(599,), (3,)])
+    connection = fake_connection(cursor)
+    fake_hook(connection)
+    ti = fake_task_instance()
+    assert dag_module.refresh_customer_features({'mart_rebuild': False}, ti) == 3
+    assert ti.xcom['mart_counts'] == {'customers': 3, 'rebuild': False}
+    statements = [statement[0] for statement in cursor.statements]
+    # The affected customers are committed before their mart rows are replaced, the refresh commits last
+    collected = statements.index(dag_module.mart_affected_query) + 1
+    assert connection.commits == [collected, len(statements)]
+    assert statements.index(dag_module.mart_delete_query) > collected
+    assert statements[-1].startswith("DELETE FROM sakila_star.etl_changed_keys WHERE target_table = 'mart_customer_features'")
+    assert not any(statement.startswith("DELETE FROM sakila_star.etl_changed_keys") for statement in statements[:-1])
@@ -0,0 +1,51 @@
+# Import required library
+import pytest
+
+# Tests of the chunked fact load: the key ranges of the changed rental_ids and the retry of a chunk
+
+def test_changed_key_ranges_split_the_sorted_keys(dag_module, fake_cursor):
+    cursor = fake_cursor([(1,), (2,), (5,), (9,), (10,)])
+    assert dag_module.changed_key_ranges(cursor, 'fact_transaction', 2) == [(1, 2), (5, 9), (10, 10)]
+    assert cursor.statements[0][1] == ('fact_transaction',)
+
+def test_changed_key_ranges_of_an_exact_multiple(dag_module, fake_cursor):
+    cursor = fake_cursor([(3,), (4,), (7,), (8,)])
+    assert dag_module.changed_key_ranges(cursor, 'fact_transaction', 2) == [(3, 4), (7, 8)]
+
+def test_changed_key_ranges_without_keys(dag_module, fake_cursor):
+    assert dag_module.changed_key_ranges(fake_cursor([]), 'fact_transaction', 100) == []
+
+def test_load_chunk_retries_a_failed_connect(dag_module, fake_cursor, fake_connection, fake_hook):
+    # The upsert reports "Records: 2  Duplicates: 0" and the session read 15 rows between the two Handler_read% probes
+    cursor = fake_cursor([[('Handler_read_key', '10')], [('Handler_read_key', '25')]], rowcount=2)
+    conn = fake_connection(cursor, "Records: 2  Duplicates: 0  Warnings: 0")
+    opened = fake_hook(ConnectionError('Lost connection to MySQL server during connect'), conn)
+    counts = dag_module.load_chunk("INSERT ...", (1, 10))
+    assert counts['records'] == 2 and counts['inserted'] == 2 and counts['rows_examined'] == 15
+    assert len(opened) == 2 and conn.commits == [len(cursor.statements)] and conn.closed
+
+def test_load_chunk_gives_up_after_the_last_attempt(dag_module, fake_hook):
+    failures = [ConnectionError('Lost connection to MySQL server during connect')] * dag_module.FACT_CHUNK_ATTEMPTS
+    opened = fake_hook(*failures)
+    with pytest.raises(ConnectionError):
+        dag_module.load_chunk("INSERT ...", (1, 10))
+    assert len(opened) == dag_module.FACT_CHUNK_ATTEMPTS
+
+def test_chunked_publish_commits_every_range_in_one_transaction(dag_module, fake_cursor, fake_connection,
+                                                                fake_task_instance, fake_hook, monkeypatch):
+    cursor = fake_cursor()
+    conn = fake_connection(cursor)
+    fake_hook(conn)
+    monkeypatch.setattr(dag_module, 'collect_changes', lambda *args: ({}, {'rental': 3}))
+    monkeypatch.setattr(dag_module, 'load_key_ranges', lambda *args: dict(dag_module.NO_RECORDS, rows_examined=0))
+    monkeypatch.setattr(dag_module, 'changed_key_ranges', lambda *args: [(1, 2), (5, 9), (10, 10)])
+    monkeypatch.setattr(dag_module, 'commit_load', lambda conn, *args: conn.commit())
+    monkeypatch.setattr(dag_module, 'finish_load', lambda table, counts, *args: counts)
+    params = {'load_mode': 'local', 'fact_load_mode': 'chunked', 'fact_chunk_size': 2}
+    dag_module.load_fact_table('fact_transaction', None, params, fake_task_instance(), 'run')
+    publish_query = dag_module.render_load('fact_transaction')['publish_range_query']
+    published = [i for i, (query, _) in enumerate(cursor.statements) if query == publish_query]
+    assert [cursor.statements[i][1] for i in published] == [
+        {'chunk_lo': 1, 'chunk_hi': 2}, {'chunk_lo': 5, 'chunk_hi': 9}, {'chunk_lo': 10, 'chunk_hi': 10}]
+    # The probe and the staging build commit before the publish, then one commit after the last range
+    assert [commit for commit in conn.commits if commit > published[0]] == [len(cursor.statements)]
@@ -0,0 +1,15 @@
+# Tests of the synthetic rows of the index audit, every value has to fit its column in strict mode
+
+def test_synthetic_integers_stay_in_the_range_of_their_type(audit_module):
+    assert audit_module.synthetic_value(('tinyint', 'tinyint(3)', None, 3, 0), 20000) == str(20000 % 128)
+    assert audit_module.synthetic_value(('tinyint', 'tinyint(3) unsigned', None, 3, 0), 300) == str(300 % 256)
+    assert audit_module.synthetic_value(('int', 'int(8)', None, 10, 0), 20000) == '20000'
+
+def test_synthetic_strings_are_cut_to_the_column_length(audit_module):
+    assert audit_module.synthetic_value(('char', 'char(3)', 3, None, None), 20000) == "'000'"
+    assert audit_module.synthetic_value(('char', 'char(3)', 3, None, None), 7) == "'7'"
+    assert audit_module.synthetic_value(('varchar', 'varchar(45)', 45, None, None), 7) == "'synthetic 7'"
+
+def test_synthetic_decimals_stay_below_the_precision(audit_module):
+    assert float(audit_module.synthetic_value(('decimal', 'decimal(3,2)', None, 3, 2), 999)) < 10
+    assert float(audit_module.synthetic_value(('decimal', 'decimal(2,2)', None, 2, 2), 999)) < 1
@@ -0,0 +1,59 @@
+# Import required library
+import pytest
+
+# Tests of the key-cache fact load: the upsert counts from the connection info, the key maps of the dimensions,
+# the vectorized key lookup and the multi-row upsert of a batch
+
+np = pytest.importorskip('numpy')
+
+def test_parse_info_counter(dag_module):
+    info = "Records: 1000  Duplicates: 250  Warnings: 0"
+    assert dag_module.parse_info_counter(info, 'Records') == 1000
+    assert dag_module.parse_info_counter(info, 'Duplicates') == 250
+    assert dag_module.parse_info_counter(None, 'Records') == 0
+    assert dag_module.parse_info_counter("Rows matched: 1  Changed: 1  Warnings: 0", 'Duplicates') == 0
+
+def test_resolve_keys_returns_0_for_unknown_ids(dag_module):
+    key_map = np.array([0, 11, 0, 13], dtype=np.int64)
+    assert dag_module.resolve_keys(key_map, [1, 3, 2, 4, -1, 100]).tolist() == [11, 13, 0, 0, 0, 0]
+    assert dag_module.resolve_keys(key_map, []).tolist() == []
+
+def test_load_key_map_keeps_the_highest_key_of_a_duplicate_id(dag_module, fake_cursor, monkeypatch, tmp_path):
+    monkeypatch.setattr(dag_module, 'KEY_CACHE_DIR', str(tmp_path))
+    # The fingerprint (count, max key, checksum), then (natural id, key) rows in no particular order, id 2 has two rows
+    cursor = fake_cursor([(4, 9, 1234), (2, 9), (1, 4), (2, 5), (3, 7)])
+    key_map = dag_module.load_key_map(cursor, 'dim_customer', 'customer_id', 'customer_key', True)
+    assert key_map.tolist() == [0, 4, 9, 7]
+    assert (tmp_path / 'dim_customer.npz').exists()
+
+def test_load_key_map_reuses_the_cache_while_the_fingerprint_holds(dag_module, fake_cursor, monkeypatch, tmp_path):
+    monkeypatch.setattr(dag_module, 'KEY_CACHE_DIR', str(tmp_path))
+    dag_module.load_key_map(fake_cursor([(1, 4, 77), (1, 4)]), 'dim_store', 'store_id', 'store_key', True)
+    cursor = fake_cursor([(1, 4, 77)])
+    assert dag_module.load_key_map(cursor, 'dim_store', 'store_id', 'store_key', False).tolist() == [0, 4]
+    assert len(cursor.statements) == 1
+
+def test_load_key_map_reloads_when_the_keys_moved_under_the_same_max_key(dag_module, fake_cursor, monkeypatch,
+                                                                          tmp_path):
+    monkeypatch.setattr(dag_module, 'KEY_CACHE_DIR', str(tmp_path))
+    dag_module.load_key_map(fake_cursor([(2, 5, 77), (1, 4), (2, 5)]), 'dim_store', 'store_id', 'store_key', True)
+    # Reloaded in the other order, same count and highest key, another checksum
+    cursor = fake_cursor([(2, 5, 78), (1, 5), (2, 4)])
+    assert dag_module.load_key_map(cursor, 'dim_store', 'store_id', 'store_key', False).tolist() == [0, 5, 4]
+    assert len(cursor.statements) == 2
+
+def test_load_key_map_of_an_empty_dimension(dag_module, fake_cursor, monkeypatch, tmp_path):
+    monkeypatch.setattr(dag_module, 'KEY_CACHE_DIR', str(tmp_path))
+    key_map = dag_module.load_key_map(fake_cursor([(0, 0, 0)]), 'dim_staff', 'staff_id', 'staff_key', True)
+    assert key_map.tolist() == [0]
+
+def test_upsert_fact_rows_sends_one_statement_per_batch(dag_module, fake_cursor, fake_connection):
+    # One statement of 3 rows, 1 of them hit an existing key and was updated
+    cursor = fake_cursor(rowcount=4)
+    rows = [tuple(range(row * 12, row * 12 + 12)) for row in range(3)]
+    counts = dag_module.upsert_fact_rows(fake_connection(cursor, "Records: 3  Duplicates: 1  Warnings: 0"), cursor, rows)
+    assert len(cursor.statements) == 1
+    query, parameters = cursor.statements[0]
+    assert query.count(dag_module.FACT_ROW_PLACEHOLDERS) == 3
+    assert parameters == list(range(36))
+    assert counts == {'records': 3, 'affected': 4, 'inserted': 2, 'updated': 1, 'unchanged': 0}
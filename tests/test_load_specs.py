@@ -0,0 +1,51 @@
+# Tests of the load specs and the queries render_load formats from them when a table loads
+
+def test_every_load_spec_renders(dag_module):
+    for spec in dag_module.LOAD_SPECS:
+        load = dag_module.render_load(spec['table'])
+        assert load['table'] == spec['table'] and load['query'] is spec['query']
+        assert "INSERT INTO sakila_star.{table}(".format(table=spec['table']) in load['publish_query']
+        assert "FROM sakila_star.stg_{table}".format(table=spec['table']) in load['publish_query']
+        assert load['transfer']['merge_query']
+        assert [source['source'] for source in load['sources']] == [source['source'] for source in spec['sources']]
+
+def test_render_load_formats_the_change_window_of_every_source(dag_module):
+    for spec in dag_module.LOAD_SPECS:
+        for source in dag_module.render_load(spec['table'])['sources']:
+            assert "{window}" not in source['keys_query']
+            assert "%(wm_update)s" in source['keys_query'] and "%(end)s" in source['keys_query']
+            assert source['keys_query'] % {'wm_update': '2024-05-01 00:00:00', 'wm_id': 0, 'end': '2024-05-02 00:00:00'}
+
+def test_render_load_is_cached_per_table(dag_module):
+    assert dag_module.render_load('dim_store') is dag_module.render_load('dim_store')
+
+def test_transfer_merge_query_defaults_to_the_staged_merge(dag_module):
+    load = dag_module.render_load('dim_store')
+    assert load['transfer']['merge_query'] == dag_module.staged_merge_query(
+        'dim_store', load['transfer']['staging_table'], dag_module.task_3_load['columns'], ['store_id'])
+
+def test_load_operator_passes_only_the_table_name(dag_module):
+    for task in dag_module.dimension_load_tasks + [dag_module.fact_load_task]:
+        assert set(task.op_kwargs) == {'table'}
+    assert dag_module.fact_load_task.trigger_rule == 'none_failed'
+
+def test_before_publish_queries_are_rendered_per_staging_table(dag_module):
+    assert '{staging_table}' in dag_module.task_6_load['before_publish'][1]
+    load = dag_module.render_load('fact_transaction')
+    for query in load['before_publish'] + load['transfer']['before_merge']:
+        assert '{' not in query
+    assert "sakila_star.stg_fact_transaction AS STG" in load['before_publish'][1]
+    assert "sakila_star.transfer_fact_transaction AS STG" in load['transfer']['before_merge'][1]
+
+def test_star_table_lists_are_derived_from_the_load_specs(dag_module):
+    assert dag_module.STAR_TABLES == ['dim_customer', 'dim_store', 'dim_staff', 'dim_film', 'bridge_film_category',
+                                      'fact_transaction']
+    assert dag_module.PARQUET_TABLES == dag_module.STAR_TABLES + ['mart_customer_features']
+    assert dag_module.PARQUET_LOGGED_TABLES == {'bridge_film_category': 'dim_film'}
+    # In the order of the natural id columns of fact_extract_query
+    assert dag_module.FACT_DIMENSIONS == [
+        ('dim_customer', 'customer_id', 'customer_key', 'mysql_task_2_execute_next'),
+        ('dim_staff', 'staff_id', 'staff_key', 'mysql_task_4_execute_next'),
+        ('dim_film', 'film_id', 'film_key', 'mysql_task_5_execute_next'),
+        ('dim_store', 'store_id', 'store_key', 'mysql_task_3_execute_next'),
+    ]
@@ -0,0 +1,34 @@
+# Import required library
+import os
+import pytest
+
+# Tests of the reader of the Parquet export, the newest version of a fact row wins across months
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+ds = pytest.importorskip('pyarrow.dataset')
+sakila_star_parquet = pytest.importorskip('sakila_star_parquet')
+
+def write_month(root, month, name, rows):
+    path = os.path.join(str(root), 'fact_transaction', 'rental_month=' + month)
+    os.makedirs(path, exist_ok=True)
+    pq.write_table(pa.table(rows), os.path.join(path, name))
+
+def test_read_table_keeps_the_newest_version_of_a_row_that_moved_month(tmp_path):
+    # Rental 1 was exported in May by run 1, its rental_date was corrected to June and run 2 exported it again
+    write_month(tmp_path, '2005-05', 'run-1.parquet', {
+        'rental_id': [1, 2], 'payment_id': [10, 20], 'export_run': [1, 1], 'payment_amount': [1.99, 2.99]})
+    write_month(tmp_path, '2005-06', 'run-2.parquet', {
+        'rental_id': [1], 'payment_id': [10], 'export_run': [2], 'payment_amount': [4.99]})
+    rows = sakila_star_parquet.read_table('fact_transaction', columns=['rental_id', 'payment_amount'],
+                                          root=str(tmp_path)).to_pydict()
+    assert sorted(zip(rows['rental_id'], rows['payment_amount'])) == [(1, 4.99), (2, 2.99)]
+
+def test_read_table_does_not_return_an_older_version_that_matches_the_filter(tmp_path):
+    write_month(tmp_path, '2005-05', 'run-1.parquet', {
+        'rental_id': [1, 2], 'payment_id': [10, 20], 'export_run': [1, 1], 'payment_amount': [1.99, 2.99]})
+    write_month(tmp_path, '2005-06', 'run-2.parquet', {
+        'rental_id': [1], 'payment_id': [10], 'export_run': [2], 'payment_amount': [4.99]})
+    rows = sakila_star_parquet.read_table('fact_transaction', columns=['rental_id'],
+                                          filter=ds.field('rental_month') == '2005-05', root=str(tmp_path)).to_pydict()
+    assert rows['rental_id'] == [2]
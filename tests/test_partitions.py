@@ -0,0 +1,80 @@
+# Import required library
+import re
+import pendulum
+
+# Tests of the monthly partitions of the fact table and of the stale fact rows deleted before the publish
+
+def test_add_months_rolls_over_the_year(dag_module):
+    assert dag_module.add_months(2024, 11, 3) == (2025, 2)
+    assert dag_module.add_months(2024, 12, 1) == (2025, 1)
+    assert dag_module.add_months(2024, 1, -1) == (2023, 12)
+    assert dag_module.add_months(2024, 5, 0) == (2024, 5)
+    assert dag_module.add_months(2024, 3, -27) == (2021, 12)
+
+def test_month_partition_holds_the_dates_before_the_next_month(dag_module):
+    partition = dag_module.month_partition(2024, 12)
+    assert partition.startswith("PARTITION p202412 ")
+    assert "'2025-01-01'" in partition
+
+def test_fact_stale_rows_are_deleted_per_range_before_the_publish(dag_module):
+    load = dag_module.render_load('fact_transaction')
+    stale_query = load['before_publish'][-1]
+    assert stale_query.lstrip().startswith("DELETE FT")
+    assert "LEFT JOIN sakila_star.stg_fact_transaction AS STG" in stale_query
+    assert "STG.rental_date = FT.rental_date" in stale_query
+    assert stale_query.rstrip().endswith("AND FT.rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s")
+    assert stale_query % dag_module.FULL_KEY_RANGE
+
+def test_fact_transfer_deletes_the_stale_rows_before_the_merge(dag_module):
+    stale_query = dag_module.render_load('fact_transaction')['transfer']['before_merge'][-1]
+    assert "LEFT JOIN sakila_star.transfer_fact_transaction AS STG" in stale_query
+    assert "%(" not in stale_query
+
+def test_dimensions_delete_nothing_before_the_publish(dag_module):
+    for spec in dag_module.DIMENSION_LOAD_SPECS:
+        load = dag_module.render_load(spec['table'])
+        assert load['before_publish'] == [] and load['transfer']['before_merge'] == []
+
+def test_new_partition_months_fold_the_empty_months_since_the_last_partition(dag_module):
+    # Last partition 2006-02, run in 2026-10, p_future has rows of 2006-03 and 2026-09
+    assert dag_module.new_partition_months([(2006, 1), (2006, 2)], [(2006, 3), (2026, 9)], (2026, 10), (2027, 1)) == [
+        (2006, 3), (2026, 9), (2026, 10), (2026, 11), (2026, 12), (2027, 1)]
+    assert dag_module.new_partition_months([(2024, 5), (2024, 6)], [], (2024, 5), (2024, 8)) == [(2024, 7), (2024, 8)]
+    assert dag_module.new_partition_months([], [], (2024, 5), (2024, 6)) == [(2024, 5), (2024, 6)]
+
+# Hook stand-in of maintain_fact_partitions, answers the partition and row month queries and records the DDL
+class PartitionHook:
+    def __init__(self, names, row_months):
+        self.names = names
+        self.row_months = row_months
+        self.statements = []
+
+    def get_records(self, query, parameters=None):
+        if 'information_schema.PARTITIONS' in query:
+            return [(name,) for name in self.names]
+        return self.row_months
+
+    def get_first(self, query, parameters=None):
+        return (0,) if 'COUNT(*)' in query else None
+
+    def run(self, query, parameters=None):
+        self.statements.append(' '.join(query.split()))
+
+def maintain(dag_module, monkeypatch, hook, retention):
+    monkeypatch.setattr(dag_module, 'MySqlHook', lambda mysql_conn_id: hook)
+    params = {'fact_partition_months_ahead': 2, 'fact_partition_retention_months': retention,
+              'fact_partition_expire': 'drop'}
+    dag_module.maintain_fact_partitions(pendulum.datetime(2026, 10, 18), params)
+    return hook.statements
+
+def test_first_maintenance_on_a_current_date_splits_only_the_needed_months(dag_module, monkeypatch):
+    hook = PartitionHook(['p_history', 'p200505', 'p200602', 'p_future'], [(2006, 3)])
+    statements = maintain(dag_module, monkeypatch, hook, 0)
+    assert len(statements) == 1
+    assert re.findall(r'PARTITION (p\d{6}) ', statements[0]) == ['p200603', 'p202610', 'p202611', 'p202612']
+
+def test_retention_removes_the_old_months_and_p_history(dag_module, monkeypatch):
+    hook = PartitionHook(['p_history', 'p200505', 'p200602', 'p_future'], [])
+    statements = maintain(dag_module, monkeypatch, hook, 12)
+    assert statements[1:] == ["ALTER TABLE sakila_star.fact_transaction DROP PARTITION {name}".format(name=name)
+                              for name in ('p_history', 'p200505', 'p200602')]
@@ -0,0 +1,52 @@
+# Tests of the reconciliation hash queries
+
+# Number of the top level expressions of the SELECT list of a query
+def select_width(query):
+    select_list = query.split('SELECT', 1)[1].split('\n    FROM', 1)[0]
+    depth = 0
+    width = 1
+    for character in select_list:
+        depth += {'(': 1, ')': -1}.get(character, 0)
+        width += character == ',' and depth == 0
+    return width
+
+def test_reconcile_hash_query_of_a_range(dag_module):
+    spec = dag_module.reconcile_spec("SELECT 1, 2", ('sakila.store', 'store_id'), 'dim_store', 'store_id',
+                                     ['store_id', 'store_city'])
+    query = dag_module.reconcile_hash_query(spec, "SELECT 1, 2", False)
+    assert query == ("SELECT COUNT(*), BIT_XOR(CRC32(CONCAT_WS('|', COALESCE(R.store_id, '<null>'), "
+                     "COALESCE(R.store_city, '<null>')))) FROM (SELECT 1, 2) AS R (store_id, store_city)")
+
+def test_reconcile_hash_query_by_key_groups_by_the_natural_id(dag_module):
+    spec = dag_module.reconcile_spec("SELECT 1, 2", ('sakila.store', 'store_id'), 'dim_store', 'store_id',
+                                     ['store_id', 'store_city'])
+    query = dag_module.reconcile_hash_query(spec, "SELECT 1, 2", True)
+    assert query.startswith("SELECT R.store_id, COUNT(*), BIT_XOR(")
+    assert query.endswith("AS R (store_id, store_city) GROUP BY R.store_id")
+
+def test_reconcile_queries_select_every_column_of_the_spec(dag_module):
+    for spec in dag_module.RECONCILE_SPECS:
+        star_query = spec['star_query'] or dag_module.star_rows_query(spec['table'], spec['columns'], spec['key_column'])
+        assert select_width(spec['source_query']) == len(spec['columns']), spec['table']
+        assert select_width(star_query) == len(spec['columns']), spec['table']
+        for query in (spec['source_query'], star_query):
+            assert "BETWEEN %(lo)s AND %(hi)s" in dag_module.reconcile_hash_query(spec, query, True)
+
+def test_load_spec_fills_in_the_reconciliation_fields_of_its_table(dag_module):
+    spec = dag_module.task_3_load['reconcile'][0]
+    assert (spec['table'], spec['key_column'], spec['columns']) == ('dim_store', 'store_id', dag_module.task_3_columns)
+    assert spec['star_keys'] == ('sakila_star.dim_store', 'store_id') and spec['repair_table'] == 'dim_store'
+    bridge = dag_module.task_5_load['reconcile'][1]
+    assert bridge['table'] == 'bridge_film_category' and bridge['repair_table'] == 'dim_film'
+    assert [spec['table'] for spec in dag_module.RECONCILE_SPECS] == [
+        'dim_customer', 'dim_store', 'dim_staff', 'dim_film', 'bridge_film_category', 'fact_transaction']
+
+def test_reconciliation_reads_both_servers_in_read_committed(dag_module, monkeypatch, fake_hook, fake_connection,
+                                                             fake_task_instance):
+    source, target = fake_connection(), fake_connection()
+    fake_hook(source, target)
+    monkeypatch.setattr(dag_module, 'RECONCILE_SPECS', [])
+    dag_module.reconcile_star_schema({'reconcile': True}, fake_task_instance(), 'run')
+    for conn in (source, target):
+        assert conn.fake_cursor.statements[0] == ("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED", None)
+        assert conn.closed
@@ -0,0 +1,23 @@
+# Tests of the merge of a staging table into its star table
+
+def test_staged_merge_query_updates_every_column_but_the_natural_key(dag_module):
+    query = dag_module.staged_merge_query('dim_store', 'stg_dim_store', ['store_last_update', 'store_id', 'store_city'],
+                                          ['store_id'])
+    assert "INSERT INTO sakila_star.dim_store(store_last_update, store_id, store_city)" in query
+    assert "FROM sakila_star.stg_dim_store\n    ON DUPLICATE KEY UPDATE" in query
+    assert "store_last_update = VALUES(store_last_update)" in query
+    assert "store_city = VALUES(store_city)" in query
+    assert "store_id = VALUES(store_id)" not in query
+    assert "WHERE" not in query
+
+def test_staged_merge_query_limited_to_a_key_range(dag_module):
+    query = dag_module.staged_merge_query('fact_transaction', 'stg_fact_transaction', ['rental_id', 'payment_id', 'amount'],
+                                          ['rental_id', 'payment_id'], 'rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s')
+    assert "FROM sakila_star.stg_fact_transaction\n    WHERE rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s\n" in query
+    assert query % {'chunk_lo': 1, 'chunk_hi': 5000}
+
+def test_fact_publish_range_query_uses_the_chunk_boundaries(dag_module):
+    load = dag_module.render_load('fact_transaction')
+    assert "WHERE rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s" in load['publish_range_query']
+    assert load['publish_range_query'].replace(
+        "\n    WHERE rental_id BETWEEN %(chunk_lo)s AND %(chunk_hi)s", "") == load['publish_query']
@@ -0,0 +1,23 @@
+# Import required library
+from datetime import datetime
+from decimal import Decimal
+
+# Tests of the LOAD DATA lines of the transfer mode
+
+def test_load_data_line_separates_fields_with_tabs(dag_module):
+    row = (7, 'Mary', Decimal('4.99'), datetime(2005, 5, 24, 22, 53, 30))
+    assert dag_module.load_data_line(row) == '7\tMary\t4.99\t2005-05-24 22:53:30\n'
+
+def test_load_data_line_writes_null_as_backslash_n(dag_module):
+    assert dag_module.load_data_line((1, None, '')) == '1\t\\N\t\n'
+
+def test_load_data_line_escapes_the_separators(dag_module):
+    line = dag_module.load_data_line(('a\tb', 'c\nd', 'e\rf', 'g\0h', 'back\\slash'))
+    assert line == 'a\\tb\tc\\nd\te\\rf\tg\\0h\tback\\\\slash\n'
+    assert line.count('\t') == 4 and line.count('\n') == 1
+
+def test_load_data_line_keeps_a_literal_backslash_n_apart_from_null(dag_module):
+    assert dag_module.load_data_line(('\\N',)) == '\\\\N\n'
+
+def test_load_data_line_writes_bytes_as_hex_and_sets_as_lists(dag_module):
+    assert dag_module.load_data_line((b'\x00\xff', {'Trailers', 'Commentaries'})) == '00ff\tCommentaries,Trailers\n'